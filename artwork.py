@@ -0,0 +1,344 @@
+# Track metadata and album art cache.
+#
+# Metadata is remembered per device and track, so the last track of a
+# phone can be drawn the moment it reconnects, before its player has been
+# read again. Album art comes from AVRCP cover art (BIP over OBEX), which
+# BlueZ exposes when the player has an ObexPort property and the track an
+# ImgHandle. The image is fetched through obexd on the session bus,
+# decoded and scaled to display size on a worker thread, and kept in two
+# tiers:
+#
+#   memory  a small LRU of ready-to-draw QPixmaps, GUI thread only
+#   disk    scaled PNGs under the cache directory, oldest removed first
+#
+# Both are keyed by device and track identity rather than by image handle,
+# since handles are only valid for one OBEX session.
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from PyQt5.QtCore import Qt, QObject, QThread
+from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap
+from bluez_index import normalize_mac
+from diagnostics import metrics
+from ui_cache import cache_dir
+
+log = logging.getLogger(__name__)
+
+# Side of the square the art is scaled to fit, in pixels.
+ART_SIZE = 160
+# Entries kept in each tier.
+TRACK_CACHE_SIZE = 256
+PIXMAP_CACHE_SIZE = 32
+DISK_CACHE_SIZE = 500
+# Seconds to wait for obexd to finish a transfer.
+FETCH_TIMEOUT = 10.0
+
+OBEX_SERVICE = 'org.bluez.obex'
+OBEX_CLIENT_INTERFACE = 'org.bluez.obex.Client1'
+OBEX_IMAGE_INTERFACE = 'org.bluez.obex.Image1'
+OBEX_TRANSFER_INTERFACE = 'org.bluez.obex.Transfer1'
+
+
+# Identity of a track on a device. The image handle is left out on
+# purpose, see above.
+def track_key(device_path, track):
+    return (device_path, str(track.get('Title', "")),
+            str(track.get('Artist', "")), str(track.get('Album', "")),
+            int(track.get('Duration', 0) or 0))
+
+
+def _disk_name(key):
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest() + ".png"
+
+
+# Least recently used mapping with a fixed number of entries.
+class LruCache:
+    def __init__(self, size):
+        self._size = size
+        self._entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+
+# Fetches cover art thumbnails through obexd. One OBEX session is kept per
+# device until forget() is called.
+class BipFetcher:
+    def __init__(self):
+        from pydbus import SessionBus
+        from gi.repository import GLib
+        self._variant = GLib.Variant
+        self._bus = SessionBus()
+        self._client = self._bus.get(OBEX_SERVICE, '/org/bluez/obex')
+        # (address, port) -> session object path
+        self._sessions = {}
+
+    def fetch(self, address, port, handle, target):
+        session = self._sessions.get((address, port))
+        if session is None:
+            session = self._client[OBEX_CLIENT_INTERFACE].CreateSession(
+                address, {'Target': self._variant('s', 'bip-avrcp'),
+                          'PSM': self._variant('q', port)})
+            self._sessions[(address, port)] = session
+
+        try:
+            image = self._bus.get(OBEX_SERVICE, session)[
+                OBEX_IMAGE_INTERFACE]
+            transfer_path, _ = image.GetThumbnail(target, handle)
+        except Exception:
+            # The session may have gone with the connection. Start a new
+            # one next time.
+            self._sessions.pop((address, port), None)
+            raise
+        transfer = self._bus.get(OBEX_SERVICE, transfer_path)[
+            OBEX_TRANSFER_INTERFACE]
+
+        deadline = time.monotonic() + FETCH_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                status = transfer.Status
+            except Exception:
+                # obexd drops finished transfers straight away.
+                return os.path.exists(target)
+            if status == 'complete':
+                return True
+            if status == 'error':
+                return False
+            time.sleep(0.05)
+        return False
+
+    def forget(self, address):
+        for key in [key for key in self._sessions if key[0] == address]:
+            try:
+                self._client[OBEX_CLIENT_INTERFACE].RemoveSession(
+                    self._sessions.pop(key))
+            except Exception as e:
+                log.warning("Failed to close OBEX session: %s", e)
+
+
+# Loads art off the GUI thread: from the disk tier if it is there,
+# otherwise through BIP, then decodes and scales it. Only QImage is used
+# here; QPixmaps are made on the GUI thread.
+class ArtworkLoader(QThread):
+    # track key, scaled QImage or None when the track has no art
+    artLoaded = pyqtSignal(object, object)
+
+    # make_fetcher is called on the loader's thread, so that pydbus and the
+    # session bus stay off the GUI thread at start up.
+    def __init__(self, directory, size=ART_SIZE, make_fetcher=BipFetcher,
+                 disk_size=DISK_CACHE_SIZE, max_pending=8, parent=None):
+        super(ArtworkLoader, self).__init__(parent)
+        self._directory = directory
+        self._size = size
+        self._make_fetcher = make_fetcher
+        self._fetcher = None
+        self._disk_size = disk_size
+        # Only the most recent requests matter; older ones fall off.
+        self._pending = collections.deque(maxlen=max_pending)
+        # Addresses whose OBEX sessions are to be dropped. Kept apart from
+        # _pending so that a burst of track changes can't push them out.
+        self._forget = set()
+        self._condition = threading.Condition()
+        self._running = True
+
+        self.disk_hits = 0
+        self.fetches = 0
+        self.fetch_failures = 0
+
+    # Called from the GUI thread.
+    def request(self, key, address, port, handle):
+        with self._condition:
+            if any(job[0] == key for job in self._pending):
+                return
+            self._pending.append((key, address, port, handle))
+            self._condition.notify()
+
+    def forget_device(self, address):
+        with self._condition:
+            self._forget.add(address)
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def run(self):
+        os.makedirs(self._directory, exist_ok=True)
+        try:
+            self._fetcher = self._make_fetcher()
+        except Exception as e:
+            log.info("No cover art from obexd: %s", e)
+        while True:
+            with self._condition:
+                while self._running and not (self._pending or self._forget):
+                    self._condition.wait()
+                if not self._running:
+                    return
+                forget, self._forget = self._forget, set()
+                job = self._pending.popleft() if self._pending else None
+
+            if self._fetcher is not None:
+                for address in forget:
+                    self._fetcher.forget(address)
+            if job is None:
+                continue
+            key, address, port, handle = job
+
+            try:
+                image = self._load(key, address, port, handle)
+            except Exception as e:
+                log.error("Couldn't load album art: %s", e)
+                image = None
+            self.artLoaded.emit(key, image)
+
+    def _load(self, key, address, port, handle):
+        path = os.path.join(self._directory, _disk_name(key))
+        if os.path.exists(path):
+            image = QImage(path)
+            if not image.isNull():
+                self.disk_hits += 1
+                metrics.count("artwork.disk_hits")
+                # Keep recently used files at the young end.
+                os.utime(path)
+                return image
+
+        if self._fetcher is None or not handle or not port:
+            return None
+
+        self.fetches += 1
+        metrics.count("artwork.fetches")
+        # obexd writes the file itself.
+        target = os.path.join(self._directory, "fetch.img")
+        try:
+            with metrics.span("artwork.fetch"):
+                fetched = self._fetcher.fetch(address, port, handle, target)
+            image = QImage(target) if fetched else QImage()
+        finally:
+            if os.path.exists(target):
+                os.remove(target)
+        if image.isNull():
+            self.fetch_failures += 1
+            return None
+
+        image = image.scaled(self._size, self._size, Qt.KeepAspectRatio,
+                             Qt.SmoothTransformation)
+        # Written under another name and renamed, so a half-written file
+        # is never read back.
+        partial_path = path + ".tmp"
+        if image.save(partial_path, "PNG"):
+            os.replace(partial_path, path)
+            self._trim()
+        return image
+
+    def _trim(self):
+        files = [os.path.join(self._directory, name)
+                 for name in os.listdir(self._directory)
+                 if name.endswith(".png")]
+        if len(files) <= self._disk_size:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self._disk_size]:
+            os.remove(path)
+
+
+# The cache as the GUI sees it. Lives on the GUI thread.
+class ArtworkCache(QObject):
+    # track key, QPixmap or None when the track has no art
+    artReady = pyqtSignal(object, object)
+
+    def __init__(self, directory=None, size=ART_SIZE, parent=None):
+        super(ArtworkCache, self).__init__(parent)
+        self._tracks = LruCache(TRACK_CACHE_SIZE)
+        # device path -> key of the last track seen on it
+        self._last_track = {}
+        self._pixmaps = LruCache(PIXMAP_CACHE_SIZE)
+
+        self._loader = ArtworkLoader(
+            directory or os.path.join(cache_dir(), "art"), size)
+        self._loader.artLoaded.connect(self._on_art_loaded)
+        self._loader.start()
+
+        self.metadata_hits = 0
+        self.metadata_misses = 0
+        self.memory_hits = 0
+        self.misses = 0
+
+    # Records the track now playing on a device and returns its key. The
+    # art comes through artReady: straight away from memory, later from
+    # disk or the phone.
+    def track_changed(self, device_path, track, obex_port=None):
+        key = track_key(device_path, track)
+        if key in self._tracks:
+            self.metadata_hits += 1
+            metrics.count("artwork.metadata_hits")
+        else:
+            self.metadata_misses += 1
+            metrics.count("artwork.metadata_misses")
+        self._tracks.put(key, dict(track))
+        self._last_track[device_path] = key
+
+        if key in self._pixmaps:
+            self.memory_hits += 1
+            metrics.count("artwork.memory_hits")
+            self.artReady.emit(key, self._pixmaps.get(key))
+        else:
+            self.misses += 1
+            metrics.count("artwork.memory_misses")
+            self._loader.request(key, normalize_mac(device_path), obex_port,
+                                 track.get('ImgHandle'))
+        return key
+
+    # The last track seen on a device, or None.
+    def last_track(self, device_path):
+        key = self._last_track.get(device_path)
+        return self._tracks.get(key) if key is not None else None
+
+    def device_disconnected(self, device_path):
+        self._loader.forget_device(normalize_mac(device_path))
+
+    def stats(self):
+        return {
+            'metadata_hits': self.metadata_hits,
+            'metadata_misses': self.metadata_misses,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self._loader.disk_hits,
+            'misses': self.misses,
+            'fetches': self._loader.fetches,
+            'fetch_failures': self._loader.fetch_failures,
+        }
+
+    def close(self):
+        self._loader.stop()
+        self._loader.wait()
+
+    # Tracks without art are not remembered, so art that turns up later
+    # (a phone can send the ImgHandle after the title) is still fetched.
+    def _on_art_loaded(self, key, image):
+        if image is None:
+            self.artReady.emit(key, None)
+            return
+        pixmap = QPixmap.fromImage(image)
+        self._pixmaps.put(key, pixmap)
+        self.artReady.emit(key, pixmap)
@@ -0,0 +1,172 @@
+# End-to-end latency benchmark for the dashboard.
+#
+# Starts a private D-Bus daemon, runs fake_bluez.py on it and drives the
+# real GUI with the offscreen Qt platform, so no phone, adapter or display
+# is needed. Reports:
+#
+#   cold start          GUI() constructor to first painted frame
+#   bluetooth ready     GUI() constructor to the BlueZ index being built,
+#                       which happens after the first frame
+#   connect-to-label    Device1 connect to the song label showing the
+#                       device, i.e. discovery plus the player GetAll()
+#   signal-to-repaint   Track PropertiesChanged to the label repainting it
+#   scrolling cost      CPU seconds and memory growth per hour of scrolling
+#
+# Usage: python bench_dashboard.py [--rounds N] [--scroll-seconds S]
+
+import argparse
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MAC = "44:35:83:3E:0E:0A"
+
+
+def start_private_bus():
+    daemon = subprocess.Popen(
+        ["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+        stdout=subprocess.PIPE, text=True)
+    address = daemon.stdout.readline().strip()
+    return daemon, address
+
+
+def start_fake_bluez(media_delay):
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_bluez.py"),
+         "--device", MAC, "--connected",
+         "--media-delay", str(media_delay)],
+        stdout=subprocess.PIPE, text=True)
+    # The service prints one line once it owns org.bluez.
+    fake.stdout.readline()
+    return fake
+
+
+# Runs the Qt event loop until predicate() is true. Returns the time taken
+# in seconds, or None on timeout.
+def wait_until(app, predicate, timeout=10.0):
+    started = time.perf_counter()
+    while not predicate():
+        app.processEvents()
+        if time.perf_counter() - started > timeout:
+            return None
+        time.sleep(0.0005)
+    return time.perf_counter() - started
+
+
+def run_for(app, seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        app.processEvents()
+        time.sleep(0.001)
+
+
+def rss_kib():
+    with open("/proc/self/statm") as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+
+def summary(name, samples):
+    samples = [s * 1000 for s in samples if s is not None]
+    if not samples:
+        print(f"{name:<22} no samples (timed out)")
+        return
+    print(f"{name:<22} median {statistics.median(samples):8.2f} ms   "
+          f"max {max(samples):8.2f} ms   n={len(samples)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Dashboard latency benchmark against a fake BlueZ.")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--scroll-seconds", type=float, default=30.0)
+    parser.add_argument("--media-delay", type=int, default=0,
+                        help="ms the fake phone takes to publish its media "
+                             "objects after connecting")
+    args = parser.parse_args()
+
+    daemon, address = start_private_bus()
+    os.environ["DBUS_SESSION_BUS_ADDRESS"] = address
+    os.environ["DASHBOARD_BUS"] = "session"
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    # Keep the real state snapshot out of it.
+    os.environ.setdefault("DASHBOARD_STATE", os.path.join(
+        tempfile.mkdtemp(), "state.bin"))
+    fake = start_fake_bluez(args.media_delay)
+
+    try:
+        # Imported here so that pydbus picks up the private bus address.
+        os.chdir(HERE)
+        from pydbus import SessionBus
+        from PyQt5.QtWidgets import QApplication
+        import main as dashboard
+
+        app = QApplication([])
+        control = SessionBus().get("org.bluez", "/")
+
+        started = time.perf_counter()
+        window = dashboard.GUI()
+        label = window.scrolling_label
+        wait_until(app, lambda: label.frames_painted > 0)
+        cold_start = time.perf_counter() - started
+        print(f"{'cold start':<22} {cold_start * 1000:8.2f} ms")
+        # D-Bus is set up after the first frame.
+        wait_until(app, lambda: window.connection is not None)
+        bluetooth_ready = time.perf_counter() - started
+        print(f"{'bluetooth ready':<22} {bluetooth_ready * 1000:8.2f} ms")
+
+        connect_samples = []
+        for round_number in range(args.rounds):
+            control.Disconnect(MAC)
+            wait_until(
+                app, lambda: label.text() == "No media device connected")
+            control.Connect(MAC)
+            # Shown once the player's properties have been read.
+            connect_samples.append(wait_until(
+                app, lambda: label.text() == "Device connected"))
+        summary("connect-to-label", connect_samples)
+
+        repaint_samples = []
+        for round_number in range(args.rounds):
+            title = f"Track {round_number}"
+            painted = label.frames_painted
+            control.SetTrack(MAC, title, "Bench", "Bench", 180000)
+            repaint_samples.append(wait_until(
+                app, lambda: label.text().startswith(title)
+                and label.frames_painted > painted))
+        summary("signal-to-repaint", repaint_samples)
+
+        control.SetTrack(MAC, "A title long enough to need scrolling " * 3,
+                         "Bench", "Bench", 180000)
+        wait_until(app, lambda: label.frame_stats()['scrolling'])
+        label.reset_frame_stats()
+        rss_before = rss_kib()
+        cpu_before = time.process_time()
+        run_for(app, args.scroll_seconds)
+        cpu = time.process_time() - cpu_before
+        rss_growth = rss_kib() - rss_before
+        stats = label.frame_stats()
+
+        per_hour = 3600 / args.scroll_seconds
+        print(f"{'scrolling CPU':<22} {cpu * per_hour:8.1f} s/hour "
+              f"({cpu / args.scroll_seconds * 100:.1f}% of a core)")
+        print(f"{'scrolling memory':<22} {rss_kib():8d} KiB RSS, "
+              f"{rss_growth * per_hour:+.0f} KiB/hour")
+        print(f"{'paint cost':<22} {stats['cpu_ms_per_frame']:8.3f} ms "
+              f"CPU/frame over {stats['frames']} frames")
+
+        window.close()
+    finally:
+        fake.terminate()
+        daemon.terminate()
+        fake.wait()
+        daemon.wait()
+
+
+if __name__ == "__main__":
+    main()
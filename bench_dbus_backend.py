@@ -0,0 +1,142 @@
+# Compares the D-Bus backends (see dbus_backend.py).
+#
+# Starts a private D-Bus daemon with fake_bluez.py on it, like
+# bench_dashboard.py, then runs the real GUI once per backend, each in a
+# fresh process so imports and threads don't carry over. Reports per
+# backend:
+#
+#   connect         GUI() constructor to the phone's player and transport
+#                   properties both being loaded
+#   reconnect       Device1 connect to both being loaded again
+#   threads         OS threads in the process once connected
+#
+# Usage: python bench_dbus_backend.py [--rounds N] [--backends a,b]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from bench_dashboard import start_private_bus, start_fake_bluez, MAC
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def thread_count():
+    return len(os.listdir("/proc/self/task"))
+
+
+# Runs one backend in this process and returns its measurements.
+def measure(backend_name, rounds):
+    os.chdir(HERE)
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    from dbus_backend import create_backend, ASYNCIO
+    import main as dashboard
+
+    app = QApplication([])
+    backend = create_backend(backend_name)
+    backend.attach(app)
+
+    if backend.name == ASYNCIO:
+        import asyncio
+
+        def pump():
+            backend.loop.run_until_complete(asyncio.sleep(0.0005))
+    else:
+        def pump():
+            app.processEvents()
+            time.sleep(0.0005)
+
+    def wait_until(predicate, timeout=10.0):
+        started = time.perf_counter()
+        while not predicate():
+            pump()
+            if time.perf_counter() - started > timeout:
+                return None
+        return time.perf_counter() - started
+
+    # Blocking calls can't be made on the asyncio backend's loop thread,
+    # so the fake phone is driven from another one.
+    def control(method):
+        thread = threading.Thread(
+            target=lambda: getattr(window.bus.get("org.bluez", "/"),
+                                   method)(MAC))
+        thread.start()
+        wait_until(lambda: not thread.is_alive())
+
+    def loaded():
+        connection = window.connection
+        if connection is None or connection.device_path is None:
+            return False
+        return len(window.dispatcher.state(connection.device_path)) == 2
+
+    started = time.perf_counter()
+    window = dashboard.GUI(backend=backend)
+    wait_until(loaded)
+    result = {'connect': time.perf_counter() - started,
+              'threads': thread_count(), 'reconnect': []}
+
+    for _ in range(rounds):
+        control("Disconnect")
+        wait_until(lambda: window.connection.device_path is None)
+        control("Connect")
+        result['reconnect'].append(wait_until(loaded))
+
+    window.close()
+    return result
+
+
+def ms(seconds):
+    return f"{seconds * 1000:8.2f} ms" if seconds is not None else \
+        "  timed out"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the D-Bus backends against a fake BlueZ.")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--backends", default="pydbus,asyncio")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.rounds)))
+        return
+
+    daemon, address = start_private_bus()
+    os.environ["DBUS_SESSION_BUS_ADDRESS"] = address
+    os.environ["DASHBOARD_BUS"] = "session"
+    # Keep the real state snapshot out of it.
+    os.environ.setdefault("DASHBOARD_STATE", os.path.join(
+        tempfile.mkdtemp(), "state.bin"))
+    fake = start_fake_bluez(0)
+
+    try:
+        for name in args.backends.split(","):
+            child = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", name,
+                 "--rounds", str(args.rounds)],
+                stdout=subprocess.PIPE, text=True)
+            if child.returncode != 0:
+                print(f"{name:<10} failed")
+                continue
+            result = json.loads(child.stdout.splitlines()[-1])
+            reconnect = [s for s in result['reconnect'] if s is not None]
+            print(f"{name:<10} connect {ms(result['connect'])}   "
+                  f"reconnect median "
+                  f"{ms(statistics.median(reconnect) if reconnect else None)}"
+                  f"   threads {result['threads']}")
+    finally:
+        fake.terminate()
+        daemon.terminate()
+        fake.wait()
+        daemon.wait()
+
+
+if __name__ == "__main__":
+    main()
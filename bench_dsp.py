@@ -0,0 +1,140 @@
+# Speed-dependent EQ benchmark.
+#
+# Runs WAV files (16-bit PCM) through SpeedEqualizer offline, block by
+# block as the DSP thread would, with the speed sweeping 0 -> 120 -> 0
+# km/h over each file, on one core with single-threaded BLAS. Without
+# files it generates a minute of music-like test signal. Reports per file:
+#
+#   realtime factor   processing time / audio time; 0.05 means 5% of a
+#                     core
+#   block             time per block: p50, p99 and worst, against the
+#                     block's own duration
+#   clipped           blocks that had to be clipped
+#
+# --output writes the processed audio of the last file, to listen to.
+#
+# Usage: python bench_dsp.py [file.wav ...] [--block N] [--cpu N]
+#                             [--output out.wav]
+
+import os
+
+# Before NumPy is imported: one BLAS thread, as on the car's board.
+for name in ("OPENBLAS_NUM_THREADS", "OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(name, "1")
+
+import argparse
+import math
+import tempfile
+import time
+import wave
+import numpy
+from dsp import SpeedEqualizer, BLOCK, RATE
+
+TOP_SPEED = 120.0
+
+
+# A minute of stereo chords over a kick drum and noise, at 16 bits.
+def generate(path, seconds=60.0, rate=RATE):
+    t = numpy.arange(int(seconds * rate)) / rate
+    signal = numpy.zeros_like(t)
+    for frequency in (110.0, 220.0, 277.2, 329.6, 880.0):
+        signal += 0.08 * numpy.sin(2 * math.pi * frequency * t)
+    beat = t % 0.5
+    signal += 0.3 * numpy.exp(-beat * 30) * numpy.sin(2 * math.pi * 55 * beat)
+    noise = numpy.random.default_rng(1).standard_normal((len(t), 2)) * 0.02
+    stereo = (signal[:, None] + noise) * 32767 * 0.7
+    with wave.open(path, "wb") as out:
+        out.setnchannels(2)
+        out.setsampwidth(2)
+        out.setframerate(rate)
+        out.writeframes(stereo.astype("<i2").tobytes())
+
+
+def read_wav(path):
+    with wave.open(path, "rb") as wav:
+        if wav.getsampwidth() != 2:
+            raise SystemExit(f"{path}: only 16-bit PCM is supported")
+        channels = wav.getnchannels()
+        rate = wav.getframerate()
+        data = wav.readframes(wav.getnframes())
+    return numpy.frombuffer(data, "<i2").reshape(-1, channels), rate
+
+
+def run(samples, rate, block):
+    frames, channels = samples.shape
+    equalizer = SpeedEqualizer(rate, channels, block)
+    padded = numpy.zeros((-(-frames // block) * block, channels), numpy.int16)
+    padded[:frames] = samples
+    output = numpy.empty_like(padded)
+    blocks = len(padded) // block
+    times = numpy.empty(blocks)
+    started = time.perf_counter()
+    for i in range(blocks):
+        equalizer.set_speed(TOP_SPEED * (1 - abs(2 * i / blocks - 1)))
+        block_started = time.perf_counter()
+        equalizer.process(padded[i * block:(i + 1) * block],
+                          output[i * block:(i + 1) * block])
+        times[i] = time.perf_counter() - block_started
+    elapsed = time.perf_counter() - started
+    return output[:frames], elapsed, times, equalizer.clipped_blocks
+
+
+def ms(seconds):
+    return f"{seconds * 1000:6.3f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the speed-dependent EQ on WAV files.")
+    parser.add_argument("files", nargs="*", help="16-bit PCM WAV files")
+    parser.add_argument("--block", type=int, default=BLOCK,
+                        help="frames per block")
+    parser.add_argument("--cpu", type=int, default=0,
+                        help="core to run on")
+    parser.add_argument("--output", help="write the processed audio here")
+    args = parser.parse_args()
+
+    try:
+        os.sched_setaffinity(0, {args.cpu})
+    except (AttributeError, OSError) as e:
+        print(f"Couldn't pin to core {args.cpu}: {e}")
+
+    files = args.files
+    generated = None
+    if not files:
+        handle, generated = tempfile.mkstemp(suffix=".wav")
+        os.close(handle)
+        generate(generated)
+        files = [generated]
+
+    try:
+        for path in files:
+            samples, rate = read_wav(path)
+            audio_time = len(samples) / rate
+            output, elapsed, times, clipped = run(samples, rate, args.block)
+            times.sort()
+            budget = args.block / rate
+            print(f"{os.path.basename(path)}: {audio_time:.1f} s, "
+                  f"{samples.shape[1]} ch, {rate} Hz, "
+                  f"{len(times)} blocks of {args.block} "
+                  f"({ms(budget).strip()} ms)")
+            print(f"  realtime factor {elapsed / audio_time:.4f} "
+                  f"({audio_time / elapsed:.0f}x real time)")
+            print(f"  block p50 {ms(times[len(times) // 2])} "
+                  f"p99 {ms(times[int(len(times) * 0.99)])} "
+                  f"worst {ms(times[-1])} ms "
+                  f"({times[-1] / budget:.1%} of the block)")
+            print(f"  clipped {clipped} blocks")
+            if args.output:
+                with wave.open(args.output, "wb") as out:
+                    out.setnchannels(output.shape[1])
+                    out.setsampwidth(2)
+                    out.setframerate(rate)
+                    out.writeframes(output.astype("<i2").tobytes())
+    finally:
+        if generated:
+            os.remove(generated)
+
+
+if __name__ == "__main__":
+    main()
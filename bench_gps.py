@@ -0,0 +1,108 @@
+# NMEA parsing throughput benchmark.
+#
+# Parses a recorded NMEA log (or a generated one of --hours length at
+# --rate Hz, with RMC, VTG, GGA and GSV sentences per epoch like a typical
+# receiver) through NmeaParser and SpeedFilter, and reports sentences per
+# second.
+#
+# Usage: python bench_gps.py [log.nmea] [--hours H] [--rate HZ]
+
+import argparse
+import functools
+import math
+import operator
+import os
+import tempfile
+import time
+from gps import NmeaParser, SpeedFilter
+
+
+def sentence(body):
+    checksum = functools.reduce(operator.xor, body.encode(), 0)
+    return f"${body}*{checksum:02X}\r\n"
+
+
+def _nmea_angle(value, positive, negative, width):
+    hemisphere = positive if value >= 0 else negative
+    value = abs(value)
+    degrees = int(value)
+    minutes = (value - degrees) * 60
+    return f"{degrees:0{width}d}{minutes:07.4f}", hemisphere
+
+
+# Writes a drive of `hours` hours at `rate` fixes per second and returns
+# the path of the file.
+def generate_log(hours, rate):
+    handle, path = tempfile.mkstemp(suffix=".nmea")
+    latitude, longitude = 51.5, -0.12
+    with os.fdopen(handle, "w") as log:
+        epochs = int(hours * 3600 * rate)
+        for epoch in range(epochs):
+            seconds = epoch / rate
+            # Speed wanders between 0 and 90 km/h.
+            speed_kmh = 45 + 45 * math.sin(seconds / 300)
+            course = (seconds / 10) % 360
+            latitude += speed_kmh / 3600 / rate / 111.0
+            stamp = (f"{int(seconds // 3600) % 24:02d}"
+                     f"{int(seconds // 60) % 60:02d}"
+                     f"{seconds % 60:05.2f}")
+            lat, ns = _nmea_angle(latitude, "N", "S", 2)
+            lon, ew = _nmea_angle(longitude, "E", "W", 3)
+            knots = speed_kmh / 1.852
+            log.write(sentence(
+                f"GPRMC,{stamp},A,{lat},{ns},{lon},{ew},{knots:.2f},"
+                f"{course:.1f},170526,,,A"))
+            log.write(sentence(
+                f"GPVTG,{course:.1f},T,,M,{knots:.2f},N,{speed_kmh:.2f},K,A"))
+            log.write(sentence(
+                f"GPGGA,{stamp},{lat},{ns},{lon},{ew},1,09,0.9,60.0,M,"
+                f"47.0,M,,"))
+            log.write(sentence(
+                "GPGSV,3,1,09,05,42,307,41,13,35,226,38,15,63,095,44,"
+                "18,20,044,35"))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure NMEA parsing throughput.")
+    parser.add_argument("log", nargs="?", help="NMEA log to parse")
+    parser.add_argument("--hours", type=float, default=3.0)
+    parser.add_argument("--rate", type=float, default=10.0)
+    parser.add_argument("--chunk", type=int, default=4096,
+                        help="bytes per read, like a serial port")
+    args = parser.parse_args()
+
+    path = args.log
+    generated = path is None
+    if generated:
+        print(f"Generating {args.hours} h of {args.rate:g} Hz NMEA...")
+        path = generate_log(args.hours, args.rate)
+
+    try:
+        with open(path, "rb") as log:
+            data = log.read()
+
+        nmea = NmeaParser()
+        speed = SpeedFilter()
+        fixes = 0
+        started = time.perf_counter()
+        for offset in range(0, len(data), args.chunk):
+            for fix in nmea.feed(data[offset:offset + args.chunk]):
+                fixes += 1
+                if fix.speed_kmh is not None:
+                    speed.add(fix.speed_kmh)
+        elapsed = time.perf_counter() - started
+    finally:
+        if generated:
+            os.remove(path)
+
+    print(f"{len(data) / 1e6:.1f} MB, {nmea.sentences} sentences "
+          f"({nmea.parsed} decoded, {nmea.checksum_errors} bad), "
+          f"{fixes} fixes")
+    print(f"{elapsed:.2f} s, {nmea.sentences / elapsed:,.0f} sentences/s, "
+          f"{len(data) / elapsed / 1e6:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
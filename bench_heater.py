@@ -0,0 +1,96 @@
+# Heater control loop jitter benchmark.
+#
+# Runs HeaterController against the fake driver while other processes keep
+# every core busy and the "touchscreen" changes settings many times a
+# second. Reports how late the control loop ticks were and how long the
+# touch calls took, which must stay tiny even when the driver is slow.
+#
+# Usage: python bench_heater.py [--seconds S] [--load N] [--write-delay MS]
+
+import argparse
+import multiprocessing
+import os
+import random
+import time
+from heater import (HeaterController, FakeHeaterDriver, FAN_LEVELS,
+                    SEAT_LEVELS, SEAT_LEFT, SEAT_RIGHT)
+
+
+def burn(stop):
+    while not stop.is_set():
+        sum(i * i for i in range(10000))
+
+
+# A fake driver whose writes take a while, like a slow bus.
+class SlowDriver(FakeHeaterDriver):
+    def __init__(self, write_delay):
+        super(SlowDriver, self).__init__()
+        self._write_delay = write_delay
+
+    def write(self, outputs):
+        time.sleep(self._write_delay)
+        super(SlowDriver, self).write(outputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure heater control loop jitter under CPU load.")
+    parser.add_argument("--seconds", type=float, default=20.0)
+    parser.add_argument("--load", type=int, default=os.cpu_count(),
+                        help="number of CPU burning processes")
+    parser.add_argument("--period", type=float, default=0.1,
+                        help="control loop period in seconds")
+    parser.add_argument("--write-delay", type=float, default=0.0,
+                        help="ms each hardware write takes")
+    args = parser.parse_args()
+
+    stop = multiprocessing.Event()
+    burners = [multiprocessing.Process(target=burn, args=(stop,))
+               for _ in range(args.load)]
+    for burner in burners:
+        burner.start()
+
+    driver = SlowDriver(args.write_delay / 1000)
+    controller = HeaterController(driver, period=args.period,
+                                  thermostat_interval=0.5)
+    controller.set_cabin_target(21.0)
+    controller.start()
+
+    touch_times = []
+    try:
+        end = time.monotonic() + args.seconds
+        while time.monotonic() < end:
+            started = time.perf_counter()
+            choice = random.randrange(3)
+            if choice == 0:
+                controller.set_fan_level(random.randrange(FAN_LEVELS))
+            elif choice == 1:
+                controller.set_seat_level(
+                    random.choice((SEAT_LEFT, SEAT_RIGHT)),
+                    random.randrange(SEAT_LEVELS))
+            else:
+                controller.set_cabin_target(random.uniform(16, 24))
+            touch_times.append(time.perf_counter() - started)
+            time.sleep(random.uniform(0.01, 0.2))
+    finally:
+        jitter = controller.jitter_stats()
+        batches = controller.batches_written
+        controller.stop()
+        stop.set()
+        for burner in burners:
+            burner.join()
+
+    touch_times.sort()
+    print(f"load processes     {args.load}")
+    print(f"control ticks      {jitter['ticks']} at {args.period * 1000:.0f}"
+          f" ms, {batches} hardware batches")
+    print(f"tick lateness      p50 {jitter['p50_ms']:.2f} ms   "
+          f"p99 {jitter['p99_ms']:.2f} ms   max {jitter['max_ms']:.2f} ms")
+    print(f"touch call         p50 "
+          f"{touch_times[len(touch_times) // 2] * 1e6:.1f} us   "
+          f"max {touch_times[-1] * 1e6:.1f} us   n={len(touch_times)}")
+    print(f"cabin temperature  {driver.cabin_temperature:.1f} C")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# Map page frame time benchmark.
+#
+# Builds an MBTiles file covering a synthetic drive (tiles drawn and PNG
+# encoded like real raster tiles), then drives the route past a MapWidget
+# on the offscreen Qt platform, --speedup times faster than real time, with
+# and without prefetching. Every fix is painted straight away and timed.
+# Reports per run:
+#
+#   frame           paint time per fix: p50, p99 and worst
+#   events          GUI thread time handling arrived tiles, per fix
+#   blank           share of on-screen tiles that weren't cached yet
+#   loaded          tiles read and decoded by the workers, and how many
+#                   of the tiles asked for weren't in the file
+#
+# Usage: python bench_map.py [--minutes M] [--speed KMH] [--speedup N]
+#                             [--zoom Z]
+
+import argparse
+import math
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import Qt, QBuffer, QByteArray, QIODevice
+from PyQt5.QtGui import QImage, QPainter, QColor, QPen
+from PyQt5.QtWidgets import QApplication
+from maps import (TileLoader, MapWidget, TILE_SIZE, DEFAULT_ZOOM,
+                  tile_position, project)
+
+START = (51.5, -0.12)
+# Fixes per second, like a GPS receiver.
+FIX_RATE = 10
+
+
+# (latitude, longitude, course, speed_kmh) every 1 / FIX_RATE seconds of a
+# winding drive.
+def route(minutes, speed_kmh):
+    latitude, longitude = START
+    course = 40.0
+    for step in range(int(minutes * 60 * FIX_RATE)):
+        course = (course + 6 * math.sin(step / 300) / FIX_RATE) % 360
+        yield latitude, longitude, course, speed_kmh
+        latitude, longitude = project(latitude, longitude, course, speed_kmh,
+                                      1 / FIX_RATE)
+
+
+def draw_tile(zoom, x, y, randomness):
+    image = QImage(TILE_SIZE, TILE_SIZE, QImage.Format_RGB32)
+    image.fill(QColor(242, 239, 233))
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.Antialiasing)
+    for _ in range(12):
+        painter.setPen(QPen(QColor(*randomness.choice(
+            ((255, 255, 255), (250, 200, 120), (170, 210, 160)))),
+            randomness.choice((2, 4, 7))))
+        painter.drawLine(randomness.randrange(TILE_SIZE),
+                         randomness.randrange(TILE_SIZE),
+                         randomness.randrange(TILE_SIZE),
+                         randomness.randrange(TILE_SIZE))
+    painter.setPen(Qt.darkGray)
+    painter.drawText(8, 20, f"{zoom}/{x}/{y}")
+    painter.end()
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    image.save(buffer, "PNG")
+    return bytes(data)
+
+
+# Writes every tile within `margin` tiles of the route and returns the
+# path and the tile count.
+def build_mbtiles(fixes, zoom, margin):
+    handle, path = tempfile.mkstemp(suffix=".mbtiles")
+    os.close(handle)
+    keys = set()
+    for latitude, longitude, _, _ in fixes[::FIX_RATE]:
+        x, y = tile_position(latitude, longitude, zoom)
+        for column in range(int(x) - margin, int(x) + margin + 1):
+            for row in range(int(y) - margin, int(y) + margin + 1):
+                keys.add((column, row))
+    randomness = random.Random(1)
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+    connection.execute(
+        "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, "
+        "tile_row INTEGER, tile_data BLOB)")
+    connection.execute("CREATE UNIQUE INDEX tile_index ON tiles "
+                       "(zoom_level, tile_column, tile_row)")
+    connection.executemany(
+        "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+        ((zoom, x, (1 << zoom) - 1 - y, draw_tile(zoom, x, y, randomness))
+         for x, y in sorted(keys)))
+    connection.executemany("INSERT INTO metadata VALUES (?, ?)",
+                           (("name", "bench"), ("format", "png")))
+    connection.commit()
+    connection.close()
+    return path, len(keys)
+
+
+def drive(app, path, fixes, speedup, prefetch, zoom, width, height):
+    loader = TileLoader(path)
+    widget = MapWidget(loader, zoom)
+    widget.resize(width, height)
+    if not prefetch:
+        widget.prefetch_seconds = 0
+    widget.show()
+    app.processEvents()
+
+    frames = []
+    events = []
+    interval = 1 / FIX_RATE / speedup
+    next_fix = time.perf_counter()
+    for fix in fixes:
+        started = time.perf_counter()
+        app.processEvents()
+        events.append(time.perf_counter() - started)
+        widget.set_position(*fix)
+        started = time.perf_counter()
+        widget.repaint()
+        frames.append(time.perf_counter() - started)
+        next_fix += interval
+        time.sleep(max(0.0, next_fix - time.perf_counter()))
+
+    widget.close()
+    loader.close()
+    return widget, loader, frames, events
+
+
+def ms(seconds):
+    return f"{seconds * 1000:6.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time map frames while driving a synthetic route.")
+    parser.add_argument("--minutes", type=float, default=5.0,
+                        help="length of the drive")
+    parser.add_argument("--speed", type=float, default=90.0,
+                        help="km/h")
+    parser.add_argument("--speedup", type=float, default=5.0,
+                        help="times faster than real time")
+    parser.add_argument("--zoom", type=int, default=DEFAULT_ZOOM)
+    parser.add_argument("--size", default="800x480")
+    args = parser.parse_args()
+    width, height = (int(value) for value in args.size.split("x"))
+
+    app = QApplication([])
+    fixes = list(route(args.minutes, args.speed))
+    print(f"Building tiles along {len(fixes)} fixes...")
+    path, tiles = build_mbtiles(fixes, args.zoom, margin=6)
+    print(f"{tiles} tiles, {os.path.getsize(path) / 1e6:.1f} MB")
+
+    try:
+        for name, prefetch in (("prefetch", True), ("no prefetch", False)):
+            widget, loader, frames, events = drive(
+                app, path, fixes, args.speedup, prefetch, args.zoom, width,
+                height)
+            frames.sort()
+            drawn = widget.hits + widget.misses
+            print(f"{name:<12} frame p50 {ms(statistics.median(frames))} "
+                  f"p99 {ms(frames[int(len(frames) * 0.99)])} "
+                  f"max {ms(frames[-1])} ms   "
+                  f"events {ms(statistics.mean(events))} ms   "
+                  f"blank {widget.misses / drawn:6.2%}   "
+                  f"loaded {loader.loaded} "
+                  f"({len(widget.missing)} not in the file)")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# Replays a D-Bus recording into the dashboard and measures throughput.
+#
+# The recording comes from a drive with DASHBOARD_RECORD=file set, or is
+# generated with --generate N: a phone connected from the start and N
+# media signals at --rate per second, mostly Position updates with track,
+# status and volume changes mixed in, like a phone in a bad mood.
+#
+# The real GUI runs with the offscreen Qt platform on a ReplayBus, so the
+# signals reach on_device_property_changed(), on_player_properties_change()
+# and on_transport_change() the same way they did live. Reports signals
+# per second sustained, how many became UI updates, the dispatch and
+# signal-to-paint latencies and whether the screen ended up showing the
+# last recorded state, i.e. no update was lost.
+#
+# Usage: python bench_replay.py recording [--speed X]
+#        python bench_replay.py storm.rec --generate 100000 --speed 0
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ADDRESS = "AA:BB:CC:DD:EE:01"
+DEVICE = "/org/bluez/hci0/dev_AA_BB_CC_DD_EE_01"
+PLAYER = DEVICE + "/player0"
+TRANSPORT = DEVICE + "/sep1/fd0"
+PROPERTIES = 'org.freedesktop.DBus.Properties'
+
+
+def track(number):
+    return {'Title': f"Track {number}", 'Artist': "Replay",
+            'Album': "Storm", 'Duration': 180000}
+
+
+def generate(path, count, rate):
+    from recorder import Recorder
+
+    if os.path.exists(path):
+        os.remove(path)
+    recorder = Recorder(path)
+    player = {'Name': "Replay", 'Status': "playing", 'Position': 0,
+              'Track': track(0), 'Device': DEVICE}
+    transport = {'Device': DEVICE, 'State': "active", 'Volume': 64}
+    recorder.reply('/', 'GetManagedObjects', (), {
+        DEVICE: {'org.bluez.Device1': {'Address': ADDRESS,
+                                       'Connected': True}},
+        PLAYER: {'org.bluez.MediaPlayer1': player},
+        TRANSPORT: {'org.bluez.MediaTransport1': transport},
+    }, t=0.0)
+    recorder.reply(PLAYER, 'GetAll', ('org.bluez.MediaPlayer1',), player,
+                   t=0.0)
+    recorder.reply(TRANSPORT, 'GetAll', ('org.bluez.MediaTransport1',),
+                   transport, t=0.0)
+
+    rng = random.Random(1)
+    track_number = 0
+    for i in range(count):
+        t = (i + 1) / rate
+        choice = rng.random()
+        if choice < 0.6:
+            recorder.signal(':1.1', PLAYER, PROPERTIES, 'PropertiesChanged',
+                            ['org.bluez.MediaPlayer1', {'Position': i}, []],
+                            t=t)
+        elif choice < 0.8:
+            track_number += 1
+            recorder.signal(':1.1', PLAYER, PROPERTIES, 'PropertiesChanged',
+                            ['org.bluez.MediaPlayer1',
+                             {'Track': track(track_number)}, []], t=t)
+        elif choice < 0.9:
+            status = rng.choice(("playing", "paused"))
+            recorder.signal(':1.1', PLAYER, PROPERTIES, 'PropertiesChanged',
+                            ['org.bluez.MediaPlayer1', {'Status': status},
+                             []], t=t)
+        else:
+            recorder.signal(':1.1', TRANSPORT, PROPERTIES,
+                            'PropertiesChanged',
+                            ['org.bluez.MediaTransport1',
+                             {'Volume': rng.randrange(128)}, []], t=t)
+    recorder.close()
+
+
+def wait_until(app, predicate, timeout=10.0):
+    started = time.perf_counter()
+    while not predicate():
+        app.processEvents()
+        if time.perf_counter() - started > timeout:
+            return False
+        time.sleep(0.0005)
+    return True
+
+
+# The last Track and Status recorded for each player path.
+def final_state(bus):
+    state = {}
+    for _, (_, path, _, member, params) in bus.signals:
+        if member == 'PropertiesChanged' and \
+                params[0] == 'org.bluez.MediaPlayer1':
+            state.setdefault(path, {}).update(params[1])
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a D-Bus recording into the dashboard.")
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 for recorded timing, 0 for as fast as "
+                             "possible")
+    parser.add_argument("--generate", type=int, metavar="N",
+                        help="write a synthetic recording of N signals "
+                             "first")
+    parser.add_argument("--rate", type=float, default=200.0,
+                        help="signals per second when generating")
+    args = parser.parse_args()
+
+    os.chdir(HERE)
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    # Keep the real state snapshot out of it.
+    os.environ.setdefault("DASHBOARD_STATE", os.path.join(
+        tempfile.mkdtemp(), "state.bin"))
+    if args.generate:
+        generate(args.recording, args.generate, args.rate)
+
+    from PyQt5.QtWidgets import QApplication
+    from diagnostics import metrics
+    from recorder import ReplayBus, Replayer
+    import main as dashboard
+
+    bus = ReplayBus(args.recording)
+    app = QApplication([])
+    window = dashboard.GUI(bus=bus)
+    label = window.scrolling_label
+    if not wait_until(app, lambda: window.connection is not None and
+                      window.connection.state == dashboard.READY):
+        print("The recording never got a device to READY")
+    # Let the initial GetAll() results land.
+    wait_until(app, lambda: False, timeout=0.5)
+
+    replayer = Replayer(bus, args.speed)
+    cpu_before = time.process_time()
+    replayer.start()
+    wait_until(app, lambda: not replayer.is_alive(), timeout=3600)
+    # Drain the last frame.
+    wait_until(app, lambda: False, timeout=0.2)
+    cpu = time.process_time() - cpu_before
+
+    stats = window.dispatcher.stats()
+    snapshot = metrics.snapshot()
+    rate = replayer.delivered / replayer.elapsed if replayer.elapsed else 0
+    print(f"{'signals':<22} {replayer.delivered} in "
+          f"{replayer.elapsed:.2f} s, {rate:,.0f}/s sustained")
+    print(f"{'CPU':<22} {cpu:.2f} s "
+          f"({cpu / max(replayer.elapsed, 1e-9) * 100:.0f}% of a core)")
+    print(f"{'dispatcher':<22} {stats['signals_received']} received, "
+          f"{stats['signals_dropped']} redundant, "
+          f"{stats['ui_updates_applied']} UI updates")
+    for name in ("dispatch.signal_to_flush", "signal_to_paint.song_label",
+                 "paint.scrolling_label"):
+        if name in snapshot:
+            values = snapshot[name]
+            print(f"{name:<27} p50 {values['p50_ms']:7.2f} ms   "
+                  f"p99 {values['p99_ms']:7.2f} ms")
+
+    # The screen must show what the phone said last.
+    lost = []
+    for path, expected in final_state(bus).items():
+        if window.bluez_index.device_for(path) != \
+                window.connection.device_path:
+            continue
+        title = expected.get('Track', {}).get('Title')
+        if title and not label.text().startswith(title):
+            lost.append(f"track {title!r}, showing {label.text()!r}")
+        status = expected.get('Status')
+        if status in ("playing", "paused") and \
+                window.trackIsPlaying != (status == "playing"):
+            lost.append(f"status {status}")
+    print(f"{'final state':<22} "
+          f"{'matches' if not lost else 'LOST ' + '; '.join(lost)}")
+
+    window.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# CAN telemetry throughput benchmark.
+#
+# Replays a candump log (or a generated one of --seconds length: OBD-II
+# requests and replies at --poll-rate plus other ECUs' broadcast traffic,
+# --bus-rate frames per second in all) through TelemetryThread at several
+# multiples of real time, with a Qt event loop taking its updates like the
+# GUI would. For each speed it reports frames decoded per second, the CPU
+# the ingestion took (the process's, and the decode step's alone) and what
+# is left of one core for the UI.
+#
+# Usage: python bench_telemetry.py [log] [--seconds S] [--speeds 1,10,0]
+#
+# A speed of 0 replays as fast as possible.
+
+import argparse
+import math
+import os
+import random
+import tempfile
+import time
+from PyQt5.QtCore import QCoreApplication, QTimer
+from telemetry import (TelemetryThread, CandumpReplaySource, POLL_PIDS,
+                       OBD_REQUEST_ID, OBD_RESPONSE_BASE)
+
+
+def reply(pid, seconds):
+    rpm = 1800 + 1200 * math.sin(seconds / 7)
+    values = {
+        0x04: (round(40 + 30 * math.sin(seconds / 5)),),
+        0x05: (round(40 + min(90, seconds / 4)),),
+        0x0C: divmod(round(rpm * 4), 256),
+        0x0D: (round(45 + 45 * math.sin(seconds / 30)),),
+        0x0F: (55,),
+        0x11: (round(30 + 25 * math.sin(seconds / 3)),),
+        0x42: divmod(13800, 256),
+    }[pid]
+    return bytes((2 + len(values), 0x41, pid) + tuple(values)).ljust(8, b"\0")
+
+
+# Writes `seconds` of bus traffic and returns the path of the file.
+def generate_log(seconds, bus_rate, poll_rate):
+    handle, path = tempfile.mkstemp(suffix=".log")
+    randomness = random.Random(1)
+    broadcast_ids = [0x100 + 0x10 * i for i in range(16)]
+    start = 1700000000.0
+    with os.fdopen(handle, "w") as log:
+        frames = int(seconds * bus_rate)
+        poll_every = max(1, round(bus_rate / poll_rate / 2))
+        poll = 0
+        for frame in range(frames):
+            t = frame / bus_rate
+            if frame % poll_every == 0:
+                # Request and reply alternate.
+                pid = POLL_PIDS[(poll // 2) % len(POLL_PIDS)]
+                if poll % 2 == 0:
+                    can_id = OBD_REQUEST_ID
+                    data = bytes((0x02, 0x01, pid)).ljust(8, b"\0")
+                else:
+                    can_id = OBD_RESPONSE_BASE
+                    data = reply(pid, t)
+                poll += 1
+            else:
+                can_id = randomness.choice(broadcast_ids)
+                data = randomness.randbytes(8)
+            log.write(f"({start + t:.6f}) vcan0 {can_id:03X}#"
+                      f"{data.hex().upper()}\n")
+    return path
+
+
+# Replays the log at `speed` for at most `duration` seconds.
+def run(app, path, speed, duration):
+    source = CandumpReplaySource(path, speed)
+    thread = TelemetryThread(source)
+    updates = []
+    thread.valuesChanged.connect(updates.append)
+    thread.finished.connect(app.quit)
+    QTimer.singleShot(round(duration * 1000), thread.stop)
+
+    cpu = time.process_time()
+    started = time.perf_counter()
+    thread.start()
+    app.exec_()
+    thread.wait()
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+    return thread, len(updates), elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure CAN telemetry decoding throughput.")
+    parser.add_argument("log", nargs="?", help="candump -l log to replay")
+    parser.add_argument("--seconds", type=float, default=600.0)
+    parser.add_argument("--bus-rate", type=float, default=2000.0,
+                        help="frames per second on the generated bus")
+    parser.add_argument("--poll-rate", type=float, default=50.0,
+                        help="OBD-II requests per second")
+    parser.add_argument("--speeds", default="1,10,50,0")
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="longest run per speed, in seconds")
+    args = parser.parse_args()
+
+    path = args.log
+    generated = path is None
+    if generated:
+        print(f"Generating {args.seconds:g} s of CAN traffic at "
+              f"{args.bus_rate:g} frames/s...")
+        path = generate_log(args.seconds, args.bus_rate, args.poll_rate)
+
+    app = QCoreApplication([])
+    try:
+        for speed in args.speeds.split(","):
+            speed = float(speed)
+            thread, updates, elapsed, cpu = run(app, path, speed,
+                                                args.duration)
+            decoder = thread.decoder
+            name = "max" if speed == 0 else f"{speed:g}x"
+            print(f"{name:<6} {decoder.frames_decoded / elapsed:>12,.0f} "
+                  f"frames/s  {decoder.samples_decoded:>8} samples  "
+                  f"{updates / elapsed:5.1f} updates/s  "
+                  f"CPU {cpu / elapsed:6.1%} "
+                  f"(decode {thread.decode_time / elapsed:6.1%})  "
+                  f"UI headroom {max(0.0, 1 - cpu / elapsed):6.1%}")
+    finally:
+        if generated:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Trip log benchmark.
+#
+# Writes a year of 1 Hz samples through TripLog (by default two drives a
+# day, --minutes long each, with speed, position, RPM and coolant
+# temperature wandering like a real drive), then times queries on it with
+# TripReader:
+#
+#   append          TripLog.append() per sample, what the GUI thread pays
+#   open            mapping the columns
+#   year            every trip of the year summarised
+#   odometer        total distance
+#   month           trips of the last 30 days
+#   day             trips of one day
+#
+# Usage: python bench_triplog.py [--days N] [--drives N] [--minutes M]
+
+import argparse
+import math
+import os
+import shutil
+import tempfile
+import time
+from triplog import TripLog, TripReader, CHUNK_ROWS
+
+DAY = 86400.0
+
+
+def write_year(directory, days, drives, minutes):
+    trip_log = TripLog(directory, sample_interval=0, flush_interval=3600)
+    start = 1700000000.0
+    latitude, longitude = 51.5, -0.12
+    samples = 0
+    started = time.perf_counter()
+    for day in range(days):
+        for drive in range(drives):
+            departure = start + day * DAY + (8 + 9 * drive) * 3600
+            for second in range(int(minutes * 60)):
+                speed_kmh = max(0.0, 50 + 40 * math.sin(second / 90))
+                latitude += speed_kmh / 3600 / 111.0 * \
+                    math.cos(second / 600)
+                longitude += speed_kmh / 3600 / 69.0 * \
+                    math.sin(second / 600)
+                trip_log.append(latitude, longitude, speed_kmh,
+                                rpm=900 + speed_kmh * 40,
+                                coolant_c=min(90.0, 20 + second / 6),
+                                now=departure + second)
+                samples += 1
+    elapsed = time.perf_counter() - started
+    trip_log.close()
+    return samples, elapsed
+
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time trip log writes and queries over a year of data.")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--drives", type=int, default=2,
+                        help="drives per day")
+    parser.add_argument("--minutes", type=float, default=40.0,
+                        help="length of each drive")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        print(f"Writing {args.days} days of {args.drives} x "
+              f"{args.minutes:g} min drives at 1 Hz...")
+        samples, elapsed = write_year(directory, args.days, args.drives,
+                                      args.minutes)
+        size = sum(os.path.getsize(os.path.join(directory, name))
+                   for name in os.listdir(directory))
+        print(f"{samples:,} samples, {size / 1e6:.1f} MB, "
+              f"{CHUNK_ROWS:,} rows per query chunk")
+        print(f"{'append':<10} {elapsed / samples * 1e6:8.2f} us/sample")
+
+        reader, elapsed = timed(lambda: TripReader(directory))
+        print(f"{'open':<10} {elapsed * 1000:8.2f} ms")
+        trips, elapsed = timed(reader.trips)
+        print(f"{'year':<10} {elapsed * 1000:8.2f} ms  {len(trips)} trips")
+        total, elapsed = timed(reader.odometer)
+        print(f"{'odometer':<10} {elapsed * 1000:8.2f} ms  {total:,.0f} km")
+        end = trips[-1].end + 1
+        month, elapsed = timed(lambda: reader.trips(end - 30 * DAY, end))
+        print(f"{'month':<10} {elapsed * 1000:8.2f} ms  {len(month)} trips")
+        day, elapsed = timed(lambda: reader.trips(end - DAY, end))
+        print(f"{'day':<10} {elapsed * 1000:8.2f} ms  {len(day)} trips")
+        trip = trips[-1]
+        print(f"last trip {trip.distance_km:.1f} km, "
+              f"{trip.drive_time / 60:.0f} min driving, "
+              f"average {trip.average_kmh:.0f} km/h, "
+              f"top {trip.top_kmh:.0f} km/h")
+        reader.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
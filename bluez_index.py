@@ -0,0 +1,388 @@
+# In-process copy of the BlueZ object tree.
+#
+# Every lookup used to call GetManagedObjects() and walk the whole tree,
+# which is a full D-Bus round trip per question. Instead we make a single
+# GetManagedObjects() call at startup and keep the copy current from the
+# ObjectManager InterfacesAdded/InterfacesRemoved signals and from
+# PropertiesChanged (needed for Device1.Connected). Lookups are then plain
+# dict accesses keyed by interface, by normalized MAC address and by owning
+# device.
+#
+# Devices are identified by their full object path, so the same phone seen
+# through two adapters (/org/bluez/hci0/dev_..., /org/bluez/hci1/dev_...)
+# is two devices, each with its own players and transports.
+#
+# Signals arrive on the GLib thread while lookups come from the Qt thread,
+# so all access goes through a lock.
+
+import logging
+import threading
+import time
+from diagnostics import metrics
+
+log = logging.getLogger(__name__)
+
+DEVICE_INTERFACE = 'org.bluez.Device1'
+PLAYER_INTERFACE = 'org.bluez.MediaPlayer1'
+TRANSPORT_INTERFACE = 'org.bluez.MediaTransport1'
+
+# Interfaces we index by MAC address. Anything else is only kept in the
+# per-interface index.
+MAC_INTERFACES = (DEVICE_INTERFACE, PLAYER_INTERFACE, TRANSPORT_INTERFACE)
+
+
+# Accepts any of "dev_XX_XX_XX_XX_XX_XX", "XX:XX:XX:XX:XX:XX", "xx_xx_..."
+# or a full object path and returns "XX:XX:XX:XX:XX:XX". Returns None if no
+# MAC address can be found.
+def normalize_mac(value):
+    if not value:
+        return None
+
+    for part in str(value).split('/'):
+        if part.startswith('dev_'):
+            value = part[4:]
+            break
+
+    mac = value.replace('_', ':').upper()
+    if len(mac) != 17 or mac.count(':') != 5:
+        return None
+    return mac
+
+
+# Returns the Device1 path a player or transport belongs to: its Device
+# property if it has one, otherwise the path up to the dev_ component.
+def owning_device(path, properties=None):
+    device = (properties or {}).get('Device')
+    if device:
+        return str(device)
+
+    parts = str(path).split('/')
+    for i, part in enumerate(parts):
+        if part.startswith('dev_'):
+            return '/'.join(parts[:i + 1])
+    return None
+
+
+class BluezObjectIndex:
+    def __init__(self, bus_object):
+        self._bus = bus_object
+        self._lock = threading.Lock()
+
+        # path -> {interface: {property: value}}
+        self._objects = {}
+        # interface -> {path: None}. Dicts are used as ordered sets so
+        # that the most recently added path is the last one.
+        self._by_interface = {}
+        # MAC -> {interface: {path: None}}
+        self._by_mac = {}
+        # device path -> {interface: {path: None}} for the MAC_INTERFACES
+        # objects a device owns, including the device itself.
+        self._by_device = {}
+        # object path -> owning device path
+        self._owners = {}
+        # Device1 paths with Connected == True, in the order they connected.
+        self._connected = {}
+
+        self._subscriptions = []
+        self._listeners = []
+
+        bluez_service = self._bus.get('org.bluez', '/')
+
+        # Subscribe before the initial scan so nothing that appears between
+        # the two is lost. Applying an InterfacesAdded for something that is
+        # already indexed is harmless.
+        self._subscriptions.append(
+            bluez_service.InterfacesAdded.connect(self._on_interfaces_added))
+        self._subscriptions.append(
+            bluez_service.InterfacesRemoved.connect(
+                self._on_interfaces_removed))
+        self._subscriptions.append(
+            self._bus.subscribe(
+                sender='org.bluez',
+                iface='org.freedesktop.DBus.Properties',
+                signal='PropertiesChanged',
+                signal_fired=self._on_properties_changed))
+
+        self.refresh(bluez_service)
+
+    # Rebuilds the whole index from a single GetManagedObjects() call.
+    def refresh(self, bluez_service=None):
+        if bluez_service is None:
+            bluez_service = self._bus.get('org.bluez', '/')
+        with metrics.span("dbus.GetManagedObjects"):
+            managed_objects = bluez_service.GetManagedObjects()
+
+        with self._lock:
+            self._objects.clear()
+            self._by_interface.clear()
+            self._by_mac.clear()
+            self._by_device.clear()
+            self._owners.clear()
+            self._connected.clear()
+            for path, interfaces in managed_objects.items():
+                self._add(path, interfaces)
+
+        log.info("BlueZ object index built with %d objects.",
+                 len(managed_objects))
+
+    # Listeners are called as listener(event, path, interfaces) after the
+    # index has been updated. event is "added" or "removed" (interfaces as
+    # in InterfacesAdded/InterfacesRemoved) or "changed" (interfaces is
+    # {interface: changed properties}). They run on whichever thread
+    # delivered the D-Bus signal, without the index lock held, so they may
+    # add or remove listeners.
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def close(self):
+        for subscription in self._subscriptions:
+            try:
+                subscription.disconnect()
+            except Exception as e:
+                log.warning("Failed to disconnect index subscription: %s", e)
+        self._subscriptions = []
+        with self._lock:
+            self._listeners = []
+
+    # ---------- Lookups ----------
+
+    # Returns the object path of the most recently connected device, or
+    # None if nothing is connected.
+    def connected_device_path(self):
+        with self._lock:
+            if not self._connected:
+                return None
+            return next(reversed(self._connected))
+
+    def connected_device_paths(self):
+        with self._lock:
+            return list(self._connected)
+
+    # device may be a Device1 object path, which picks that device on that
+    # adapter, or a MAC address in any of the forms normalize_mac()
+    # accepts, which picks the most recent match on any adapter.
+    def device_path(self, device):
+        return self.interface_path(device, DEVICE_INTERFACE)
+
+    def player_path(self, device):
+        return self.interface_path(device, PLAYER_INTERFACE)
+
+    def transport_path(self, device):
+        return self.interface_path(device, TRANSPORT_INTERFACE)
+
+    # The most recent object with `interface` that belongs to `device`
+    # (see device_path()), or None.
+    def interface_path(self, device, interface):
+        with self._lock:
+            if str(device).startswith('/'):
+                paths = self._by_device.get(str(device), {}).get(interface)
+            else:
+                paths = self._by_mac.get(normalize_mac(device), {}).get(
+                    interface)
+            if not paths:
+                return None
+            return next(reversed(paths))
+
+    # Returns the device path an indexed object belongs to, or None.
+    def device_for(self, path):
+        with self._lock:
+            return self._owners.get(path)
+
+    def paths_with_interface(self, interface):
+        with self._lock:
+            return list(self._by_interface.get(interface, ()))
+
+    # Returns a copy of the cached properties of one interface on one
+    # object, or None if the object does not have that interface.
+    def properties(self, path, interface):
+        with self._lock:
+            properties = self._objects.get(path, {}).get(interface)
+            return dict(properties) if properties is not None else None
+
+    # ---------- Index maintenance (lock must be held) ----------
+
+    def _add(self, path, interfaces):
+        known = self._objects.setdefault(path, {})
+        mac = normalize_mac(path)
+
+        for interface, properties in interfaces.items():
+            known.setdefault(interface, {}).update(properties)
+            self._by_interface.setdefault(interface, {})[path] = None
+
+            if mac and interface in MAC_INTERFACES:
+                self._by_mac.setdefault(mac, {}).setdefault(
+                    interface, {})[path] = None
+
+            if interface in MAC_INTERFACES:
+                owner = (path if interface == DEVICE_INTERFACE
+                         else owning_device(path, known[interface]))
+                if owner:
+                    self._owners[path] = owner
+                    self._by_device.setdefault(owner, {}).setdefault(
+                        interface, {})[path] = None
+
+            if interface == DEVICE_INTERFACE:
+                self._update_connected(path, known[interface])
+
+    def _remove(self, path, interfaces):
+        known = self._objects.get(path)
+        if known is None:
+            return
+        mac = normalize_mac(path)
+
+        for interface in interfaces:
+            known.pop(interface, None)
+            self._by_interface.get(interface, {}).pop(path, None)
+
+            if mac and interface in MAC_INTERFACES:
+                by_interface = self._by_mac.get(mac, {})
+                by_interface.get(interface, {}).pop(path, None)
+                if not by_interface.get(interface):
+                    by_interface.pop(interface, None)
+                if not by_interface:
+                    self._by_mac.pop(mac, None)
+
+            owner = self._owners.get(path)
+            if owner and interface in MAC_INTERFACES:
+                by_interface = self._by_device.get(owner, {})
+                by_interface.get(interface, {}).pop(path, None)
+                if not by_interface.get(interface):
+                    by_interface.pop(interface, None)
+                if not by_interface:
+                    self._by_device.pop(owner, None)
+
+            if interface == DEVICE_INTERFACE:
+                self._connected.pop(path, None)
+
+        if not known:
+            del self._objects[path]
+            self._owners.pop(path, None)
+
+    def _update_connected(self, path, device_properties):
+        if device_properties.get('Connected'):
+            # Re-inserting moves the device to the "most recent" end.
+            self._connected.pop(path, None)
+            self._connected[path] = None
+        else:
+            self._connected.pop(path, None)
+
+    # ---------- Signal handlers (GLib thread) ----------
+
+    def _on_interfaces_added(self, path, interfaces):
+        with self._lock:
+            self._add(path, interfaces)
+        self._notify("added", path, interfaces)
+
+    def _on_interfaces_removed(self, path, interfaces):
+        with self._lock:
+            self._remove(path, interfaces)
+        self._notify("removed", path, interfaces)
+
+    def _on_properties_changed(self, sender, path, iface, signal, params):
+        interface, changed, invalidated = params
+
+        with self._lock:
+            properties = self._objects.get(path, {}).get(interface)
+            if properties is None:
+                return
+            properties.update(changed)
+            for name in invalidated:
+                properties.pop(name, None)
+
+            if interface == DEVICE_INTERFACE and 'Connected' in changed:
+                self._update_connected(path, properties)
+
+        self._notify("changed", path, {interface: changed})
+
+    def _notify(self, event, path, interfaces):
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(event, path, interfaces)
+            except Exception:
+                log.exception("An error occurred in an index listener")
+
+
+# Waits for a set of interfaces to exist for one device, without blocking.
+#
+# Replaces a fixed sleep before touching MediaPlayer1/MediaTransport1: the
+# callback fires as soon as InterfacesAdded has delivered every wanted
+# interface (or straight away if they are already indexed). If they have
+# not all appeared within `timeout` seconds the callback fires anyway so
+# the caller can fall back to whatever is available.
+#
+# callback(ready, waited, paths) is called exactly once, where ready is
+# True if every interface appeared, waited is the measured wait in seconds
+# and paths maps interface -> object path (None if missing). It runs on the
+# GLib thread, the timer thread or the calling thread.
+class InterfaceWaiter:
+    def __init__(self, index, device_path, interfaces, callback,
+                 timeout=5.0):
+        self._index = index
+        self._device_path = device_path
+        self._interfaces = tuple(interfaces)
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._done = False
+        self._started = time.monotonic()
+
+        self._timer = threading.Timer(timeout, self._on_timeout)
+        self._timer.daemon = True
+
+        index.add_listener(self._on_index_event)
+        self._timer.start()
+        # The interfaces may already be there, in which case we finish now.
+        self._check()
+
+    @property
+    def device_path(self):
+        return self._device_path
+
+    def cancel(self):
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+        self._cleanup()
+
+    def _paths(self):
+        return {interface: self._index.interface_path(self._device_path,
+                                                      interface)
+                for interface in self._interfaces}
+
+    def _check(self):
+        paths = self._paths()
+        if all(paths.values()):
+            self._finish(True, paths)
+
+    def _on_index_event(self, event, path, interfaces):
+        if event == "added" and \
+                self._index.device_for(path) == self._device_path:
+            self._check()
+
+    def _on_timeout(self):
+        self._finish(False, self._paths())
+
+    def _finish(self, ready, paths):
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+        self._cleanup()
+
+        waited = time.monotonic() - self._started
+        try:
+            self._callback(ready, waited, paths)
+        except Exception:
+            log.exception("An error occurred in an interface wait callback")
+
+    def _cleanup(self):
+        self._timer.cancel()
+        self._index.remove_listener(self._on_index_event)
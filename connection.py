@@ -0,0 +1,278 @@
+# Connection state machine.
+#
+# Every connected phone gets a DeviceSession, keyed by its Device1 object
+# path (so hci0 and hci1 are kept apart), that goes through
+#
+#   DISCONNECTED -> DISCOVERING -> READY -> TEARING_DOWN -> DISCONNECTED
+#
+# on its own. One ConnectionManager owns the sessions: the wait for each
+# phone's media objects and the media worker's player and transport
+# subscriptions for it. Device connects and disconnects reach it from the
+# BlueZ object index, which has its own single set of signal subscriptions,
+# so however often phones connect and disconnect there is never more than
+# one listener of each kind.
+#
+# Of the sessions, one is active: the one the screen shows and the buttons
+# control. The active device is the one that most recently started playing
+# or, when none has, the one that connected last, with a device that is
+# playing right now preferred over one that is not. Switching between
+# sessions that are already READY needs no D-Bus traffic at all.
+#
+# Every connection attempt gets a new generation number. A slow attempt
+# that is overtaken by a disconnect or a reconnect finds its generation out
+# of date when it completes and does nothing.
+#
+# Events arrive on the GLib thread, the waiter's timer thread and the Qt
+# thread, so the state is guarded by a lock. The GUI hears about changes
+# through Qt signals, which Qt delivers on its own thread.
+
+import collections
+import logging
+import threading
+import time
+from functools import partial
+from PyQt5.QtCore import QObject
+from PyQt5.QtCore import pyqtSignal
+from diagnostics import metrics
+from bluez_index import (InterfaceWaiter, PLAYER_INTERFACE,
+                         TRANSPORT_INTERFACE)
+
+DISCONNECTED = "disconnected"
+DISCOVERING = "discovering"
+READY = "ready"
+TEARING_DOWN = "tearing_down"
+
+log = logging.getLogger(__name__)
+
+# Samples kept per transition for the metrics.
+METRIC_SAMPLES = 100
+
+
+class DeviceSession:
+    def __init__(self, device_path, generation):
+        self.device_path = device_path
+        self.generation = generation
+        self.state = DISCONNECTED
+        self.state_entered = time.monotonic()
+        self.connected_at = self.state_entered
+        self.waiter = None
+        # Whether the phone reports playing, and since when.
+        self.playing = False
+        self.playing_since = None
+
+    # Sort key for choosing the active device.
+    def priority(self):
+        return (self.playing,
+                max(self.connected_at, self.playing_since or 0.0))
+
+
+class ConnectionManager(QObject):
+    # state, device path, for every session
+    stateChanged = pyqtSignal(str, object)
+    # the new active device path, None when nothing is connected
+    activeDeviceChanged = pyqtSignal(object)
+
+    def __init__(self, index, media_worker, media_ready_timeout=5.0,
+                 parent=None):
+        super(ConnectionManager, self).__init__(parent)
+        self._index = index
+        self._media_worker = media_worker
+        self.media_ready_timeout = media_ready_timeout
+
+        self._lock = threading.RLock()
+        # device path -> DeviceSession
+        self._sessions = {}
+        self._active = None
+        self._generation = 0
+
+        # "from->to" -> recent durations of the "from" state, in seconds.
+        self._transitions = collections.defaultdict(
+            partial(collections.deque, maxlen=METRIC_SAMPLES))
+        # Measured wait for the media interfaces of the last connection.
+        self.media_ready_wait_time = None
+
+    # State of the active device.
+    @property
+    def state(self):
+        with self._lock:
+            session = self._sessions.get(self._active)
+            return session.state if session else DISCONNECTED
+
+    # Object path of the active device, None if nothing is connected.
+    @property
+    def device_path(self):
+        return self._active
+
+    def device_paths(self):
+        with self._lock:
+            return list(self._sessions)
+
+    def session_state(self, device_path):
+        with self._lock:
+            session = self._sessions.get(device_path)
+            return session.state if session else DISCONNECTED
+
+    # Picks up devices that were already connected before we started, on
+    # every adapter.
+    def start(self):
+        device_paths = self._index.connected_device_paths()
+        if not device_paths:
+            log.info("No connected Bluetooth device found at start up.")
+            self.stateChanged.emit(DISCONNECTED, None)
+            self.activeDeviceChanged.emit(None)
+        for device_path in device_paths:
+            self.device_connected(device_path)
+
+    def device_connected(self, device_path):
+        with self._lock:
+            if device_path in self._sessions:
+                # Several signals can report the same connection.
+                return
+
+            log.info("A Bluetooth device has connected: %s", device_path)
+            self._generation += 1
+            session = DeviceSession(device_path, self._generation)
+            self._sessions[device_path] = session
+            self._enter(session, DISCOVERING)
+            self._choose_active()
+
+            # Wait for BlueZ to announce the device's MediaPlayer1 and
+            # MediaTransport1 rather than for a fixed time.
+            waiter = InterfaceWaiter(
+                self._index, device_path,
+                (PLAYER_INTERFACE, TRANSPORT_INTERFACE),
+                partial(self._media_ready, device_path, session.generation),
+                timeout=self.media_ready_timeout)
+            # The waiter finishes straight away if everything is there.
+            if session.state == DISCOVERING:
+                session.waiter = waiter
+
+    def device_disconnected(self, device_path):
+        with self._lock:
+            session = self._sessions.get(device_path)
+            if session is None:
+                return
+            log.info("A Bluetooth device has disconnected: %s",
+                     device_path)
+            self._tear_down(session)
+            # Another phone may still be connected; it already has its
+            # session.
+            self._choose_active()
+
+    # Called from any thread whenever a phone's player Status or
+    # transport State says whether it is playing.
+    def playback_changed(self, device_path, playing):
+        with self._lock:
+            session = self._sessions.get(device_path)
+            if session is None or session.playing == playing:
+                return
+            session.playing = playing
+            if playing:
+                session.playing_since = time.monotonic()
+            self._choose_active()
+
+    # Makes a device active by hand, e.g. from a device picker.
+    def activate(self, device_path):
+        with self._lock:
+            session = self._sessions.get(device_path)
+            if session is None:
+                return
+            session.playing_since = time.monotonic()
+            self._choose_active()
+
+    # Transition timings: {"from->to": {count, mean_ms, max_ms}}.
+    def transition_stats(self):
+        with self._lock:
+            stats = {}
+            for name, samples in self._transitions.items():
+                if samples:
+                    stats[name] = {
+                        'count': len(samples),
+                        'mean_ms': sum(samples) / len(samples) * 1000,
+                        'max_ms': max(samples) * 1000,
+                    }
+            return stats
+
+    # Called once the media interfaces exist, or after media_ready_timeout
+    # without them, in which case we fall back to re-reading the object
+    # tree in case a signal was missed and carry on with what is there.
+    def _media_ready(self, device_path, generation, ready, waited, paths):
+        with self._lock:
+            if not self._current(device_path, generation):
+                return  # Superseded
+            self._sessions[device_path].waiter = None
+            self.media_ready_wait_time = waited
+
+        if ready:
+            log.info("Media interfaces ready after %.3fs", waited)
+        else:
+            log.warning("Media interfaces not ready after %.3fs, "
+                        "falling back to a full object scan", waited)
+            # A GetManagedObjects round trip; not under the lock, so that
+            # connects, disconnects and playback changes aren't held up.
+            self._index.refresh()
+            paths = {
+                PLAYER_INTERFACE: self._index.player_path(device_path),
+                TRANSPORT_INTERFACE:
+                    self._index.transport_path(device_path),
+            }
+
+        with self._lock:
+            # The device may have gone or come back during the refresh.
+            if not self._current(device_path, generation):
+                return
+            session = self._sessions[device_path]
+
+            log.info("Device player path: %s", paths[PLAYER_INTERFACE])
+            log.info("Device transport path: %s",
+                     paths[TRANSPORT_INTERFACE])
+
+            # The worker connects to both, subscribes to their
+            # PropertiesChanged signals and reports the initial properties.
+            self._media_worker.attach(device_path, paths[PLAYER_INTERFACE],
+                                      paths[TRANSPORT_INTERFACE])
+            self._enter(session, READY)
+
+    # Whether the session for device_path is still the one that started
+    # discovering at `generation`. Lock must be held.
+    def _current(self, device_path, generation):
+        session = self._sessions.get(device_path)
+        return session is not None and session.generation == generation \
+            and session.state == DISCOVERING
+
+    # Lock must be held.
+    def _choose_active(self):
+        if self._sessions:
+            active = max(self._sessions.values(),
+                         key=DeviceSession.priority).device_path
+        else:
+            active = None
+        if active == self._active:
+            return
+
+        log.info("Active Bluetooth device: %s", active)
+        self._active = active
+        if active is not None:
+            self._media_worker.activate(active)
+        self.activeDeviceChanged.emit(active)
+
+    # Lock must be held.
+    def _tear_down(self, session):
+        self._enter(session, TEARING_DOWN)
+        if session.waiter is not None:
+            session.waiter.cancel()
+            session.waiter = None
+        self._media_worker.detach(session.device_path)
+        del self._sessions[session.device_path]
+        self._enter(session, DISCONNECTED)
+
+    # Lock must be held.
+    def _enter(self, session, state):
+        now = time.monotonic()
+        transition = f"{session.state}->{state}"
+        self._transitions[transition].append(now - session.state_entered)
+        metrics.record(f"connection.{transition}",
+                       now - session.state_entered)
+        session.state = state
+        session.state_entered = now
+        self.stateChanged.emit(state, session.device_path)
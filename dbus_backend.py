@@ -0,0 +1,496 @@
+# D-Bus backends.
+#
+# Everything that talks to BlueZ does it through a pydbus-shaped bus:
+# bus.get(service, path) proxies with method calls, property access and
+# proxy.Signal.connect(), plus bus.subscribe(). A backend provides one:
+#
+#   pydbus   pydbus with a GLib main loop on its own thread (GLibThread).
+#            Signal callbacks run on that thread. The default.
+#   asyncio  dbus-next on an asyncio event loop that is the Qt event loop,
+#            through qasync. There is one loop, signal callbacks run on the
+#            GUI thread and every call is a coroutine on that loop. Worker
+#            threads keep their blocking calls by waiting on those
+#            coroutines, and get_all() sends several GetAll() calls at once
+#            so a phone's player and transport are read in parallel.
+#
+# The asyncio backend is not fully asynchronous. Apart from get_all(), a
+# call from a worker thread (media commands, subscriptions, property reads)
+# blocks that thread until the reply arrives, just as it does with pydbus.
+# The code above the bus is unchanged. On connect, the player and
+# transport GetAll() calls are the only D-Bus reads; Device1 comes from
+# the BlueZ index. Album art (artwork.py) still goes through pydbus on the
+# session bus.
+#
+# asyncio, concurrent.futures, dbus-next and qasync are only imported by
+# the asyncio backend's code, so starting on pydbus doesn't load them.
+#
+# DASHBOARD_DBUS_BACKEND picks one. bench_dbus_backend.py compares their
+# connect latency and thread count.
+
+import collections
+import logging
+import os
+import threading
+import time
+from PyQt5.QtCore import QThread
+from diagnostics import metrics
+
+log = logging.getLogger(__name__)
+
+PYDBUS = "pydbus"
+ASYNCIO = "asyncio"
+
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+OBJECT_MANAGER_INTERFACE = 'org.freedesktop.DBus.ObjectManager'
+
+# Standard members every BlueZ object has, so using them needs no
+# Introspect() call: name -> (interface, input signature).
+STANDARD_METHODS = {
+    'Get': (PROPERTIES_INTERFACE, 'ss'),
+    'GetAll': (PROPERTIES_INTERFACE, 's'),
+    'Set': (PROPERTIES_INTERFACE, 'ssv'),
+    'GetManagedObjects': (OBJECT_MANAGER_INTERFACE, ''),
+}
+STANDARD_SIGNALS = {
+    'PropertiesChanged': PROPERTIES_INTERFACE,
+    'InterfacesAdded': OBJECT_MANAGER_INTERFACE,
+    'InterfacesRemoved': OBJECT_MANAGER_INTERFACE,
+}
+
+# Seconds a worker thread waits for a call on the asyncio backend.
+CALL_TIMEOUT = 25.0
+
+
+# Calls GetAll() on each (proxy, interface) and returns the results in the
+# same order, with an exception in place of any that failed. Proxies that
+# can (the asyncio backend's) are all called at once; others one after
+# another. Must not be called on the asyncio backend's loop thread.
+def get_all(requests):
+    started = time.perf_counter()
+    pending = []
+    for proxy, interface in requests:
+        name = f"dbus.{interface.rsplit('.', 1)[-1]}.GetAll"
+        try:
+            start = getattr(proxy.GetAll, 'future', None)
+            if start is None:
+                with metrics.span(name):
+                    pending.append((None, proxy.GetAll(interface)))
+                continue
+            future = start(interface)
+            future.add_done_callback(
+                lambda _, name=name: metrics.record(
+                    name, time.perf_counter() - started))
+            pending.append((future, None))
+        except Exception as e:
+            pending.append((None, e))
+
+    results = []
+    for future, result in pending:
+        if future is not None:
+            try:
+                result = future.result(CALL_TIMEOUT)
+            except Exception as e:
+                result = e
+        results.append(result)
+    return results
+
+
+# Waits for a concurrent.futures.Future from a coroutine on the loop, giving
+# up early once closed is set.
+def _wait(future, closed):
+    import concurrent.futures
+    deadline = time.monotonic() + CALL_TIMEOUT
+    while True:
+        try:
+            return future.result(0.1)
+        except concurrent.futures.TimeoutError:
+            if closed.is_set():
+                raise ConnectionError("D-Bus connection closed")
+            if time.monotonic() > deadline:
+                raise
+
+
+# ---------- pydbus ----------
+
+class GLibThread(QThread):
+    def run(self):
+        from gi.repository import GLib
+        self.loop = GLib.MainLoop()
+        self.loop.run()
+
+
+class PydbusBackend:
+    name = PYDBUS
+
+    def __init__(self):
+        self._glib_thread = None
+
+    def attach(self, app):
+        pass
+
+    def exec(self, app):
+        return app.exec_()
+
+    # Called off the GUI thread.
+    def connect(self, session=False):
+        from pydbus import SessionBus, SystemBus
+        return SessionBus() if session else SystemBus()
+
+    # Starts delivering signals.
+    def start(self):
+        self._glib_thread = GLibThread()
+        self._glib_thread.start()
+
+    def stop(self):
+        thread = self._glib_thread
+        if thread is not None and getattr(thread, 'loop', None) is not None:
+            thread.loop.quit()
+            thread.wait()
+
+
+# ---------- asyncio ----------
+
+# Turns dbus-next Variants back into plain values, as pydbus returns them.
+def unwrap(value):
+    from dbus_next import Variant
+    if isinstance(value, Variant):
+        return unwrap(value.value)
+    if isinstance(value, dict):
+        return {key: unwrap(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [unwrap(item) for item in value]
+    return value
+
+
+def match_rule(sender, iface, signal, path, arg0):
+    rule = ["type='signal'"]
+    for key, value in (('sender', sender), ('interface', iface),
+                       ('member', signal), ('path', path), ('arg0', arg0)):
+        if value is not None:
+            rule.append(f"{key}='{value}'")
+    return ",".join(rule)
+
+
+class AsyncSubscription:
+    def __init__(self, bus, entry, rule):
+        self._bus = bus
+        self._entry = entry
+        self._rule = rule
+
+    def disconnect(self):
+        if self._bus.closed:
+            return
+        self._bus._schedule(self._bus._remove_subscription(self._entry,
+                                                           self._rule))
+
+
+class AsyncSignal:
+    def __init__(self, bus, service, path, interface, name):
+        self._bus = bus
+        self._service = service
+        self._path = path
+        self._interface = interface
+        self._name = name
+
+    def connect(self, callback):
+        return self._bus.subscribe(
+            sender=self._service, iface=self._interface, signal=self._name,
+            object=self._path,
+            signal_fired=lambda sender, path, iface, member, params:
+                callback(*params))
+
+
+class AsyncMethod:
+    def __init__(self, bus, service, path, interface, name, signature):
+        self._bus = bus
+        self._service = service
+        self._path = path
+        self._interface = interface
+        self._name = name
+        self._signature = signature
+
+    # Blocks a worker thread until the reply comes, like pydbus.
+    def __call__(self, *args):
+        return self._bus.wait(self.coroutine(*args))
+
+    def coroutine(self, *args):
+        return self._bus.call(self._service, self._path, self._interface,
+                              self._name, self._signature, args)
+
+    # Starts the call from a worker thread and returns a
+    # concurrent.futures.Future for the reply.
+    def future(self, *args):
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(self.coroutine(*args),
+                                                self._bus.loop)
+
+
+class AsyncProxy:
+    def __init__(self, bus, service, path, interface=None):
+        object.__setattr__(self, '_bus', bus)
+        object.__setattr__(self, '_service', service)
+        object.__setattr__(self, '_path', path)
+        object.__setattr__(self, '_interface', interface)
+
+    def __getitem__(self, interface):
+        return AsyncProxy(self._bus, self._service, self._path, interface)
+
+    def __getattr__(self, name):
+        if name in STANDARD_SIGNALS:
+            return AsyncSignal(self._bus, self._service, self._path,
+                               STANDARD_SIGNALS[name], name)
+        if name in STANDARD_METHODS:
+            interface, signature = STANDARD_METHODS[name]
+            return AsyncMethod(self._bus, self._service, self._path,
+                               interface, name, signature)
+
+        interface, kind, signature = self._bus.wait(self._bus.member(
+            self._service, self._path, self._interface, name))
+        if kind == 'method':
+            return AsyncMethod(self._bus, self._service, self._path,
+                               interface, name, signature)
+        if kind == 'signal':
+            return AsyncSignal(self._bus, self._service, self._path,
+                               interface, name)
+        return self._bus.wait(self._bus.get_property(
+            self._service, self._path, interface, name))
+
+    def __setattr__(self, name, value):
+        interface, kind, _ = self._bus.wait(self._bus.member(
+            self._service, self._path, self._interface, name))
+        if kind != 'property':
+            raise AttributeError(f"{name} is not a property")
+        self._bus.wait(self._bus.set_property(
+            self._service, self._path, interface, name, value))
+
+
+# A dbus-next MessageBus behind the pydbus interface. Its coroutines
+# (call(), get_property(), set_property()) can also be awaited directly on
+# the loop.
+class AsyncBus:
+    def __init__(self, loop, loop_thread, message_bus):
+        self.loop = loop
+        self._bus = message_bus
+        self._loop_thread = loop_thread
+        # [((iface, signal, path, arg0), signal_fired)], loop thread only
+        self._subscriptions = []
+        # Match rules added to the bus daemon, with how many use each.
+        self._rules = collections.Counter()
+        # (service, path, interface) -> {member: (interface, kind, sig)}
+        self._members = {}
+        # (service, path, interface, property) -> signature, from Get()
+        self._signatures = {}
+        # Set by close(); stops worker threads waiting on a loop that may
+        # be blocked waiting for them.
+        self._closed = threading.Event()
+        message_bus.add_message_handler(self._on_message)
+
+    def get(self, service, path=None):
+        return AsyncProxy(self, service, path or '/')
+
+    def subscribe(self, sender=None, iface=None, signal=None, object=None,
+                  arg0=None, flags=0, signal_fired=None):
+        entry = ((iface, signal, object, arg0), signal_fired)
+        rule = match_rule(sender, iface, signal, object, arg0)
+        if self._on_loop_thread():
+            # Can't wait here; the rule is added in the background.
+            self._subscriptions.append(entry)
+            self._schedule(self._add_rule(rule))
+        else:
+            self.wait(self._add_subscription(entry, rule))
+        return AsyncSubscription(self, entry, rule)
+
+    # Waits on a coroutine from a worker thread.
+    def wait(self, coroutine):
+        import asyncio
+        if self._on_loop_thread():
+            coroutine.close()
+            raise RuntimeError("Blocking D-Bus call on the event loop "
+                               "thread; await the coroutine instead")
+        return _wait(asyncio.run_coroutine_threadsafe(coroutine, self.loop),
+                     self._closed)
+
+    async def call(self, service, path, interface, member, signature='',
+                   args=()):
+        from dbus_next import Message, MessageType
+        from dbus_next.errors import DBusError
+        reply = await self._bus.call(Message(
+            destination=service, path=path, interface=interface,
+            member=member, signature=signature, body=list(args)))
+        if reply.message_type == MessageType.ERROR:
+            raise DBusError(reply.error_name,
+                            reply.body[0] if reply.body else "")
+        if member == 'Get':
+            # Set() needs to know the type.
+            self._signatures[(service, path) + tuple(args)] = \
+                reply.body[0].signature
+        body = unwrap(reply.body)
+        if not body:
+            return None
+        return body[0] if len(body) == 1 else tuple(body)
+
+    async def get_property(self, service, path, interface, name):
+        return await self.call(service, path, PROPERTIES_INTERFACE, 'Get',
+                               'ss', (interface, name))
+
+    async def set_property(self, service, path, interface, name, value):
+        from dbus_next import Variant
+        key = (service, path, interface, name)
+        if key not in self._signatures:
+            await self.get_property(service, path, interface, name)
+        await self.call(service, path, PROPERTIES_INTERFACE, 'Set', 'ssv',
+                        (interface, name,
+                         Variant(self._signatures[key], value)))
+
+    # Finds what a member is by introspecting the object, once per object.
+    async def member(self, service, path, interface, name):
+        key = (service, path, interface)
+        members = self._members.get(key)
+        if members is None:
+            members = {}
+            node = await self._bus.introspect(service, path)
+            for node_interface in node.interfaces:
+                if interface is not None and node_interface.name != interface:
+                    continue
+                for method in node_interface.methods:
+                    members[method.name] = (node_interface.name, 'method',
+                                            method.in_signature)
+                for prop in node_interface.properties:
+                    members[prop.name] = (node_interface.name, 'property',
+                                          prop.signature)
+                for signal in node_interface.signals:
+                    members[signal.name] = (node_interface.name, 'signal',
+                                            None)
+            self._members[key] = members
+        if name not in members:
+            raise AttributeError(f"{path} has no member {name}")
+        return members[name]
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    def close(self):
+        self._closed.set()
+        self._bus.disconnect()
+
+    def _on_loop_thread(self):
+        return threading.current_thread() is self._loop_thread
+
+    def _schedule(self, coroutine):
+        if self._on_loop_thread():
+            self.loop.create_task(coroutine)
+        else:
+            import asyncio
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def _add_subscription(self, entry, rule):
+        self._subscriptions.append(entry)
+        await self._add_rule(rule)
+
+    async def _add_rule(self, rule):
+        self._rules[rule] += 1
+        if self._rules[rule] == 1:
+            await self._bus_daemon('AddMatch', rule)
+
+    async def _remove_subscription(self, entry, rule):
+        if entry not in self._subscriptions:
+            return
+        self._subscriptions.remove(entry)
+        self._rules[rule] -= 1
+        if self._rules[rule] == 0:
+            del self._rules[rule]
+            if not self._closed.is_set():
+                await self._bus_daemon('RemoveMatch', rule)
+
+    async def _bus_daemon(self, member, rule):
+        try:
+            await self.call('org.freedesktop.DBus', '/org/freedesktop/DBus',
+                            'org.freedesktop.DBus', member, 's', (rule,))
+        except Exception as e:
+            log.error("%s %s failed: %s", member, rule, e)
+
+    # Runs on the loop thread for every message received. The sender is
+    # left to the bus daemon's match rules: every rule we add names it.
+    def _on_message(self, message):
+        from dbus_next import MessageType
+        if message.message_type != MessageType.SIGNAL:
+            return
+        params = None
+        for (iface, signal, path, arg0), signal_fired in \
+                list(self._subscriptions):
+            if (iface is not None and iface != message.interface) or \
+                    (signal is not None and signal != message.member) or \
+                    (path is not None and path != message.path):
+                continue
+            if params is None:
+                params = tuple(unwrap(message.body))
+            if arg0 is not None and (not params or params[0] != arg0):
+                continue
+            try:
+                signal_fired(message.sender, message.path,
+                             message.interface, message.member, params)
+            except Exception:
+                log.exception("Error handling %s from %s", message.member,
+                              message.path)
+
+
+class AsyncioBackend:
+    name = ASYNCIO
+
+    def __init__(self):
+        self.loop = None
+        self._loop_thread = None
+        self._bus = None
+        self._stopped = threading.Event()
+
+    # Makes the Qt event loop the asyncio loop. Call once the
+    # QApplication exists and before connect().
+    def attach(self, app):
+        import asyncio
+        import qasync
+        self.loop = qasync.QEventLoop(app)
+        self._loop_thread = threading.current_thread()
+        asyncio.set_event_loop(self.loop)
+
+    # Runs the application on the shared loop until it quits.
+    def exec(self, app):
+        with self.loop:
+            self.loop.run_forever()
+        return 0
+
+    # Called off the GUI thread.
+    def connect(self, session=False):
+        import asyncio
+        message_bus = _wait(asyncio.run_coroutine_threadsafe(
+            self._connect(session), self.loop), self._stopped)
+        self._bus = AsyncBus(self.loop, self._loop_thread, message_bus)
+        return self._bus
+
+    async def _connect(self, session):
+        from dbus_next import BusType
+        from dbus_next.aio import MessageBus
+        return await MessageBus(
+            bus_type=BusType.SESSION if session else BusType.SYSTEM
+        ).connect()
+
+    # Signals come through the Qt event loop; nothing to start.
+    def start(self):
+        pass
+
+    def stop(self):
+        self._stopped.set()
+        if self._bus is not None:
+            self._bus.close()
+
+
+BACKENDS = {PYDBUS: PydbusBackend, ASYNCIO: AsyncioBackend}
+
+
+# The backend named by DASHBOARD_DBUS_BACKEND, pydbus if unset.
+def create_backend(name=None):
+    name = name or os.environ.get("DASHBOARD_DBUS_BACKEND", PYDBUS)
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown D-Bus backend {name!r}, expected one of "
+                         f"{', '.join(BACKENDS)}")
+    return BACKENDS[name]()
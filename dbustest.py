@@ -1,22 +1,27 @@
-
 from pydbus import SystemBus
 from gi.repository import GLib
 
-def on_track_change(*args, **kwargs):
-    print("Track changed signal received.")
+def on_track_change(path, *args, **kwargs):
+    print("Track changed signal received from", path)
     print("Args:", args)
     print("Kwargs:", kwargs)
     print(type(args))
     print(type(kwargs))
 
-try:
-    bus = SystemBus()
-    media_player = bus.get('org.bluez', '/org/bluez/hci0/dev_44_35_83_3E_0E_0A/player0')  # Replace with your device's MAC
-    print("Connected to media player.")
-    media_player.PropertiesChanged.connect(on_track_change)
-except KeyError:
-    print("Failed to connect to the media player. Make sure the device is connected and try again.")
+bus = SystemBus()
+managed_objects = bus.get('org.bluez', '/').GetManagedObjects()
+
+# Every media player of every connected device, on every adapter.
+players = [path for path, interfaces in managed_objects.items()
+           if 'org.bluez.MediaPlayer1' in interfaces]
+if not players:
+    print("No media players found. Make sure a device is connected and try again.")
+
+for path in players:
+    media_player = bus.get('org.bluez', path)
+    print("Connected to media player", path)
+    media_player.PropertiesChanged.connect(
+        lambda *args, path=path, **kwargs: on_track_change(path, *args, **kwargs))
 
 loop = GLib.MainLoop()
 loop.run()
-
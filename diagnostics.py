@@ -0,0 +1,252 @@
+# Logging and timing metrics.
+#
+# Log records are put on a bounded queue and written by a background
+# thread, so logging never waits on a slow SD card or journald from the GUI
+# or GLib threads. If the queue is full the record is dropped and counted
+# rather than blocking.
+#
+# Timings of hot paths (D-Bus calls, signal-to-paint, paints) are kept per
+# name in fixed-size rings. They can be read from a running dashboard over
+# a Unix socket:
+#
+#   python diagnostics.py [socket path]
+#
+# This module only uses the standard library and is imported first by
+# main.py, so the startup timer also covers the time spent importing Qt.
+
+import array
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s"
+LOG_QUEUE_SIZE = 10000
+
+# Samples kept per metric.
+METRIC_SAMPLES = 1024
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", "/tmp")
+    return os.environ.get(
+        "DASHBOARD_METRICS_SOCKET",
+        os.path.join(runtime_dir, "suzuki-lj-dashboard.sock"))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+_listener = None
+
+
+# Sends all logging through a queue to a writer thread. The level comes
+# from DASHBOARD_LOG_LEVEL unless given.
+def setup_logging(level=None, stream=None):
+    global _listener
+    if _listener is not None:
+        return
+
+    level = level or os.environ.get("DASHBOARD_LOG_LEVEL", "INFO")
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+
+
+def shutdown_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class Metrics:
+    def __init__(self, size=METRIC_SAMPLES):
+        self._size = size
+        self._lock = threading.Lock()
+        # name -> [ring of seconds, next index, total count]
+        self._series = {}
+        # name -> count, for events without a duration
+        self._counters = {}
+
+    def record(self, name, seconds):
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                series = [array.array('d', bytes(8 * self._size)), 0, 0]
+                self._series[name] = series
+            series[0][series[1]] = seconds
+            series[1] = (series[1] + 1) % self._size
+            series[2] += 1
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    # Times the body of a with block.
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    # {name: {count, p50_ms, p99_ms, max_ms}} for timings plus
+    # {"counters": {name: count}}.
+    def snapshot(self):
+        with self._lock:
+            series = {name: (list(values[:min(total, self._size)]), total)
+                      for name, (values, _, total) in self._series.items()}
+            counters = dict(self._counters)
+
+        result = {}
+        for name, (samples, total) in sorted(series.items()):
+            samples.sort()
+            n = len(samples)
+            result[name] = {
+                'count': total,
+                'p50_ms': samples[n // 2] * 1000,
+                'p99_ms': samples[min(n - 1, int(n * 0.99))] * 1000,
+                'max_ms': samples[-1] * 1000,
+            }
+        counters['log_records_dropped'] = DroppingQueueHandler.dropped
+        result['counters'] = counters
+        return result
+
+
+# Shared by every module.
+metrics = Metrics()
+
+
+# Seconds since this process was started, from /proc on Linux. Covers the
+# interpreter's own start up, before any of our code ran. None elsewhere.
+def process_age():
+    try:
+        with open("/proc/self/stat") as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        # Field 22, starttime, in clock ticks since boot.
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+# Splits start up into phases. mark(phase) ends the phase running since the
+# previous mark (or since the timer was created).
+class StartupTimer:
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._last = self._started
+        self._before = process_age()
+        # [(phase, seconds)]
+        self.phases = []
+        if self._before is not None:
+            self.phases.append(("interpreter", self._before))
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        metrics.record(f"startup.{phase}", now - self._last)
+        self._last = now
+
+    # Seconds since the process started, or since the timer was created
+    # where that isn't known.
+    def elapsed(self):
+        return (self._before or 0.0) + time.perf_counter() - self._started
+
+    def report(self):
+        phases = ", ".join(f"{phase} {seconds * 1000:.1f} ms"
+                           for phase, seconds in self.phases)
+        return f"{self.elapsed() * 1000:.1f} ms ({phases})"
+
+
+# Started when this module is first imported.
+startup = StartupTimer()
+
+
+# Answers every connection on a Unix socket with a JSON metrics snapshot.
+class MetricsServer:
+    def __init__(self, path=None, registry=metrics):
+        self.path = path or default_socket_path()
+        self._registry = registry
+        self._socket = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        self._socket.listen(1)
+        self._thread = threading.Thread(target=self._serve, name="metrics",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _serve(self):
+        while self._socket is not None:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            with connection:
+                try:
+                    connection.sendall(
+                        json.dumps(self._registry.snapshot()).encode())
+                except OSError:
+                    pass
+
+
+def dump(path=None):
+    path = path or default_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        data = b""
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    snapshot = json.loads(data)
+
+    counters = snapshot.pop('counters', {})
+    print(f"{'metric':<40}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}")
+    for name, values in snapshot.items():
+        print(f"{name:<40}{values['count']:>8}{values['p50_ms']:>10.2f}"
+              f"{values['p99_ms']:>10.2f}{values['max_ms']:>10.2f}")
+    for name, value in sorted(counters.items()):
+        print(f"{name:<40}{value:>8}")
+
+
+if __name__ == "__main__":
+    dump(sys.argv[1] if len(sys.argv) > 1 else None)
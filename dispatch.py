@@ -0,0 +1,158 @@
+# PropertiesChanged dispatch into the Qt thread.
+#
+# Phones send bursts of MediaPlayer1/MediaTransport1 PropertiesChanged
+# signals, most of which either carry properties the dashboard doesn't
+# show or repeat values it already has.
+# PropertyDispatcher is fed on the GLib thread, drops the properties we
+# don't use straight away, merges the rest into the last known state of
+# the device and keeps only what differs from what the GUI was last given.
+# Those differences are handed to the Qt thread at most once per frame as
+# one propertiesChanged signal, stamped with when the oldest of those
+# changes arrived so the GUI can measure signal-to-paint latency.
+
+import threading
+import time
+from PyQt5.QtCore import QObject, QTimer
+from PyQt5.QtCore import pyqtSignal
+from bluez_index import PLAYER_INTERFACE, TRANSPORT_INTERFACE
+from diagnostics import metrics
+
+# Properties the GUI uses. Everything else is dropped on arrival.
+RELEVANT_PROPERTIES = {
+    # ObexPort is only there when the player has cover art. Position only
+    # anchors the progress bar's clock, see progress.py.
+    PLAYER_INTERFACE: frozenset(('Track', 'Status', 'ObexPort', 'Position')),
+    TRANSPORT_INTERFACE: frozenset(('State', 'Volume')),
+}
+
+
+class PropertyDispatcher(QObject):
+    # device path, {interface: {property: value}} holding only changes,
+    # time.perf_counter() when the first of them was received
+    propertiesChanged = pyqtSignal(object, object, float)
+    # Internal: wakes the Qt thread when the first change of a frame comes
+    # in.
+    _changesPending = pyqtSignal()
+
+    def __init__(self, frame_interval=16, parent=None):
+        super(PropertyDispatcher, self).__init__(parent)
+        self._lock = threading.Lock()
+        # device path -> {interface: {property: value}} as last delivered
+        self._delivered = {}
+        # device path -> {interface: {property: value}} waiting for a frame
+        self._pending = {}
+        # device path -> time.perf_counter() of its oldest pending change
+        self._pending_since = {}
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(frame_interval)
+        self._timer.timeout.connect(self._flush)
+        self._changesPending.connect(self._schedule)
+
+        # Counters.
+        self.signals_received = 0
+        self.signals_dropped = 0
+        self.ui_updates_applied = 0
+
+    # Called from any thread with the properties of one PropertiesChanged
+    # signal.
+    def push(self, device_path, interface, properties):
+        received = time.perf_counter()
+        relevant = RELEVANT_PROPERTIES.get(interface, ())
+        with self._lock:
+            self.signals_received += 1
+            delivered = self._delivered.get(device_path, {}).get(
+                interface, {})
+            wake = not self._pending
+            pending = self._pending.setdefault(device_path, {}).setdefault(
+                interface, {})
+
+            changed = False
+            for name, value in properties.items():
+                if name not in relevant:
+                    continue
+                if name in delivered and delivered[name] == value:
+                    # Back to what the GUI shows, e.g. paused -> playing ->
+                    # paused within one frame.
+                    if name in pending:
+                        del pending[name]
+                        changed = True
+                elif name not in pending or pending[name] != value:
+                    pending[name] = value
+                    changed = True
+
+            if not pending:
+                del self._pending[device_path][interface]
+                if not self._pending[device_path]:
+                    del self._pending[device_path]
+                    self._pending_since.pop(device_path, None)
+            if not changed:
+                self.signals_dropped += 1
+                return
+            if device_path in self._pending:
+                self._pending_since.setdefault(device_path, received)
+
+        if wake:
+            self._changesPending.emit()
+
+    # Records values the GUI already shows (such as the initial GetAll()
+    # results), so they aren't delivered again.
+    def seed(self, device_path, interface, properties):
+        relevant = RELEVANT_PROPERTIES.get(interface, ())
+        with self._lock:
+            delivered = self._delivered.setdefault(
+                device_path, {}).setdefault(interface, {})
+            delivered.update({name: value
+                              for name, value in properties.items()
+                              if name in relevant})
+
+    # Everything known about a device, delivered or not, as
+    # {interface: {property: value}}. Used to redraw the screen for a
+    # device without asking it again.
+    def state(self, device_path):
+        with self._lock:
+            state = {interface: dict(properties)
+                     for interface, properties in
+                     self._delivered.get(device_path, {}).items()}
+            for interface, changes in self._pending.get(
+                    device_path, {}).items():
+                state.setdefault(interface, {}).update(changes)
+            return state
+
+    # Forgets a device, e.g. when it disconnects.
+    def reset(self, device_path):
+        with self._lock:
+            self._delivered.pop(device_path, None)
+            self._pending.pop(device_path, None)
+            self._pending_since.pop(device_path, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'signals_received': self.signals_received,
+                'signals_dropped': self.signals_dropped,
+                'ui_updates_applied': self.ui_updates_applied,
+            }
+
+    # ---------- Qt thread ----------
+
+    def _schedule(self):
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            since, self._pending_since = self._pending_since, {}
+            for device_path, interfaces in pending.items():
+                delivered = self._delivered.setdefault(device_path, {})
+                for interface, changes in interfaces.items():
+                    delivered.setdefault(interface, {}).update(changes)
+            self.ui_updates_applied += len(pending)
+
+        now = time.perf_counter()
+        for device_path, interfaces in pending.items():
+            received = since.get(device_path, now)
+            metrics.record("dispatch.signal_to_flush", now - received)
+            self.propertiesChanged.emit(device_path, interfaces, received)
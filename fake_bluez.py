@@ -0,0 +1,411 @@
+# A fake org.bluez service for running the dashboard without a phone.
+#
+# Publishes an ObjectManager at "/" and, per simulated phone, Device1,
+# MediaPlayer1 and MediaTransport1 objects laid out like the real BlueZ:
+#
+#   /org/bluez/hci0/dev_XX_XX_XX_XX_XX_XX
+#   /org/bluez/hci0/dev_XX_XX_XX_XX_XX_XX/playerN
+#   /org/bluez/hci0/dev_XX_XX_XX_XX_XX_XX/sep1/fdN
+#
+# The simulation is driven through an extra org.bluez.Fake1 interface on
+# "/" (AddDevice, Connect, Disconnect, SetTrack, SetStatus, SetState,
+# SetMediaDelay), so a test or benchmark can script connects, track changes
+# and state changes over D-Bus.
+#
+# Meant for a private session bus, e.g.
+#   dbus-run-session -- sh -c \
+#       "python fake_bluez.py --device 44:35:83:3E:0E:0A --connected & \
+#        DASHBOARD_BUS=session python main.py"
+
+import argparse
+from pydbus import SessionBus
+from pydbus.generic import signal
+from gi.repository import GLib
+
+ADAPTER_PATH = '/org/bluez/hci0'
+
+DEVICE_INTERFACE = 'org.bluez.Device1'
+PLAYER_INTERFACE = 'org.bluez.MediaPlayer1'
+TRANSPORT_INTERFACE = 'org.bluez.MediaTransport1'
+
+# D-Bus types of every property we publish, used to wrap values in
+# GLib.Variant for GetManagedObjects() and InterfacesAdded.
+PROPERTY_TYPES = {
+    DEVICE_INTERFACE: {
+        'Address': 's', 'Name': 's', 'Alias': 's', 'Paired': 'b',
+        'Trusted': 'b', 'Connected': 'b', 'Adapter': 'o',
+    },
+    PLAYER_INTERFACE: {
+        'Name': 's', 'Status': 's', 'Position': 'u', 'Track': 'a{sv}',
+        'Device': 'o',
+    },
+    TRANSPORT_INTERFACE: {
+        'Device': 'o', 'UUID': 's', 'State': 's', 'Volume': 'q',
+    },
+}
+
+
+def to_variants(interface, properties):
+    types = PROPERTY_TYPES[interface]
+    return {name: GLib.Variant(types[name], value)
+            for name, value in properties.items()}
+
+
+# Track metadata in the form MediaPlayer1.Track uses.
+def track_variant(title, artist, album, duration=0):
+    return {
+        'Title': GLib.Variant('s', title),
+        'Artist': GLib.Variant('s', artist),
+        'Album': GLib.Variant('s', album),
+        'Duration': GLib.Variant('u', duration),
+    }
+
+
+class FakeDevice:
+    dbus = """
+    <node>
+      <interface name='org.bluez.Device1'>
+        <method name='Connect'/>
+        <method name='Disconnect'/>
+        <property name='Address' type='s' access='read'/>
+        <property name='Name' type='s' access='read'/>
+        <property name='Alias' type='s' access='read'/>
+        <property name='Paired' type='b' access='read'/>
+        <property name='Trusted' type='b' access='read'/>
+        <property name='Connected' type='b' access='read'/>
+        <property name='Adapter' type='o' access='read'/>
+      </interface>
+    </node>
+    """
+    PropertiesChanged = signal()
+
+    def __init__(self, service, address, name):
+        self._service = service
+        self.Address = address
+        self.Name = name
+        self.Alias = name
+        self.Paired = True
+        self.Trusted = True
+        self.Connected = False
+        self.Adapter = ADAPTER_PATH
+        self.path = f"{ADAPTER_PATH}/dev_{address.replace(':', '_')}"
+
+    def Connect(self):
+        self._service.connect_device(self.Address)
+
+    def Disconnect(self):
+        self._service.disconnect_device(self.Address)
+
+    def properties(self):
+        return {name: getattr(self, name)
+                for name in PROPERTY_TYPES[DEVICE_INTERFACE]}
+
+
+class FakePlayer:
+    dbus = """
+    <node>
+      <interface name='org.bluez.MediaPlayer1'>
+        <method name='Play'/>
+        <method name='Pause'/>
+        <method name='Stop'/>
+        <method name='Next'/>
+        <method name='Previous'/>
+        <property name='Name' type='s' access='read'/>
+        <property name='Status' type='s' access='read'/>
+        <property name='Position' type='u' access='read'/>
+        <property name='Track' type='a{sv}' access='read'/>
+        <property name='Device' type='o' access='read'/>
+      </interface>
+    </node>
+    """
+    PropertiesChanged = signal()
+
+    def __init__(self, device, number):
+        self.path = f"{device.path}/player{number}"
+        self.Name = "Fake Player"
+        self.Status = "paused"
+        self.Position = 0
+        self.Track = track_variant("", "", "")
+        self.Device = device.path
+        # Calls received, for checking what the dashboard sent.
+        self.calls = []
+
+    def _set(self, **changes):
+        for name, value in changes.items():
+            setattr(self, name, value)
+        self.PropertiesChanged(PLAYER_INTERFACE, changes, [])
+
+    def Play(self):
+        self.calls.append("Play")
+        self._set(Status="playing")
+
+    def Pause(self):
+        self.calls.append("Pause")
+        self._set(Status="paused")
+
+    def Stop(self):
+        self.calls.append("Stop")
+        self._set(Status="stopped")
+
+    def Next(self):
+        self.calls.append("Next")
+
+    def Previous(self):
+        self.calls.append("Previous")
+
+    def properties(self):
+        return {name: getattr(self, name)
+                for name in PROPERTY_TYPES[PLAYER_INTERFACE]}
+
+
+class FakeTransport:
+    dbus = """
+    <node>
+      <interface name='org.bluez.MediaTransport1'>
+        <property name='Device' type='o' access='read'/>
+        <property name='UUID' type='s' access='read'/>
+        <property name='State' type='s' access='read'/>
+        <property name='Volume' type='q' access='readwrite'/>
+      </interface>
+    </node>
+    """
+    PropertiesChanged = signal()
+
+    def __init__(self, device, number):
+        self.path = f"{device.path}/sep1/fd{number}"
+        self.Device = device.path
+        self.UUID = "0000110a-0000-1000-8000-00805f9b34fb"
+        self.State = "idle"
+        self._volume = 64
+
+    @property
+    def Volume(self):
+        return self._volume
+
+    @Volume.setter
+    def Volume(self, value):
+        self._volume = value
+        self.PropertiesChanged(TRANSPORT_INTERFACE, {'Volume': value}, [])
+
+    def _set(self, **changes):
+        for name, value in changes.items():
+            setattr(self, name, value)
+        self.PropertiesChanged(TRANSPORT_INTERFACE, changes, [])
+
+    def properties(self):
+        return {name: getattr(self, name)
+                for name in PROPERTY_TYPES[TRANSPORT_INTERFACE]}
+
+
+class FakeBluez:
+    dbus = """
+    <node>
+      <interface name='org.freedesktop.DBus.ObjectManager'>
+        <method name='GetManagedObjects'>
+          <arg name='objects' type='a{oa{sa{sv}}}' direction='out'/>
+        </method>
+        <signal name='InterfacesAdded'>
+          <arg name='object' type='o'/>
+          <arg name='interfaces' type='a{sa{sv}}'/>
+        </signal>
+        <signal name='InterfacesRemoved'>
+          <arg name='object' type='o'/>
+          <arg name='interfaces' type='as'/>
+        </signal>
+      </interface>
+      <interface name='org.bluez.Fake1'>
+        <method name='AddDevice'>
+          <arg name='address' type='s' direction='in'/>
+          <arg name='name' type='s' direction='in'/>
+        </method>
+        <method name='Connect'>
+          <arg name='address' type='s' direction='in'/>
+        </method>
+        <method name='Disconnect'>
+          <arg name='address' type='s' direction='in'/>
+        </method>
+        <method name='SetTrack'>
+          <arg name='address' type='s' direction='in'/>
+          <arg name='title' type='s' direction='in'/>
+          <arg name='artist' type='s' direction='in'/>
+          <arg name='album' type='s' direction='in'/>
+          <arg name='duration' type='u' direction='in'/>
+        </method>
+        <method name='SetStatus'>
+          <arg name='address' type='s' direction='in'/>
+          <arg name='status' type='s' direction='in'/>
+        </method>
+        <method name='SetState'>
+          <arg name='address' type='s' direction='in'/>
+          <arg name='state' type='s' direction='in'/>
+        </method>
+        <method name='SetMediaDelay'>
+          <arg name='milliseconds' type='u' direction='in'/>
+        </method>
+        <method name='GetPlayerCalls'>
+          <arg name='address' type='s' direction='in'/>
+          <arg name='calls' type='as' direction='out'/>
+        </method>
+      </interface>
+    </node>
+    """
+    InterfacesAdded = signal()
+    InterfacesRemoved = signal()
+
+    def __init__(self, bus_object, media_delay=0):
+        self._bus = bus_object
+        # Time between Device1.Connected and the media objects appearing,
+        # as on a real phone.
+        self._media_delay = media_delay
+        self._devices = {}
+        # address -> (player, transport)
+        self._media = {}
+        self._registrations = {}
+        self._next_number = 0
+
+    # ---------- org.freedesktop.DBus.ObjectManager ----------
+
+    def GetManagedObjects(self):
+        objects = {}
+        for device in self._devices.values():
+            objects[device.path] = {DEVICE_INTERFACE: to_variants(
+                DEVICE_INTERFACE, device.properties())}
+        for player, transport in self._media.values():
+            objects[player.path] = {PLAYER_INTERFACE: to_variants(
+                PLAYER_INTERFACE, player.properties())}
+            objects[transport.path] = {TRANSPORT_INTERFACE: to_variants(
+                TRANSPORT_INTERFACE, transport.properties())}
+        return objects
+
+    # ---------- org.bluez.Fake1 ----------
+
+    def AddDevice(self, address, name):
+        address = address.upper()
+        if address in self._devices:
+            return
+        device = FakeDevice(self, address, name)
+        self._devices[address] = device
+        self._register(device)
+        self.InterfacesAdded(device.path, {DEVICE_INTERFACE: to_variants(
+            DEVICE_INTERFACE, device.properties())})
+
+    def Connect(self, address):
+        self.connect_device(address)
+
+    def Disconnect(self, address):
+        self.disconnect_device(address)
+
+    def SetTrack(self, address, title, artist, album, duration):
+        player = self._player(address)
+        player._set(Track=track_variant(title, artist, album, duration))
+
+    def SetStatus(self, address, status):
+        self._player(address)._set(Status=status)
+
+    def SetState(self, address, state):
+        self._transport(address)._set(State=state)
+
+    def SetMediaDelay(self, milliseconds):
+        self._media_delay = milliseconds
+
+    def GetPlayerCalls(self, address):
+        return list(self._player(address).calls)
+
+    # ---------- Simulation ----------
+
+    def connect_device(self, address):
+        device = self._devices[address.upper()]
+        if device.Connected:
+            return
+        device.Connected = True
+        device.PropertiesChanged(DEVICE_INTERFACE, {'Connected': True}, [])
+
+        if self._media_delay:
+            GLib.timeout_add(self._media_delay, self._add_media, device)
+        else:
+            self._add_media(device)
+
+    def disconnect_device(self, address):
+        device = self._devices[address.upper()]
+        if not device.Connected:
+            return
+        self._remove_media(device)
+        device.Connected = False
+        device.PropertiesChanged(DEVICE_INTERFACE, {'Connected': False}, [])
+
+    def _add_media(self, device):
+        if not device.Connected or device.Address in self._media:
+            return False
+        player = FakePlayer(device, self._next_number)
+        transport = FakeTransport(device, self._next_number)
+        self._next_number += 1
+        self._media[device.Address] = (player, transport)
+
+        self._register(player)
+        self.InterfacesAdded(player.path, {PLAYER_INTERFACE: to_variants(
+            PLAYER_INTERFACE, player.properties())})
+        self._register(transport)
+        self.InterfacesAdded(transport.path, {
+            TRANSPORT_INTERFACE: to_variants(
+                TRANSPORT_INTERFACE, transport.properties())})
+        return False  # Don't repeat when used as a GLib timeout
+
+    def _remove_media(self, device):
+        media = self._media.pop(device.Address, None)
+        if media is None:
+            return
+        player, transport = media
+        self.InterfacesRemoved(transport.path, [TRANSPORT_INTERFACE])
+        self._unregister(transport)
+        self.InterfacesRemoved(player.path, [PLAYER_INTERFACE])
+        self._unregister(player)
+
+    def _register(self, fake_object):
+        self._registrations[fake_object.path] = self._bus.register_object(
+            fake_object.path, fake_object, None)
+
+    def _unregister(self, fake_object):
+        registration = self._registrations.pop(fake_object.path, None)
+        if registration is not None:
+            registration.unregister()
+
+    def _player(self, address):
+        return self._media[address.upper()][0]
+
+    def _transport(self, address):
+        return self._media[address.upper()][1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a fake org.bluez service on the session bus.")
+    parser.add_argument("--device", action="append", default=[],
+                        help="MAC address of a paired phone (repeatable)")
+    parser.add_argument("--connected", action="store_true",
+                        help="start with the first device connected")
+    parser.add_argument("--media-delay", type=int, default=0,
+                        help="ms between connecting and the media objects "
+                             "appearing")
+    args = parser.parse_args()
+
+    bus = SessionBus()
+    service = FakeBluez(bus, args.media_delay)
+    bus.register_object("/", service, None)
+
+    for number, address in enumerate(args.device):
+        service.AddDevice(address, f"Fake Phone {number}")
+    if args.connected and args.device:
+        service.connect_device(args.device[0])
+
+    # Own the name last so clients see a fully populated tree.
+    name = bus.request_name("org.bluez")
+    print("Fake BlueZ service running.", flush=True)
+
+    try:
+        GLib.MainLoop().run()
+    finally:
+        name.unown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+# GPS speed.
+#
+# NMEA comes in from a serial receiver, from gpsd or from a recorded log.
+# NmeaParser finds lines in a single buffer and looks at the three-letter
+# sentence type in place before doing anything else. Only the sentences we
+# use (RMC, VTG and GGA) are checksummed, and each of those is copied out
+# once to be split into fields. Speeds go through SpeedFilter, a fixed-size
+# ring buffer with an exponential moving average. GpsThread hands the
+# result to the GUI through a Qt signal at no more than max_rate updates
+# per second, so a 10 Hz receiver can't flood the event loop. A fix or
+# speed held back by that limit is sent when the limit allows, even if the
+# receiver goes quiet.
+
+import array
+import collections
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from PyQt5.QtCore import QThread
+from PyQt5.QtCore import pyqtSignal
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+log = logging.getLogger(__name__)
+
+KNOTS_TO_KMH = 1.852
+
+# Lines longer than this are noise; real sentences are at most 82 bytes.
+MAX_LINE_LENGTH = 256
+
+# timestamp is seconds since midnight UTC as sent by the receiver.
+# latitude/longitude are decimal degrees, or None when the sentence didn't
+# carry a position (VTG).
+GpsFix = collections.namedtuple(
+    'GpsFix', 'timestamp speed_kmh course latitude longitude valid')
+
+
+# XOR of every byte, used for the NMEA checksum. Rather than looping over
+# the bytes in Python the data is read as one big integer and folded in
+# half until one byte is left.
+def xor_bytes(data):
+    length = len(data)
+    value = int.from_bytes(data, 'big')
+    while length > 1:
+        half = length // 2
+        low_bits = half * 8
+        value = (value >> low_bits) ^ (value & ((1 << low_bits) - 1))
+        length -= half
+    return value
+
+
+# ddmm.mmmm plus hemisphere to decimal degrees.
+def _degrees(field, hemisphere):
+    if not field:
+        return None
+    value = float(field)
+    degrees = int(value // 100)
+    degrees += (value - degrees * 100) / 60
+    if hemisphere in (b'S', b'W'):
+        degrees = -degrees
+    return degrees
+
+
+def _seconds_of_day(field):
+    if len(field) < 6:
+        return None
+    return (int(field[0:2]) * 3600 + int(field[2:4]) * 60 +
+            float(field[4:]))
+
+
+class NmeaParser:
+    WANTED = (b'RMC', b'VTG', b'GGA')
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # Latest values from each sentence type, combined into a GpsFix.
+        self._timestamp = None
+        self._latitude = None
+        self._longitude = None
+        self._course = None
+        self._valid = False
+        # Timestamp of the last RMC that carried a speed. A VTG from the
+        # same epoch repeats it and is not reported again.
+        self._speed_timestamp = None
+        self.fix_quality = 0
+        self.satellites = 0
+        self.altitude = None
+
+        # Counters.
+        self.sentences = 0
+        self.parsed = 0
+        self.checksum_errors = 0
+
+    # Adds raw bytes and returns the fixes completed by them. Partial lines
+    # are kept until the rest arrives.
+    def feed(self, data):
+        buffer = self._buffer
+        buffer += data
+        fixes = []
+
+        view = memoryview(buffer)
+        start = 0
+        try:
+            while True:
+                end = buffer.find(b'\n', start)
+                if end < 0:
+                    break
+                fix = self._parse_line(view, start, end)
+                if fix is not None:
+                    fixes.append(fix)
+                start = end + 1
+        finally:
+            view.release()
+
+        del buffer[:start]
+        if len(buffer) > MAX_LINE_LENGTH:
+            buffer.clear()
+        return fixes
+
+    def _parse_line(self, view, start, end):
+        if view[start] != 0x24:  # '$'
+            return None
+        self.sentences += 1
+
+        # $GPRMC / $GNRMC / ... -> RMC. Nothing else is looked at for the
+        # sentences we don't use.
+        kind = view[start + 3:start + 6]
+        if kind not in self.WANTED:
+            return None
+
+        star = self._buffer.find(b'*', start, end)
+        if star < 0 or star + 3 > end:
+            self.checksum_errors += 1
+            return None
+        try:
+            expected = int(self._buffer[star + 1:star + 3], 16)
+        except ValueError:
+            self.checksum_errors += 1
+            return None
+        if xor_bytes(view[start + 1:star]) != expected:
+            self.checksum_errors += 1
+            return None
+
+        fields = view[start:star].tobytes().split(b',')
+        try:
+            if kind == b'RMC':
+                fix = self._parse_rmc(fields)
+            elif kind == b'VTG':
+                fix = self._parse_vtg(fields)
+            else:
+                fix = self._parse_gga(fields)
+        except (ValueError, IndexError):
+            return None
+        self.parsed += 1
+        return fix
+
+    def _parse_rmc(self, fields):
+        self._timestamp = _seconds_of_day(fields[1])
+        self._valid = fields[2] == b'A'
+        if not self._valid:
+            return GpsFix(self._timestamp, None, None, None, None, False)
+
+        self._latitude = _degrees(fields[3], fields[4])
+        self._longitude = _degrees(fields[5], fields[6])
+        speed = float(fields[7]) * KNOTS_TO_KMH if fields[7] else None
+        if speed is not None:
+            self._speed_timestamp = self._timestamp
+        self._course = float(fields[8]) if fields[8] else self._course
+        return GpsFix(self._timestamp, speed, self._course, self._latitude,
+                      self._longitude, True)
+
+    def _parse_vtg(self, fields):
+        if not fields[7]:
+            return None
+        if self._timestamp is not None and \
+                self._speed_timestamp == self._timestamp:
+            return None
+        speed = float(fields[7])
+        if fields[1]:
+            self._course = float(fields[1])
+        return GpsFix(self._timestamp, speed, self._course, None, None,
+                      self._valid)
+
+    def _parse_gga(self, fields):
+        self.fix_quality = int(fields[6]) if fields[6] else 0
+        self.satellites = int(fields[7]) if fields[7] else 0
+        self.altitude = float(fields[9]) if fields[9] else None
+        if self.fix_quality == 0:
+            self._valid = False
+        return None
+
+
+# Smooths speed readings. The last `size` raw readings are kept in a
+# preallocated ring buffer and the output is an exponential moving average.
+# Speeds below `standstill` km/h are shown as 0 so a parked car doesn't
+# wander around with GPS noise.
+class SpeedFilter:
+    def __init__(self, size=16, alpha=0.35, standstill=2.0):
+        self.size = size
+        self.alpha = alpha
+        self.standstill = standstill
+        self._samples = array.array('d', bytes(8 * size))
+        self._index = 0
+        self._count = 0
+        self._value = None
+
+    def add(self, speed_kmh):
+        self._samples[self._index] = speed_kmh
+        self._index = (self._index + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+        if self._value is None:
+            self._value = speed_kmh
+        else:
+            self._value += self.alpha * (speed_kmh - self._value)
+        return self.value
+
+    def reset(self):
+        self._index = 0
+        self._count = 0
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            return None
+        return 0.0 if self._value < self.standstill else self._value
+
+    # Raw readings, oldest first.
+    def samples(self):
+        if self._count < self.size:
+            return list(self._samples[:self._count])
+        return (list(self._samples[self._index:]) +
+                list(self._samples[:self._index]))
+
+
+# ---------- Sources ----------
+# Each source has read(), which blocks until some bytes are available and
+# returns b'' at the end, and close().
+
+class SerialSource:
+    def __init__(self, path, baudrate=9600):
+        if serial is not None:
+            self._port = serial.Serial(path, baudrate, timeout=1)
+            self._fd = None
+        else:
+            # Without pyserial the port is read as a plain file, so its
+            # speed must already be set (stty).
+            self._port = None
+            self._fd = os.open(path, os.O_RDONLY | os.O_NOCTTY)
+
+    def read(self):
+        if self._port is not None:
+            return self._port.read(max(1, self._port.in_waiting))
+        return os.read(self._fd, 4096)
+
+    def close(self):
+        if self._port is not None:
+            self._port.close()
+        elif self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class GpsdSource:
+    def __init__(self, host="localhost", port=2947):
+        self._socket = socket.create_connection((host, port), timeout=5)
+        self._socket.settimeout(None)
+        # Ask gpsd for the receiver's raw NMEA. Its JSON reports don't
+        # start with '$' and are skipped by the parser.
+        watch = {"enable": True, "nmea": True}
+        self._socket.sendall(b"?WATCH=" + json.dumps(watch).encode() +
+                             b"\n")
+
+    def read(self):
+        try:
+            return self._socket.recv(4096)
+        except OSError:
+            return b''
+
+    def close(self):
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+
+
+# Plays back a recorded NMEA log. Sentences are released at the pace of the
+# RMC timestamps divided by `speed`; speed=0 reads as fast as possible.
+class ReplaySource:
+    def __init__(self, path, speed=1.0, loop=False):
+        self._file = open(path, 'rb')
+        self._speed = speed
+        self._loop = loop
+        self._closed = threading.Event()
+        self._last_timestamp = None
+
+    def read(self):
+        if self._speed <= 0:
+            data = self._file.read(65536)
+            if not data and self._loop:
+                self._file.seek(0)
+                data = self._file.read(65536)
+            return data
+
+        line = self._file.readline()
+        if not line and self._loop:
+            self._file.seek(0)
+            self._last_timestamp = None
+            line = self._file.readline()
+
+        if line[3:6] == b'RMC':
+            timestamp = _seconds_of_day(line.split(b',', 2)[1])
+            if timestamp is not None:
+                if self._last_timestamp is not None:
+                    delay = (timestamp - self._last_timestamp) % 86400
+                    self._closed.wait(delay / self._speed)
+                self._last_timestamp = timestamp
+        if self._closed.is_set():
+            return b''
+        return line
+
+    def close(self):
+        self._closed.set()
+        self._file.close()
+
+
+# "gpsd", "gpsd:host:port", "replay:path", "replay:path:speed" or a serial
+# device path such as "/dev/ttyACM0".
+def open_gps_source(spec):
+    if spec == "gpsd" or spec.startswith("gpsd:"):
+        parts = spec.split(":")
+        host = parts[1] if len(parts) > 1 else "localhost"
+        port = int(parts[2]) if len(parts) > 2 else 2947
+        return GpsdSource(host, port)
+    if spec.startswith("replay:"):
+        parts = spec.split(":")
+        speed = float(parts[2]) if len(parts) > 2 else 1.0
+        return ReplaySource(parts[1], speed, loop=True)
+    return SerialSource(spec)
+
+
+class GpsThread(QThread):
+    # Smoothed speed in km/h, at most max_rate times per second.
+    speedChanged = pyqtSignal(float)
+    # Emitted with no value when the receiver loses its fix.
+    fixLost = pyqtSignal()
+    # Every positioned fix (GpsFix), at most max_rate times per second.
+    fixChanged = pyqtSignal(object)
+
+    def __init__(self, source, max_rate=4.0, parent=None):
+        super(GpsThread, self).__init__(parent)
+        self._source = source
+        self._interval = 1.0 / max_rate
+        self._running = True
+        self.parser = NmeaParser()
+        self.filter = SpeedFilter()
+
+        # Guards what is held back, which the flush timer sends.
+        self._lock = threading.Lock()
+        self._last_emit = 0.0
+        self._last_shown = None
+        self._last_fix_emit = 0.0
+        self._has_fix = False
+        # Latest positioned fix and smoothed speed not sent yet.
+        self._held_fix = None
+        self._held_speed = None
+        self._flush_timer = None
+
+    def stop(self):
+        self._running = False
+        self._source.close()
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+    def run(self):
+        while self._running:
+            try:
+                data = self._source.read()
+            except Exception as e:
+                if self._running:
+                    log.error("GPS read failed: %s", e)
+                break
+            if not data:
+                break
+
+            for fix in self.parser.feed(data):
+                self._handle_fix(fix)
+
+    def _handle_fix(self, fix):
+        with self._lock:
+            if not fix.valid:
+                if self._has_fix:
+                    self._has_fix = False
+                    self.filter.reset()
+                    self._last_shown = None
+                    self._held_fix = None
+                    self._held_speed = None
+                    self.fixLost.emit()
+                return
+            self._has_fix = True
+
+            if fix.latitude is not None:
+                self._held_fix = fix
+            if fix.speed_kmh is not None:
+                self._held_speed = self.filter.add(fix.speed_kmh)
+            self._publish(time.monotonic())
+
+    # Sends what is held back if max_rate allows, and starts a timer for
+    # whatever still has to wait. Lock must be held.
+    def _publish(self, now):
+        if self._held_fix is not None and \
+                now - self._last_fix_emit >= self._interval:
+            self._last_fix_emit = now
+            self.fixChanged.emit(self._held_fix)
+            self._held_fix = None
+
+        # Only wake the GUI when the shown (whole km/h) value changes.
+        if self._held_speed is not None:
+            shown = round(self._held_speed)
+            if shown == self._last_shown:
+                self._held_speed = None
+            elif now - self._last_emit >= self._interval:
+                self._last_emit = now
+                self._last_shown = shown
+                self.speedChanged.emit(self._held_speed)
+                self._held_speed = None
+
+        waits = []
+        if self._held_fix is not None:
+            waits.append(self._last_fix_emit + self._interval - now)
+        if self._held_speed is not None:
+            waits.append(self._last_emit + self._interval - now)
+        if waits and self._flush_timer is None and self._running:
+            self._flush_timer = threading.Timer(max(0.0, min(waits)),
+                                                self._flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush(self):
+        with self._lock:
+            self._flush_timer = None
+            if self._has_fix:
+                self._publish(time.monotonic())
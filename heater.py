@@ -0,0 +1,389 @@
+# Heater and fan control.
+#
+# The touchscreen only ever changes the wanted settings held by
+# HeaterController, which returns straight away. A scheduler thread wakes
+# every `period` seconds on fixed deadlines, runs the cabin thermostat and
+# works out what each output channel should be. A channel is only written
+# once its value has been stable for `debounce` seconds and at most once
+# per `min_write_interval`, and all channels due in a tick go to the driver
+# in one batch. How late each tick wakes up is recorded so the jitter of
+# the loop can be checked (see bench_heater.py). Temperature sensors can be
+# slow to read (a DS18B20 takes most of a second), so they are read on a
+# separate thread and the loop only uses the latest reading.
+#
+# Drivers:
+#   SysfsPwmDriver  PWM outputs under /sys/class/pwm and 1-Wire
+#                   temperature sensors under /sys/bus/w1.
+#   GpiodDriver     on/off relays through libgpiod.
+#   FakeHeaterDriver in memory, with a crude cabin temperature model.
+
+import logging
+import os
+import threading
+import time
+
+try:
+    import gpiod
+except ImportError:
+    gpiod = None
+
+log = logging.getLogger(__name__)
+
+# Output channels.
+FAN = "fan"
+SEAT_LEFT = "seat_left"
+SEAT_RIGHT = "seat_right"
+CABIN_HEATER = "cabin_heater"
+CHANNELS = (FAN, SEAT_LEFT, SEAT_RIGHT, CABIN_HEATER)
+
+# Sensor used by the cabin thermostat.
+CABIN_SENSOR = "cabin"
+
+FAN_LEVELS = 4    # off, 1, 2, 3
+SEAT_LEVELS = 4   # off, low, medium, high
+# Duty cycle for each fan/seat level.
+LEVEL_DUTY = (0.0, 0.4, 0.7, 1.0)
+
+CABIN_TARGET_MIN = 10.0
+CABIN_TARGET_MAX = 30.0
+
+# Default wiring. PWM channel numbers on pwmchip0, GPIO lines on gpiochip0
+# and the 1-Wire sensor ID can be changed to suit the car.
+PWM_CHIP = "/sys/class/pwm/pwmchip0"
+PWM_CHANNELS = {FAN: 0, SEAT_LEFT: 1, SEAT_RIGHT: 2, CABIN_HEATER: 3}
+PWM_PERIOD_NS = 1000000  # 1 kHz
+GPIO_CHIP = "gpiochip0"
+GPIO_LINES = {FAN: 17, SEAT_LEFT: 27, SEAT_RIGHT: 22, CABIN_HEATER: 23}
+W1_SENSORS = {
+    CABIN_SENSOR: "/sys/bus/w1/devices/28-000000000000/temperature",
+}
+
+
+class FakeHeaterDriver:
+    name = "fake"
+
+    def __init__(self, cabin_temperature=5.0, outside_temperature=5.0):
+        self.outputs = {channel: 0.0 for channel in CHANNELS}
+        # Every batch written, as (time, {channel: value}).
+        self.writes = []
+        self.cabin_temperature = cabin_temperature
+        self.outside_temperature = outside_temperature
+        self._last_update = time.monotonic()
+        # Written by the scheduler, read by the sensor thread.
+        self._lock = threading.Lock()
+
+    def write(self, outputs):
+        with self._lock:
+            self._simulate()
+            self.outputs.update(outputs)
+            self.writes.append((time.monotonic(), dict(outputs)))
+
+    def read_temperature(self, sensor):
+        with self._lock:
+            self._simulate()
+            return self.cabin_temperature
+
+    def close(self):
+        pass
+
+    # The heater warms the cabin and the cabin cools towards the outside
+    # temperature.
+    def _simulate(self):
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+        heating = self.outputs[CABIN_HEATER] * 0.5
+        cooling = (self.cabin_temperature - self.outside_temperature) * 0.01
+        self.cabin_temperature += (heating - cooling) * elapsed
+
+
+class SysfsPwmDriver:
+    name = "sysfs"
+
+    def __init__(self, chip=PWM_CHIP, channels=None, sensors=None,
+                 period_ns=PWM_PERIOD_NS):
+        self._chip = chip
+        self._channels = channels or PWM_CHANNELS
+        self._sensors = sensors or W1_SENSORS
+        self._period_ns = period_ns
+        # duty_cycle files are kept open so a write is a single syscall.
+        self._duty_files = {}
+
+        for channel, number in self._channels.items():
+            pwm = os.path.join(chip, f"pwm{number}")
+            if not os.path.exists(pwm):
+                self._write_file(os.path.join(chip, "export"), str(number))
+            self._write_file(os.path.join(pwm, "period"), str(period_ns))
+            self._write_file(os.path.join(pwm, "duty_cycle"), "0")
+            self._write_file(os.path.join(pwm, "enable"), "1")
+            self._duty_files[channel] = os.open(
+                os.path.join(pwm, "duty_cycle"), os.O_WRONLY)
+
+    def write(self, outputs):
+        for channel, value in outputs.items():
+            duty = int(self._period_ns * max(0.0, min(1.0, value)))
+            os.pwrite(self._duty_files[channel], str(duty).encode(), 0)
+
+    # 1-Wire sensors report millidegrees.
+    def read_temperature(self, sensor):
+        path = self._sensors.get(sensor)
+        if path is None:
+            return None
+        with open(path) as sensor_file:
+            return int(sensor_file.read()) / 1000
+
+    def close(self):
+        for fd in self._duty_files.values():
+            os.pwrite(fd, b"0", 0)
+            os.close(fd)
+        self._duty_files = {}
+
+    @staticmethod
+    def _write_file(path, value):
+        with open(path, "w") as sysfs_file:
+            sysfs_file.write(value)
+
+
+# Relays can only be on or off, so any value above zero switches the
+# output on. Temperatures come from the same 1-Wire sensors as above.
+class GpiodDriver:
+    name = "gpiod"
+
+    def __init__(self, chip=GPIO_CHIP, lines=None, sensors=None):
+        if gpiod is None:
+            raise RuntimeError("gpiod is not installed")
+        self._lines = lines or GPIO_LINES
+        self._sensors = sensors or W1_SENSORS
+        self._chip = gpiod.Chip(chip)
+        self._requests = {}
+        for channel, offset in self._lines.items():
+            line = self._chip.get_line(offset)
+            line.request(consumer="suzuki-lj-dashboard",
+                         type=gpiod.LINE_REQ_DIR_OUT, default_vals=[0])
+            self._requests[channel] = line
+
+    def write(self, outputs):
+        for channel, value in outputs.items():
+            self._requests[channel].set_value(1 if value > 0 else 0)
+
+    def read_temperature(self, sensor):
+        path = self._sensors.get(sensor)
+        if path is None:
+            return None
+        with open(path) as sensor_file:
+            return int(sensor_file.read()) / 1000
+
+    def close(self):
+        for line in self._requests.values():
+            line.set_value(0)
+            line.release()
+        self._requests = {}
+        self._chip.close()
+
+
+def create_heater_driver(name):
+    if name == "sysfs":
+        return SysfsPwmDriver()
+    if name == "gpiod":
+        return GpiodDriver()
+    return FakeHeaterDriver()
+
+
+class HeaterController:
+    def __init__(self, driver, period=0.1, debounce=0.15,
+                 min_write_interval=0.25, hysteresis=1.0,
+                 thermostat_interval=2.0):
+        self.driver = driver
+        self.period = period
+        self.debounce = debounce
+        self.min_write_interval = min_write_interval
+        self.hysteresis = hysteresis
+        self.thermostat_interval = thermostat_interval
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._sensor_thread = None
+
+        # Wanted settings, changed from the GUI thread.
+        self._fan_level = 0
+        self._seat_levels = {SEAT_LEFT: 0, SEAT_RIGHT: 0}
+        self._cabin_target = None  # None means the cabin heater is off
+        # Set when the target changes, so the next tick re-runs the
+        # thermostat instead of waiting for thermostat_interval.
+        self._target_changed = False
+
+        # Latest reading, written by the sensor thread.
+        self.cabin_temperature = None
+
+        # Scheduler thread only.
+        self._heating = False
+        self._last_thermostat = 0.0
+        # channel -> [wanted value, time it last changed]
+        self._wanted = {channel: [0.0, 0.0] for channel in CHANNELS}
+        # channel -> [written value, time written]
+        self._written = {channel: [0.0, 0.0] for channel in CHANNELS}
+
+        # Tick lateness in seconds, kept in a fixed-size ring.
+        self._lateness = [0.0] * 1024
+        self._lateness_index = 0
+        self.ticks = 0
+        self.batches_written = 0
+
+    # ---------- Touchscreen side, never blocks on hardware ----------
+
+    def set_fan_level(self, level):
+        with self._lock:
+            self._fan_level = max(0, min(FAN_LEVELS - 1, level))
+
+    def set_seat_level(self, seat, level):
+        with self._lock:
+            self._seat_levels[seat] = max(0, min(SEAT_LEVELS - 1, level))
+
+    # None switches the cabin heater off.
+    def set_cabin_target(self, temperature):
+        with self._lock:
+            if temperature is None:
+                self._cabin_target = None
+            else:
+                self._cabin_target = max(CABIN_TARGET_MIN,
+                                         min(CABIN_TARGET_MAX, temperature))
+            self._target_changed = True
+
+    def settings(self):
+        with self._lock:
+            return {
+                'fan_level': self._fan_level,
+                'seat_levels': dict(self._seat_levels),
+                'cabin_target': self._cabin_target,
+            }
+
+    # ---------- Scheduler ----------
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="heater",
+                                        daemon=True)
+        self._thread.start()
+        self._sensor_thread = threading.Thread(
+            target=self._read_sensors, name="heater-sensors", daemon=True)
+        self._sensor_thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in (self._thread, self._sensor_thread):
+            if thread is not None:
+                thread.join()
+        self._thread = None
+        self._sensor_thread = None
+        # Leave everything off.
+        try:
+            self.driver.write({channel: 0.0 for channel in CHANNELS})
+        except Exception as e:
+            log.error("Failed to switch heaters off: %s", e)
+        self.driver.close()
+
+    # Percentiles of tick lateness in milliseconds.
+    def jitter_stats(self):
+        count = min(self.ticks, len(self._lateness))
+        if not count:
+            return {'ticks': 0}
+        samples = sorted(self._lateness[:count])
+        return {
+            'ticks': self.ticks,
+            'p50_ms': samples[count // 2] * 1000,
+            'p99_ms': samples[min(count - 1, int(count * 0.99))] * 1000,
+            'max_ms': samples[-1] * 1000,
+        }
+
+    def _run(self):
+        # Deadlines are fixed multiples of the period from the start, so a
+        # late tick doesn't push the following ones back.
+        started = time.monotonic()
+        tick = 0
+        while True:
+            tick += 1
+            deadline = started + tick * self.period
+            if self._stop.wait(max(0.0, deadline - time.monotonic())):
+                return
+
+            now = time.monotonic()
+            if now - deadline > self.period:
+                # Badly overrun; skip the missed ticks.
+                tick = int((now - started) / self.period)
+            self._lateness[self._lateness_index] = now - deadline
+            self._lateness_index = (self._lateness_index + 1) % len(
+                self._lateness)
+            self.ticks += 1
+
+            try:
+                self._tick(now)
+            except Exception:
+                log.exception("An error occurred in the heater loop")
+
+    def _tick(self, now):
+        with self._lock:
+            target_changed, self._target_changed = \
+                self._target_changed, False
+        if target_changed or \
+                now - self._last_thermostat >= self.thermostat_interval:
+            self._last_thermostat = now
+            self._thermostat()
+
+        with self._lock:
+            fan_level = self._fan_level
+            seat_levels = dict(self._seat_levels)
+
+        # The heater core needs some airflow.
+        if self._heating and fan_level == 0:
+            fan_level = 1
+
+        wanted = {
+            FAN: LEVEL_DUTY[fan_level],
+            SEAT_LEFT: LEVEL_DUTY[seat_levels[SEAT_LEFT]],
+            SEAT_RIGHT: LEVEL_DUTY[seat_levels[SEAT_RIGHT]],
+            CABIN_HEATER: 1.0 if self._heating else 0.0,
+        }
+
+        batch = {}
+        for channel, value in wanted.items():
+            state = self._wanted[channel]
+            if state[0] != value:
+                state[0] = value
+                state[1] = now
+            written = self._written[channel]
+            if (written[0] != value and
+                    now - state[1] >= self.debounce and
+                    now - written[1] >= self.min_write_interval):
+                batch[channel] = value
+
+        if batch:
+            self.driver.write(batch)
+            self.batches_written += 1
+            for channel, value in batch.items():
+                self._written[channel] = [value, now]
+
+    def _read_sensors(self):
+        while True:
+            try:
+                self.cabin_temperature = self.driver.read_temperature(
+                    CABIN_SENSOR)
+            except Exception as e:
+                log.warning("Failed to read cabin temperature: %s", e)
+                self.cabin_temperature = None
+            if self._stop.wait(self.thermostat_interval):
+                return
+
+    # Switches the cabin heater on below target - hysteresis / 2 and off
+    # above target + hysteresis / 2. Without a reading it stays off.
+    def _thermostat(self):
+        with self._lock:
+            target = self._cabin_target
+        temperature = self.cabin_temperature
+
+        if target is None or temperature is None:
+            self._heating = False
+        elif temperature < target - self.hysteresis / 2:
+            self._heating = True
+        elif temperature > target + self.hysteresis / 2:
+            self._heating = False
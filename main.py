@@ -9,237 +9,367 @@
 # is connected but doesn't have a player active then no song is displayed.
 # This is fine but becomes a problem when Spotify if then opened, a song is
 # played but only an active of playing status is passed with no song info.
-
-import subprocess
+#
+# Start up is ordered so that the window appears as early as possible:
+# pydbus, gi and the GPS, telemetry and trip log code are only imported
+# when they are needed, the form comes precompiled from ui_cache, and
+# connecting to D-Bus and reading the BlueZ object tree happen on a thread
+# after the first frame. The time each phase took is logged once the
+# window is up and again once Bluetooth is ready.
+
+# Imported first: it starts the startup timer.
+from diagnostics import (startup, metrics, setup_logging, shutdown_logging,
+                         MetricsServer)
+import logging
+import os
 import time
-from PyQt5.QtCore import Qt, QTimer, QRect
-from PyQt5.QtGui import QPainter, QFontMetrics
-from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QVBoxLayout
-from PyQt5 import uic
+from PyQt5.QtCore import Qt, QTimer, QRect, QEvent
+from PyQt5.QtGui import QPainter, QFontMetrics, QPixmap, QPalette
+from PyQt5.QtWidgets import (QApplication, QWidget, QMainWindow, QVBoxLayout,
+                             QLabel, QPushButton)
 from PyQt5.QtCore import QThread
 from PyQt5.QtCore import pyqtSignal
-from pydbus import SystemBus
-from gi.repository import GLib
 from functools import partial
-
-
-def setup_general_device_listener(bus_object, window):
-    bluez_service = bus_object.get('org.bluez', '/')
-    bluez_service.InterfacesAdded.connect(partial(on_device_connected, window))
-    print("General device listener set up.")
-
-
-def on_device_connected(window, *args, **kwargs):
-    if not window.specific_listener_active:
-        print("A Bluetooth device has connected.")
-        window.handle_new_connection()
+from bluez_index import (BluezObjectIndex, DEVICE_INTERFACE,
+                         PLAYER_INTERFACE, TRANSPORT_INTERFACE)
+from connection import ConnectionManager, READY, TEARING_DOWN
+from dispatch import PropertyDispatcher
+from media_worker import (MediaControlWorker, PLAY, PAUSE, NEXT, PREVIOUS,
+                          TRANSPORT_VOLUME_MAX)
+from mixer import create_mixer, TransportMixer
+from ui_cache import load_ui
+from artwork import ArtworkCache, track_key
+from progress import PlaybackClock, ProgressBar
+from pages import Page, PageStack, FrameTimeOverlay
+from snapshot import StateSnapshot
+from recorder import RecordingBus
+from reconnect import ReconnectScheduler
+from optimistic import (IntentTracker, STATUS, TRACK, VOLUME,
+                        VOLUME_TOLERANCE)
+from dbus_backend import create_backend
+from heater import (HeaterController, create_heater_driver, FAN_LEVELS,
+                    SEAT_LEVELS, SEAT_LEFT, SEAT_RIGHT, CABIN_TARGET_MIN,
+                    CABIN_TARGET_MAX)
+
+# Percent per volume button press.
+VOLUME_STEP = 5
+# Auto-repeat of a held volume button, in milliseconds.
+VOLUME_REPEAT_DELAY = 400
+VOLUME_REPEAT_INTERVAL = 100
+
+# Button text for each fan and seat heater level.
+LEVEL_NAMES = ("Off", "Low", "Med", "High")
+# Cabin target when the heater is first switched on, and the step per
+# press, in degrees C.
+CABIN_DEFAULT_TARGET = 20.0
+CABIN_TARGET_STEP = 1.0
+# Seconds between GPS fixes kept in the state snapshot.
+SNAPSHOT_GPS_INTERVAL = 30.0
+# Milliseconds between trip summary refreshes on the Speed page.
+TRIP_REFRESH_INTERVAL = 10000
+# Time to first frame, in milliseconds, above which start up logs a
+# warning. Set with DASHBOARD_STARTUP_BUDGET.
+STARTUP_BUDGET = 1500
+
+log = logging.getLogger("dashboard")
+
+
+# BlueZ lives on the system bus. Setting DASHBOARD_BUS=session uses the
+# session bus instead, which is where fake_bluez.py runs. Setting
+# DASHBOARD_RECORD=file records the BlueZ traffic, see recorder.py.
+def connect_bus(backend):
+    bus = backend.connect(
+        session=os.environ.get("DASHBOARD_BUS") == "session")
+    if os.environ.get("DASHBOARD_RECORD"):
+        bus = RecordingBus(bus, os.environ["DASHBOARD_RECORD"])
+    return bus
 
 
 # This function just returns the MAC address of the connected device.
-def get_connected_bluetooth_mac(bus_object):
-    print("get_connected_bluetooth_mac() called")
-
-    bluez_service = bus_object.get('org.bluez', '/')
-    managed_objects = bluez_service.GetManagedObjects()
-
-    for path, interfaces in managed_objects.items():
-        if 'org.bluez.Device1' in interfaces:
-            device_properties = managed_objects[path]['org.bluez.Device1']
-
-            if ('Connected' in device_properties and
-                    device_properties['Connected']):
-                return path.split('/')[-1]  # Extract MAC address from the path
+# The answer comes from the cached BlueZ object index rather than a
+# GetManagedObjects() scan.
+def get_connected_bluetooth_mac(index):
+    log.debug("get_connected_bluetooth_mac() called")
+
+    device_path = index.connected_device_path()
+    if device_path:
+        return device_path.split('/')[-1]  # Extract MAC address from the path
     return None  # Return None if no connected device is found
 
 
-# This function sets up the PropertiesChanged listener for the connected
-# device.
-def setup_device_connection(bus_object, window):
-    print("setup_device_connection() called")
-    mac_address = get_connected_bluetooth_mac(bus_object)
-    print("setup_device_connection() mac address:", mac_address)
-    if mac_address:
-        device_path = f"/org/bluez/hci0/{mac_address.replace(':', '_')}"
-        device = bus_object.get('org.bluez', device_path)
-
-        if (hasattr(window, 'device_properties_subscription') and
-                window.device_properties_subscription):
-            window.device_properties_subscription.disconnect()
-
-        window.device_properties_subscription = (
-            device.PropertiesChanged.connect(
-                partial(on_device_property_changed, window)
-            )
-        )
-
-        print("device.PropertiesChanged.connect() called")
-        return mac_address  # Return the MAC address for further use
-    else:
-        # print("No connected Bluetooth device found.")
-        return None
-
-
 # Used to handle connections and disconnections of Bluetooth devices.
+# Called with the PropertiesChanged arguments of a device plus its object
+# path, see GUI.on_bluez_object_event().
 def on_device_property_changed(window, *args, **kwargs):
-    # print("on_device_property_changed() called")
-    # print("on_device_property_changed() args:", args)  # Debugging line
-    # print("on_device_property_changed() kwargs:", kwargs)  # Debugging line
-
     interface_name = args[0]
     properties = args[1]
-
-    # print(f"Interface: {interface_name}")  # Debugging line
-    # print(f"Properties: {properties}")  # Debugging line
+    device_path = kwargs.get('path')
 
     try:
-        if interface_name == 'org.bluez.Device1':
+        if interface_name == DEVICE_INTERFACE:
             if 'Connected' in properties:
                 is_connected = properties['Connected']
                 if is_connected:
-                    print("A Bluetooth device has connected.")
-                    # You can add your logic here to handle the new connection
-                    window.handle_new_connection()
+                    window.connection.device_connected(device_path)
                 else:
-                    print("A Bluetooth device has disconnected.")
-                    # You can add your logic here to handle the disconnection
-                    window.handle_disconnection()
-
-        # print("on_device_property_changed() finished gracefully")
+                    window.connection.device_disconnected(device_path)
     except Exception as e:
-        print(f"An error occurred in on_device_property_changed: {e}")
-
-
-# The dbus player path can change as devices are connected
-# and disconnected. We cannot hardcode player0 as the path and must
-# therefore retrive it once we have the device MAC address.
-def find_media_player_path(bus_object, mac_address):
-    bluez_service = bus_object.get('org.bluez', '/')
-    managed_objects = bluez_service.GetManagedObjects()
-
-    for path, interfaces in managed_objects.items():
-        if 'org.bluez.MediaPlayer1' in interfaces:
-            if mac_address.replace(":", "_").lower() in path.lower():
-                return path
-    return None
+        log.error("An error occurred in on_device_property_changed: %s", e)
 
 
-# Same thing as above except retrieving the path that deals with
-# volume controls. Typically "fd" followed by a number.
-def find_media_transport_path(bus_object, mac_address):
-    bluez_service = bus_object.get('org.bluez', '/')
-    managed_objects = bluez_service.GetManagedObjects()
+# Connects to the bus and builds the BlueZ object index (one
+# GetManagedObjects() call) off the GUI thread, so neither the D-Bus
+# library import nor the round trip delay the first frame.
+class BusConnectThread(QThread):
+    # bus, BluezObjectIndex
+    connected = pyqtSignal(object, object)
+    failed = pyqtSignal(str)
 
-    for path, interfaces in managed_objects.items():
-        if 'org.bluez.MediaTransport1' in interfaces:
-            if mac_address.replace(":", "_").lower() in path.lower():
-                return path
-    return None
+    # bus replaces the connect_bus() one, e.g. with a replay.
+    def __init__(self, backend, bus=None, parent=None):
+        super(BusConnectThread, self).__init__(parent)
+        self._backend = backend
+        self._bus = bus
 
-
-def find_device_object_path(bus_object, mac_address):
-    bluez_service = bus_object.get('org.bluez', '/')
-    managed_objects = bluez_service.GetManagedObjects()
-
-    for path, interfaces in managed_objects.items():
-        if 'org.bluez.Device1' in interfaces:
-            if mac_address.replace(":", "_").lower() in path.lower():
-                return path
-    return None
-
-
-class GLibThread(QThread):
     def run(self):
-        loop = GLib.MainLoop()
-        loop.run()
+        try:
+            bus = self._bus or connect_bus(self._backend)
+            index = BluezObjectIndex(bus)
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.connected.emit(bus, index)
 
 
+# Draws a single line of text, scrolling it sideways when it is too wide to
+# fit. The text is rendered once into a pixmap whenever it or the font
+# changes, and each frame just blits that pixmap at the current offset. The
+# scroll timer only runs while the text overflows and the widget is visible,
+# so a label that fits (or is hidden) costs nothing between updates.
 class ScrollingLabel(QWidget):
-    def __init__(self, text, parent=None):
+    def __init__(self, text, parent=None, frame_rate=60, scroll_speed=30):
         super(ScrollingLabel, self).__init__(parent)
         self._text = text
         self._offset = 0
+        # Pixels per second.
+        self._scroll_speed = scroll_speed
+
+        # Cached rendering of the text, see _render_text().
+        self._pixmap = None
+        self._text_width = 0
+        self._spaced_text_width = 0
+        self._overflows = False
+
+        # CPU time spent in paintEvent, for checking the cost per frame.
+        self.frames_painted = 0
+        self.paint_cpu_time = 0.0
+        # time.perf_counter() when the D-Bus signal behind the current text
+        # arrived, until that text has been painted.
+        self._text_received_at = None
 
         # Set fixed width and height for the widget
         self.setFixedWidth(400)
         self.setFixedHeight(50)
 
-        # Initialize timer for scrolling
+        # Initialize timer for scrolling. Started by _update_timer().
         self._timer = QTimer(self)
         self._timer.timeout.connect(self._update_offset)
-        self._timer.start(16)  # Update every 16 ms (about 60 frames/second)
+        self.set_frame_rate(frame_rate)
+
+        self._render_text()
+
+    def set_frame_rate(self, frame_rate):
+        self._frame_rate = frame_rate
+        self._timer.setInterval(max(1, round(1000 / frame_rate)))
+
+    # Returns the paint counters plus the average CPU time per frame in
+    # milliseconds.
+    def frame_stats(self):
+        frames = self.frames_painted
+        return {
+            'frames': frames,
+            'cpu_ms_per_frame': (self.paint_cpu_time * 1000 / frames
+                                 if frames else 0.0),
+            'scrolling': self._timer.isActive(),
+            'frame_rate': self._frame_rate,
+        }
+
+    def reset_frame_stats(self):
+        self.frames_painted = 0
+        self.paint_cpu_time = 0.0
 
     def paintEvent(self, event):
-        painter = QPainter(self)
-        font_metrics = QFontMetrics(painter.font())
-        text_width = font_metrics.width(self._text)
+        started = time.thread_time()
+        wall_started = time.perf_counter()
 
-        if text_width > self.width():
-            # Add a space at the end of the text for separation
-            spaced_text = self._text + ' '
-            spaced_text_width = font_metrics.width(spaced_text)
+        painter = QPainter(self)
+        y = (self.height() - self._pixmap_height()) // 2
 
+        if self._overflows:
             # Calculate the x position to start drawing text
             x = int(self.width() - self._offset)
 
             # Draw text twice to create a continuous scrolling effect
-            painter.drawText(
-                QRect(x, 0, spaced_text_width, self.height()),
-                Qt.AlignVCenter,
-                spaced_text
-            )
-            painter.drawText(
-                QRect(x - spaced_text_width, 0, spaced_text_width,
-                      self.height()),
-                Qt.AlignVCenter,
-                spaced_text
-            )
+            painter.drawPixmap(x, y, self._pixmap)
+            painter.drawPixmap(x - self._spaced_text_width, y, self._pixmap)
         else:
             # Center the text if it fits within the widget
-            x = max((self.width() - text_width) // 2, 0)  # Ensure x is +tive
-            painter.drawText(QRect(x, 0, self.width() - x, self.height()),
-                             Qt.AlignVCenter, self._text)
+            x = max((self.width() - self._text_width) // 2, 0)  # Ensure +tive
+            painter.drawPixmap(x, y, self._pixmap)
 
             # Debug to check widget border size
             # painter.setPen(Qt.red)
             # painter.drawRect(self.rect().adjusted(0, 0, -1, -1))
+        painter.end()
+
+        self.frames_painted += 1
+        self.paint_cpu_time += time.thread_time() - started
+        finished = time.perf_counter()
+        metrics.record("paint.scrolling_label", finished - wall_started)
+        if self._text_received_at is not None:
+            metrics.record("signal_to_paint.song_label",
+                           finished - self._text_received_at)
+            self._text_received_at = None
 
     def _update_offset(self):
-        font_metrics = QFontMetrics(self.font())
-        text_width = font_metrics.width(self._text)
+        self._offset += self._scroll_speed / self._frame_rate
 
-        # Only scroll if the text width is greater than the widget width
-        if text_width > self.width():
-            self._offset += 0.5  # Change this value to adjust speed
-
-            if self._offset > text_width:
-                self._offset = 0
-        else:
-            self._offset = 0  # Reset offset if text fits within the widget
+        # Wrap once a whole copy of the text has scrolled past.
+        if self._offset > self._spaced_text_width:
+            self._offset -= self._spaced_text_width
 
         self.update()  # Trigger a repaint
 
-    def update_text(self, new_text):
+    def text(self):
+        return self._text
+
+    # received_at is when the signal behind the new text arrived, if it
+    # came from D-Bus.
+    def update_text(self, new_text, received_at=None):
+        if new_text == self._text:
+            return
         self._text = new_text
+        self._text_received_at = received_at
+        self._render_text()
         self.update()
 
+    # Measures the text and draws it into the cached pixmap. Only called
+    # when the text, font or size changes.
+    def _render_text(self):
+        font_metrics = QFontMetrics(self.font())
+        self._text_width = font_metrics.width(self._text)
+        self._overflows = self._text_width > self.width()
+
+        if self._overflows:
+            # Add a space at the end of the text for separation
+            rendered_text = self._text + ' '
+            self._spaced_text_width = font_metrics.width(rendered_text)
+            width = self._spaced_text_width
+        else:
+            rendered_text = self._text
+            self._spaced_text_width = self._text_width
+            self._offset = 0  # Reset offset if text fits within the widget
+            width = self._text_width
+
+        ratio = self.devicePixelRatioF()
+        pixmap = QPixmap(max(1, int(width * ratio)),
+                         max(1, int(self.height() * ratio)))
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(Qt.transparent)
+
+        painter = QPainter(pixmap)
+        painter.setFont(self.font())
+        painter.setPen(self.palette().color(QPalette.WindowText))
+        painter.drawText(QRect(0, 0, width, self.height()),
+                         Qt.AlignVCenter, rendered_text)
+        painter.end()
+
+        self._pixmap = pixmap
+        self._update_timer()
+
+    def _pixmap_height(self):
+        return round(self._pixmap.height() / self._pixmap.devicePixelRatio())
+
+    # Scroll only while there is something to scroll and someone to see it.
+    def _update_timer(self):
+        if self._overflows and self.isVisible():
+            if not self._timer.isActive():
+                self._timer.start()
+        else:
+            self._timer.stop()
+
+    def showEvent(self, event):
+        super(ScrollingLabel, self).showEvent(event)
+        self._update_timer()
+
+    def hideEvent(self, event):
+        super(ScrollingLabel, self).hideEvent(event)
+        self._update_timer()
+
+    def resizeEvent(self, event):
+        super(ScrollingLabel, self).resizeEvent(event)
+        self._render_text()
+
+    def changeEvent(self, event):
+        super(ScrollingLabel, self).changeEvent(event)
+        if event.type() in (QEvent.FontChange, QEvent.PaletteChange):
+            self._render_text()
+            self.update()
+
 
 class GUI(QMainWindow):
     trackChanged = pyqtSignal(str)
     mediaPlayerStatusChanged = pyqtSignal(str)
-    device_properties_subscription = None
-
-    # Any changes made in __init__() must be reflected in
-    # handle_new_connection(). See the note preceding this function.
-    def __init__(self):
+    # Seconds to wait for MediaPlayer1/MediaTransport1 before falling back.
+    media_ready_timeout = 5.0
+    media_worker = None
+    connection = None
+    reconnect = None
+    # Pending button presses, see optimistic.py.
+    intents = None
+    # Frames per second of the scrolling song label.
+    label_frame_rate = 60
+    gps_thread = None
+    # Most speed label updates per second.
+    speed_refresh_rate = 4.0
+    telemetry_thread = None
+    # Trip history, kept while there is GPS, see triplog.py.
+    trip_log = None
+    trip_label = None
+    # Most engine readout updates per second.
+    engine_refresh_rate = 10.0
+    # Speed-dependent EQ on the phone's audio, see dsp.py.
+    dsp = None
+    transport_mixer = None
+    # Set when the connected transport reports a Volume property.
+    transport_has_volume = False
+    # Arrival time of the Track signal being shown, see
+    # on_properties_dispatched().
+    _track_received_at = None
+    first_frame_painted = False
+    bluez_index = None
+    pages = None
+    # Lazily built pages, see setup_pages().
+    climate = None
+    speed_page_label = None
+    engine_label = None
+    map_widget = None
+
+    # bus replaces the system bus, e.g. with recorder.ReplayBus. backend is
+    # the D-Bus backend (see dbus_backend.py), DASHBOARD_DBUS_BACKEND's if
+    # not given.
+    def __init__(self, bus=None, backend=None):
         super(GUI, self).__init__()
-        uic.loadUi("mainwindow.ui", self)
+        load_ui("mainwindow.ui", self)
+        self.setup_pages()
+        startup.mark("ui")
         self.show()
 
         self.trackIsPlaying = False
-        # We need a way of tracking how audio transport has changed,
-        # whether that's on the bluetooth device end or if a button has been
-        # pushed.
-        self.playPauseInitiatedByButton = False
+        # Presses change the screen straight away and are checked against
+        # what the phone reports next, see optimistic.py.
+        self.intents = IntentTracker()
+        self.intents.rolledBack.connect(self.on_intent_rolled_back)
         self.playPauseButton.clicked.connect(self.playPauseButton_clicked)
         self.nextTrackButton.clicked.connect(self.nextTrackButton_clicked)
         self.prevTrackButton.clicked.connect(self.prevTrackButton_clicked)
@@ -247,256 +377,490 @@ class GUI(QMainWindow):
         self.volDownButton.clicked.connect(self.volDownButton_clicked)
         self.volUpButton.clicked.connect(self.volUpButton_clicked)
 
-        self.dbus_thread = GLibThread()
+        # Holding a volume button repeats the press. The mixer limits how
+        # often the volume is actually changed.
+        for button in (self.volDownButton, self.volUpButton):
+            button.setAutoRepeat(True)
+            button.setAutoRepeatDelay(VOLUME_REPEAT_DELAY)
+            button.setAutoRepeatInterval(VOLUME_REPEAT_INTERVAL)
+
+        # Local volume control, opened once.
+        self.mixer = create_mixer("Master")
+        log.info("Using %s mixer backend.", self.mixer.name)
+
         self.trackChanged.connect(self.update_song_label)
         self.mediaPlayerStatusChanged.connect(self.handleMPStatusChange)
 
-        self.scrolling_label = ScrollingLabel("Nothing playing")
+        self.scrolling_label = ScrollingLabel(
+            "Nothing playing", frame_rate=self.label_frame_rate)
         layout = QVBoxLayout()
         layout.addWidget(self.scrolling_label)
 
         self.scrollingLabelPlaceholder.setLayout(layout)
 
-        self.specific_listener_active = False
-
-        # dbus init. Also found in handle_new_connection() below
-        try:
-            # Make dbus connection.
-            self.bus = SystemBus()
-
-            # Set the flag to process the PropertiesChanged signal.
-            # Used in on_player_properties_change()
-            self.ignore_properties_changed = False
-
-            # Format: dev_XX_XX_XX_XX_XX_XX
-            self.bt_mac_address = setup_device_connection(self.bus, self)
-
-            if self.bt_mac_address:
-                print(f"Bluetooth device MAC address: {self.bt_mac_address}")
-
-                # ----------------------------------------
-                # ---------- PLAYER DEVICE INIT ----------
-                # ----------------------------------------
-                # Format: /org/bluez/hci0/dev_XX_XX_XX_XX_XX_XX/playerX
-                player_device_path = find_media_player_path(
-                    self.bus, self.bt_mac_address)
-                print("Device player path: ", player_device_path)
-
-                try:
-                    if player_device_path:
-                        # Connect to dbus media player
-                        self.media_player = self.bus.get('org.bluez',
-                                                         player_device_path)
-                    else:
-                        print("No player device path!")
-                except Exception as e:
-                    print(f"Couldn't get media player: {e}")
-                    return
-
-                other_player_properties = self.media_player.GetAll(
-                    'org.bluez.MediaPlayer1')
-                print("All media properties:", other_player_properties)
-
-                # Get the current song information to display song information
-                # on connect.
-                current_track = self.media_player.Get('org.bluez.MediaPlayer1',
-                                                      'Track')
-                if current_track:
-                    print("Initial track:", current_track)
-                    self.update_label_with_track_info(current_track)
-
-                # Listen for changes and call on_player_properties_change()
-                # Subscription so that we can call disconnect() to prevent
-                # multiple listeners being set up as devices connect and
-                # disconnect over time.
-                self.media_player_properties_subscription = (
-                    self.media_player.PropertiesChanged.connect(
-                        self.on_player_properties_change)
-                    )
-
-                # -------------------------------------------
-                # ---------- TRANSPORT DEVICE INIT ----------
-                # -------------------------------------------
-                # Format: /org/bluez/hci0/dev_XX_XX_XX_XX_XX_XX/fdX
-                transport_device_path = find_media_transport_path(
-                    self.bus, self.bt_mac_address)
-                print("Device transport path: ", transport_device_path)
-
-                try:
-                    if transport_device_path:
-                        # Connect to dbus media transport
-                        self.media_transport = self.bus.get(
-                            'org.bluez', transport_device_path)
-                    else:
-                        print("No transport device path!")
-                except Exception as e:
-                    print(f"Couldn't get media transport: {e}")
-
-                other_transport_properties = self.media_transport.GetAll(
-                    'org.bluez.MediaTransport1')
-                print("All transport properties:", other_transport_properties)
-
-                current_state = self.media_transport.Get(
-                    'org.bluez.MediaTransport1', 'State')
-
-                if current_state:
-                    print("Initial state:", current_state)
-                    if current_state == "idle":
-                        self.trackIsPlaying = False
-                        self.playPauseButton.setText("|>")
-                    elif current_state == "active":
-                        self.trackIsPlaying = False
-                        self.playPauseButton.setText("||")
-
-                self.media_transport_properties_subscription = (
-                    self.media_transport.PropertiesChanged.connect(
-                        self.on_transport_change)
-                    )
-
-            else:
-                print("No connected Bluetooth device found at start up.")
-                self.scrolling_label.update_text("No media device connected")
-                setup_general_device_listener(self.bus, self)
-
-        except Exception as e:
-            print(f"An error occurred in GUI constructor: {e}")
-
-        # Now we are set up we can start the Bluetooth thread
-        self.dbus_thread.start()
-
-    # Used for handling any new Bluetooth connection after program init.
-    # Despite the fact that this is pretty much completely repeated code
-    # to what's found in __init__ there is an additional time.sleep(2)
-    # below. If we run this on startup we have an unnecessary 2 second
-    # increase in start time. Without waiting 2 seconds below a race condition
-    # fails, and because this sleep() is nested I would prefer not to turn
-    # this all into spaghetti. This function must be updated if changes are
-    # made in __init__()
-    # See above code for comments.
-    def handle_new_connection(self):
-        try:
-            # Set the flag to process the PropertiesChanged signal
-            self.ignore_properties_changed = False
-
-            # self.media_player_properties_subscription.disconnect()
-            # self.media_transport_properties_subscription.disconnect()
-
-            self.bt_mac_address = setup_device_connection(self.bus, self)
-
-            if self.bt_mac_address:
-                print(f"New Bluetooth device MAC address: "
-                      f"{self.bt_mac_address}")
-                time.sleep(2)  # Make sure the media player object is ready
-
-                player_device_path = find_media_player_path(
-                    self.bus, self.bt_mac_address)
-                print("handle_new_connection()_ device connect run")
-
-                try:
-                    if player_device_path:
-                        self.media_player = self.bus.get('org.bluez',
-                                                         player_device_path)
-                    else:
-                        print("No player device path!")
-                except Exception as e:
-                    print(f"Couldn't get media player: {e}")
-                    return
-
-                other_player_properties = self.media_player.GetAll(
-                    'org.bluez.MediaPlayer1')
-                print("All media properties:", other_player_properties)
-
-                # Get the current song information
-                current_track = self.media_player.Get('org.bluez.MediaPlayer1',
-                                                      'Track')
-                if current_track:
-                    print("Initial track:", current_track)
-                    self.update_label_with_track_info(current_track)
-
-                self.media_player_properties_subscription = (
-                    self.media_player.PropertiesChanged.connect(
-                        self.on_player_properties_change)
-                    )
-
-                transport_device_path = find_media_transport_path(
-                    self.bus, self.bt_mac_address)
-
-                try:
-                    if transport_device_path:
-                        self.media_transport = self.bus.get(
-                            'org.bluez', transport_device_path)
-                    else:
-                        print("No transport device path!")
-                except Exception as e:
-                    print(f"Couldn't get media transport: {e}")
-
-                other_transport_properties = self.media_transport.GetAll(
-                    'org.bluez.MediaTransport1')
-                print("All transport properties:", other_transport_properties)
-
-                current_state = self.media_transport.Get(
-                    'org.bluez.MediaTransport1', 'State')
-
-                if current_state:
-                    print("Initial state:", current_state)
-                    if current_state == "idle":
-                        self.trackIsPlaying = False
-                        self.playPauseButton.setText("|>")
-                    elif current_state == "active":
-                        self.trackIsPlaying = False
-                        self.playPauseButton.setText("||")
-
-                self.media_transport_properties_subscription = (
-                    self.media_transport.PropertiesChanged.connect(
-                        self.on_transport_change)
-                    )
-
-                self.specific_listener_active = True
-            else:
-                print("No connected Bluetooth device found.")
-                self.scrolling_label.update_text("No media device connected")
-                setup_general_device_listener(self.bus, self)
+        # Track progress, timed locally between the phone's updates.
+        self.progress_bar = ProgressBar()
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.progress_bar)
+        self.progressBarPlaceholder.setLayout(layout)
+        # device path -> PlaybackClock
+        self.playback_clocks = {}
+
+        # Coalesces media PropertiesChanged signals into one update per
+        # frame holding only what changed.
+        self.dispatcher = PropertyDispatcher(
+            frame_interval=round(1000 / self.label_frame_rate))
+        self.dispatcher.propertiesChanged.connect(
+            self.on_properties_dispatched)
+
+        # Track metadata and album art, see show_track_art().
+        self.artwork = ArtworkCache()
+        self.artwork.artReady.connect(self.on_art_ready)
+        self._art_key = None
+
+        # Heaters. DASHBOARD_HEATER picks the driver: "sysfs", "gpiod" or
+        # "fake" (the default, for running away from the car). The buttons
+        # only change settings; the controller's own thread does the I/O.
+        self.heater = HeaterController(create_heater_driver(
+            os.environ.get("DASHBOARD_HEATER", "fake")))
+        log.info("Using %s heater driver.", self.heater.driver.name)
+        # The last state the dashboard was in, see snapshot.py.
+        self.snapshot = StateSnapshot()
+        self.restore_heater_settings()
+        self.heater.start()
+
+        # GPS speed. DASHBOARD_GPS names the source, see open_gps_source().
+        gps_source = os.environ.get("DASHBOARD_GPS")
+        if gps_source:
+            try:
+                from gps import GpsThread, open_gps_source
+                from triplog import TripLog
+                self.trip_log = TripLog()
+                self.gps_thread = GpsThread(open_gps_source(gps_source),
+                                            max_rate=self.speed_refresh_rate)
+                self.gps_thread.speedChanged.connect(self.update_speed_label)
+                self.gps_thread.fixLost.connect(self.clear_speed_label)
+                self.gps_thread.fixChanged.connect(self.on_gps_fix)
+                self.gps_thread.start()
+            except Exception as e:
+                log.error("Couldn't start GPS from %s: %s", gps_source, e)
 
-            print("handle_new_connection() called")
+        # Engine data. DASHBOARD_TELEMETRY names the source, see
+        # open_telemetry_source().
+        self.engine_values = {}
+        telemetry_source = os.environ.get("DASHBOARD_TELEMETRY")
+        if telemetry_source:
+            try:
+                from telemetry import TelemetryThread, open_telemetry_source
+                self.telemetry_thread = TelemetryThread(
+                    open_telemetry_source(telemetry_source),
+                    max_rate=self.engine_refresh_rate)
+                self.telemetry_thread.valuesChanged.connect(
+                    self.on_telemetry)
+                self.telemetry_thread.start()
+            except Exception as e:
+                log.error("Couldn't start telemetry from %s: %s",
+                          telemetry_source, e)
 
-        except Exception as e:
-            print(f"An error occurred in handle_new_connection(): {e}")
+        # Speed-dependent EQ. DASHBOARD_DSP names the ALSA device the
+        # phone's audio comes from, DASHBOARD_DSP_OUTPUT the one it goes to.
+        dsp_capture = os.environ.get("DASHBOARD_DSP")
+        if dsp_capture:
+            try:
+                from dsp import AudioDsp
+                self.dsp = AudioDsp(dsp_capture, os.environ.get(
+                    "DASHBOARD_DSP_OUTPUT", "default"))
+                self.dsp.start()
+            except Exception as e:
+                log.error("Couldn't start the EQ on %s: %s", dsp_capture, e)
+
+        # dbus init. The bus connection and the BlueZ object index are made
+        # on a thread once the first frame is up, and the rest is set up in
+        # on_bus_connected().
+        self.backend = backend or create_backend()
+        self.bus_connect_thread = BusConnectThread(self.backend, bus)
+        # A bus passed in delivers its own signals.
+        self._start_backend = bus is None
+        self.bus_connect_thread.connected.connect(self.on_bus_connected)
+        self.bus_connect_thread.failed.connect(self.on_bus_failed)
+        self.show_snapshot()
+        startup.mark("widgets")
+
+    # The form's central widget becomes the Media page. The other pages are
+    # built the first time they are shown, see pages.py.
+    def setup_pages(self):
+        media = self.takeCentralWidget()
+        self.pages = PageStack()
+        page = Page("Media")
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(media)
+        page.setLayout(layout)
+        self.pages.add_page(page)
+        self.pages.add_page(Page("Climate", self.build_climate_page))
+        self.pages.add_page(Page("Speed", self.build_speed_page))
+        self.pages.add_page(Page("Map", self.build_map_page))
+        self.pages.add_page(Page("Diagnostics",
+                                 self.build_diagnostics_page))
+        self.setCentralWidget(self.pages)
+
+        self.frame_overlay = FrameTimeOverlay(self.pages, self)
+        self.frame_overlay.setVisible(
+            bool(os.environ.get("DASHBOARD_FRAME_OVERLAY")))
+
+    def build_climate_page(self, page):
+        load_ui("climate.ui", page)
+        self.climate = page
+        page.fanButton.clicked.connect(self.fanButton_clicked)
+        page.leftSeatButton.clicked.connect(
+            partial(self.seatButton_clicked, SEAT_LEFT))
+        page.rightSeatButton.clicked.connect(
+            partial(self.seatButton_clicked, SEAT_RIGHT))
+        page.cabinDownButton.clicked.connect(self.cabinDownButton_clicked)
+        page.cabinUpButton.clicked.connect(self.cabinUpButton_clicked)
+        self.show_heater_settings()
+
+    def build_speed_page(self, page):
+        self.speed_page_label = QLabel(self.speedLabel.text())
+        self.speed_page_label.setAlignment(Qt.AlignCenter)
+        font = self.speed_page_label.font()
+        font.setPointSize(96)
+        self.speed_page_label.setFont(font)
+        self.engine_label = QLabel(self.engine_text())
+        self.engine_label.setAlignment(Qt.AlignCenter)
+        font = self.engine_label.font()
+        font.setPointSize(28)
+        self.engine_label.setFont(font)
+        layout = QVBoxLayout()
+        layout.addWidget(self.speed_page_label)
+        layout.addWidget(self.engine_label)
+        if self.trip_log is not None:
+            self.trip_label = QLabel()
+            self.trip_label.setAlignment(Qt.AlignCenter)
+            layout.addWidget(self.trip_label)
+            timer = QTimer(page)
+            timer.setInterval(TRIP_REFRESH_INTERVAL)
+            timer.timeout.connect(self.update_trip_label)
+            page.add_timer(timer)
+            self.update_trip_label()
+        page.setLayout(layout)
+
+    # The offline map from DASHBOARD_MBTILES, see maps.py. It starts at the
+    # last position in the snapshot until GPS has a fix.
+    def build_map_page(self, page):
+        from maps import TileLoader, MapWidget, default_path
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        page.setLayout(layout)
+        self.map_widget = MapWidget(TileLoader(default_path()))
+        layout.addWidget(self.map_widget)
+        last = self.snapshot.get('gps')
+        if isinstance(last, dict) and last.get('latitude') is not None:
+            self.map_widget.set_position(
+                last['latitude'], last['longitude'], last.get('course'),
+                last.get('speed_kmh'))
+
+    def build_diagnostics_page(self, page):
+        self.diagnostics_label = QLabel()
+        self.diagnostics_label.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        font = self.diagnostics_label.font()
+        font.setFamily("monospace")
+        self.diagnostics_label.setFont(font)
+        overlay_button = QPushButton("Frame times")
+        overlay_button.setCheckable(True)
+        overlay_button.setChecked(self.frame_overlay.isVisible())
+        overlay_button.toggled.connect(self.frame_overlay.setVisible)
+        layout = QVBoxLayout()
+        layout.addWidget(self.diagnostics_label, 1)
+        layout.addWidget(overlay_button)
+        page.setLayout(layout)
+
+        # Refreshed only while the page is on screen.
+        timer = QTimer(page)
+        timer.setInterval(1000)
+        timer.timeout.connect(self.update_diagnostics)
+        page.add_timer(timer)
+        self.update_diagnostics()
+
+    def update_diagnostics(self):
+        lines = [f"Start up: {startup.report()}", ""]
+        for name, values in sorted(metrics.snapshot().items()):
+            if name == 'counters':
+                continue
+            lines.append(f"{name:<36} {values['count']:>7}  "
+                         f"p50 {values['p50_ms']:8.2f} ms  "
+                         f"p99 {values['p99_ms']:8.2f} ms")
+        stats = self.dispatcher.stats()
+        lines.append("")
+        lines.append(f"D-Bus signals {stats['signals_received']}, "
+                     f"redundant {stats['signals_dropped']}, "
+                     f"UI updates {stats['ui_updates_applied']}")
+        lines.append(f"Presses confirmed {self.intents.confirmed}, "
+                     f"rolled back {self.intents.rolled_back}, "
+                     f"superseded {self.intents.superseded}, "
+                     f"stale echoes dropped {self.intents.dropped}")
+        if self.reconnect is not None:
+            reconnect = self.reconnect.reconnect_stats()
+            lines.append(f"Reconnect attempts {self.reconnect.attempts}" + (
+                f", {reconnect['count']} reconnects, p50 "
+                f"{reconnect['p50_ms']:.0f} ms, max "
+                f"{reconnect['max_ms']:.0f} ms" if reconnect else ""))
+        if self.telemetry_thread is not None:
+            decoder = self.telemetry_thread.decoder
+            lines.append(f"CAN frames {decoder.frames_decoded}, "
+                         f"samples {decoder.samples_decoded}, "
+                         f"decoding {self.telemetry_thread.decode_time:.2f} s")
+            lines.append("  ".join(f"{name} {value:.1f}" for name, value
+                                   in sorted(self.engine_values.items())))
+        if self.dsp is not None:
+            gain, bass, treble = self.dsp.equalizer.compensation_db()
+            lines.append(f"EQ blocks {self.dsp.blocks}, overruns "
+                         f"{self.dsp.overruns}, clipped "
+                         f"{self.dsp.equalizer.clipped_blocks}, worst "
+                         f"{self.dsp.worst_block * 1000:.2f} ms, gain "
+                         f"{gain:+.1f} dB, bass {bass:+.1f} dB, treble "
+                         f"{treble:+.1f} dB")
+        self.diagnostics_label.setText("\n".join(lines))
+
+    # Times every frame the window paints: Qt paints all the widgets that
+    # need it while handling one UpdateRequest on the window.
+    def event(self, event):
+        if event.type() != QEvent.UpdateRequest or self.pages is None:
+            return super(GUI, self).event(event)
+        started = time.perf_counter()
+        result = super(GUI, self).event(event)
+        finished = time.perf_counter()
+        metrics.record("frame", finished - started)
+        self.frame_overlay.frame_painted(finished - started)
+        self.pages.frame_painted(finished)
+        if self.intents is not None:
+            self.intents.frame_painted(finished)
+        return result
+
+    def resizeEvent(self, event):
+        super(GUI, self).resizeEvent(event)
+        if self.pages is None:
+            return
+        self.frame_overlay.move(self.width() - self.frame_overlay.width(),
+                                self.menuBar().height())
 
-    # According to dbus spec there is nothing we need to do with the bus
-    # object(?)
-    def handle_disconnection(self):
+    # The first paint of the window ends start up proper.
+    def paintEvent(self, event):
+        super(GUI, self).paintEvent(event)
+        if self.first_frame_painted:
+            return
+        self.first_frame_painted = True
+        startup.mark("first_frame")
+        log.info("First frame after %s", startup.report())
+
+        budget = float(os.environ.get("DASHBOARD_STARTUP_BUDGET",
+                                      STARTUP_BUDGET))
+        if startup.elapsed() * 1000 > budget:
+            log.warning("Start up took longer than the %.0f ms budget",
+                        budget)
+
+        # Let the frame reach the screen before starting on D-Bus.
+        QTimer.singleShot(0, self.bus_connect_thread.start)
+
+    # Runs on the GUI thread once the bus and BlueZ object index (one
+    # GetManagedObjects() call, kept current from signals) are ready.
+    def on_bus_connected(self, bus, bluez_index):
+        self.bus = bus
+        self.bluez_index = bluez_index
         try:
-            # Set a flag to ignore the PropertiesChanged signal
-            self.ignore_properties_changed = True
+            # All blocking media calls happen on this thread.
+            self.media_worker = MediaControlWorker(
+                self.bus, self.on_player_properties_change,
+                self.on_transport_change)
+            self.media_worker.commandFinished.connect(
+                self.on_media_command_finished)
+            self.media_worker.playerPropertiesLoaded.connect(
+                self.on_player_properties_loaded)
+            self.media_worker.transportPropertiesLoaded.connect(
+                self.on_transport_properties_loaded)
+            self.media_worker.start()
+
+            # Phone-side volume, used while the transport has a Volume
+            # property.
+            self.transport_mixer = TransportMixer(self.media_worker)
+
+            # Connection state machine. It hears about devices connecting
+            # and disconnecting through on_bluez_object_event() and reports
+            # back through on_connection_state_changed() and, when the
+            # phone on screen changes, on_active_device_changed().
+            self.connection = ConnectionManager(
+                self.bluez_index, self.media_worker,
+                media_ready_timeout=self.media_ready_timeout)
+            self.connection.stateChanged.connect(
+                self.on_connection_state_changed)
+            self.connection.activeDeviceChanged.connect(
+                self.on_active_device_changed)
+            self.bluez_index.add_listener(self.on_bluez_object_event)
+            self.connection.start()
+
+            # Asks the phones we know to connect rather than waiting for
+            # them, see reconnect.py.
+            self.reconnect = ReconnectScheduler(
+                self.bus, self.bluez_index, self.snapshot.get('devices', ()))
+            self.reconnect.devicesChanged.connect(self.remember_devices)
+            self.reconnect.start()
+
+        except Exception:
+            log.exception("An error occurred setting up Bluetooth")
+
+        # Now we are set up signals can start coming in.
+        if self._start_backend:
+            self.backend.start()
+        startup.mark("bluetooth")
+        log.info("Bluetooth ready after %s", startup.report())
+
+    def on_bus_failed(self, error):
+        log.error("Couldn't connect to D-Bus: %s", error)
+
+    def closeEvent(self, event):
+        if self.reconnect is not None:
+            self.reconnect.close()
+        # On the asyncio backend the threads below may be waiting on calls
+        # that need this thread, so the bus goes first.
+        if self._start_backend:
+            self.backend.stop()
+        # Don't set Bluetooth up on the way out.
+        self.bus_connect_thread.wait()
+        self.bus_connect_thread.connected.disconnect()
+        self.mixer.close()
+        if self.transport_mixer is not None:
+            self.transport_mixer.close()
+        if self.media_worker is not None:
+            self.media_worker.stop()
+            self.media_worker.wait()
+        if self.gps_thread is not None:
+            self.gps_thread.stop()
+            self.gps_thread.wait()
+        if self.trip_log is not None:
+            self.trip_log.close()
+        if self.telemetry_thread is not None:
+            self.telemetry_thread.stop()
+            self.telemetry_thread.wait()
+        if self.map_widget is not None:
+            self.map_widget.close_loader()
+        if self.dsp is not None:
+            self.dsp.stop()
+        self.heater.stop()
+        self.artwork.close()
+        self.snapshot.close()
+        if isinstance(getattr(self, 'bus', None), RecordingBus):
+            self.bus.close()
+        super(GUI, self).closeEvent(event)
+
+    # Called by the BlueZ object index on the GLib thread for every object
+    # added, removed or changed.
+    def on_bluez_object_event(self, event, path, interfaces):
+        if DEVICE_INTERFACE not in interfaces:
+            return
 
+        # A device can also appear already connected, so "added" is
+        # treated like a property change.
+        if event in ("changed", "added"):
+            on_device_property_changed(
+                self, DEVICE_INTERFACE, interfaces[DEVICE_INTERFACE],
+                path=path)
+        elif event == "removed":
+            self.connection.device_disconnected(path)
+
+    # Runs on the GUI thread for every connection state change of every
+    # device.
+    def on_connection_state_changed(self, state, device_path):
+        if state == TEARING_DOWN:
+            # A reconnect must show everything afresh.
+            self.dispatcher.reset(device_path)
+            self.intents.forget(device_path)
+            self.artwork.device_disconnected(device_path)
+            self.playback_clocks.pop(device_path, None)
+
+    # Runs on the GUI thread when another phone becomes the one shown and
+    # controlled. Everything needed to draw it is already known, so this
+    # makes no D-Bus calls.
+    def on_active_device_changed(self, device_path):
+        if device_path is None:
             # No track playing if no device connected
             self.trackIsPlaying = False
+            self.transport_has_volume = False
 
             # Reset UI elements
             self.scrolling_label.update_text("No media device connected")
             self.playPauseButton.setText("|>")
+            self.show_volume(None)
+            self._art_key = None
+            self.albumArtLabel.clear()
+            self.progress_bar.set_clock(None)
+            return
 
-            # Reset any internal state variables
-            self.bt_mac_address = None
-            self.media_player = None
-            self.media_transport = None
-
-            # Clear up listeners so that when new devices connect
-            # we don't have more than one listener for media and transport
-            # active.
-            # Note: self.device_properties_subscription must remain connected
-            # to listen for new Bluetooth devices.
-            if self.media_player_properties_subscription:
-                self.media_player_properties_subscription.disconnect()
-            if self.media_transport_properties_subscription:
-                self.media_transport_properties_subscription.disconnect()
-            # if self.device_properties_subscription:
-                # self.device_properties_subscription.disconnect()
-
-            print("handle_disconnection() called")
-
-        except Exception as e:
-            print(f"An error occurred in handle_disconnection(): {e}")
+        state = self.dispatcher.state(device_path)
+        player = state.get(PLAYER_INTERFACE, {})
+        transport = state.get(TRANSPORT_INTERFACE, {})
+        self.transport_has_volume = 'Volume' in transport
+        self.show_volume(transport.get('Volume'))
+
+        # A phone that has just reconnected has nothing in the dispatcher
+        # yet; draw what it was playing last time until it has been read.
+        # Before the ignition cycle, that comes from the snapshot.
+        remembered = self.snapshot.get('device_path') == device_path
+        track = player.get('Track') or self.artwork.last_track(device_path)
+        if not track and remembered:
+            track = self.snapshot.get('track')
+        self.snapshot.update(device_path=device_path)
+        if track:
+            self.update_label_with_track_info(track)
+            self.show_track_art(device_path, track)
+        else:
+            # Shown until the phone's properties have been read.
+            self.scrolling_label.update_text("Connecting...")
+            self._art_key = None
+            self.albumArtLabel.clear()
+
+        status = player.get('Status')
+        if status is None and not transport and remembered:
+            status = self.snapshot.get('status')
+        if status == "playing" or transport.get('State') == "active":
+            self.handleMPStatusChange("playing")
+        else:
+            self.handleMPStatusChange("paused")
+        # The clock has kept time while the phone was in the background.
+        self.progress_bar.set_clock(self.playback_clocks.get(device_path))
+
+    # Paints the snapshot's track and play status before D-Bus is up.
+    # BlueZ confirms or corrects it in on_active_device_changed().
+    def show_snapshot(self):
+        device_path = self.snapshot.get('device_path')
+        track = self.snapshot.get('track')
+        if not device_path or not isinstance(track, dict):
+            return
+        log.info("Resuming with %s on %s", track.get('Title'), device_path)
+        self.update_label_with_track_info(track)
+        self.show_track_art(device_path, track)
+        self.handleMPStatusChange(self.snapshot.get('status'))
+
+    # Keeps the active phone's media state in the snapshot. player and
+    # transport are properties as loaded or changed.
+    def remember_devices(self, device_paths):
+        self.snapshot.update(devices=device_paths)
+
+    def remember_media_state(self, device_path, player=None,
+                             transport=None):
+        values = {}
+        if player:
+            if 'Track' in player:
+                values['track'] = player['Track']
+            if 'Status' in player:
+                values['status'] = player['Status']
+        if transport and 'Volume' in transport:
+            values['volume'] = transport['Volume']
+        if self.bluez_index is not None:
+            values['player_path'] = self.bluez_index.player_path(device_path)
+            values['transport_path'] = self.bluez_index.transport_path(
+                device_path)
+        self.snapshot.update(**values)
 
     def handleMPStatusChange(self, status_info):
         if status_info == "playing":
@@ -506,53 +870,99 @@ class GUI(QMainWindow):
             self.trackIsPlaying = False
             self.playPauseButton.setText("|>")
 
-    def on_player_properties_change(self, *args, **kwargs):
-        if self.ignore_properties_changed:
+    # MediaPlayer1 and MediaTransport1 PropertiesChanged handlers for every
+    # connected phone. These run on the GLib thread and only hand the
+    # properties to the dispatcher, which passes real changes on to
+    # on_properties_dispatched() once per frame, and tell the connection
+    # manager which phones are playing.
+    def on_player_properties_change(self, device_path, *args, **kwargs):
+        # Signals can still be in flight from a player we have let go of.
+        if self.connection is None or \
+                self.connection.session_state(device_path) != READY:
             return
-        print("Media properties changed:", args, kwargs)
 
         if len(args) < 2 or not isinstance(args[1], dict):
-            print("Invalid arguments received.")
+            log.warning("Invalid arguments received.")
             return
 
-        properties = args[1]
-        self.handle_track_change(properties.get('Track', {}))
-        self.handle_status_change(properties.get('Status'))
+        if 'Status' in args[1]:
+            self.connection.playback_changed(
+                device_path, args[1]['Status'] == "playing")
+        self.dispatcher.push(device_path, PLAYER_INTERFACE, args[1])
 
-    def handle_track_change(self, track_info):
-        if not isinstance(track_info, dict):
+    def on_transport_change(self, device_path, *args, **kwargs):
+        if self.connection is None or \
+                self.connection.session_state(device_path) != READY:
             return
 
-        title = track_info.get('Title', "Unknown")
-        artist = track_info.get('Artist', "Unknown")
-
-        if title != "Unknown" or artist != "Unknown":
-            song_info = f"{title} - {artist}     "
-            self.trackChanged.emit(song_info)
-
-    def handle_status_change(self, status_info):
-        if not status_info:
+        if len(args) < 2 or not isinstance(args[1], dict):
             return
 
-        if status_info in ["playing", "paused"]:
-            self.mediaPlayerStatusChanged.emit(status_info)
+        if 'State' in args[1]:
+            self.connection.playback_changed(
+                device_path, args[1]['State'] == "active")
+        self.dispatcher.push(device_path, TRANSPORT_INTERFACE, args[1])
 
-    def on_transport_change(self, *args, **kwargs):
-        # Extract the 'State' property from the arguments.
-        state = args[1].get('State', None) if len(args) > 1 else None
+    # Runs on the GUI thread with only the properties that changed.
+    def on_properties_dispatched(self, device_path, changes, received_at):
+        player_changes = changes.get(PLAYER_INTERFACE, {})
+        resynced = self.update_playback_clock(device_path, player_changes)
+        if device_path != self.connection.device_path:
+            return
+        self.remember_media_state(device_path, player_changes,
+                                  changes.get(TRANSPORT_INTERFACE))
+
+        if resynced:
+            self.progress_bar.clock_changed()
+        if 'Track' in player_changes and self.intents.reconcile(
+                device_path, TRACK, player_changes['Track']):
+            self._track_received_at = received_at
+            self.handle_track_change(player_changes['Track'])
+            self._track_received_at = None
+            self.show_track_art(device_path, player_changes['Track'])
+        self.handle_status_change(player_changes.get('Status'), device_path)
+
+        transport_changes = changes.get(TRANSPORT_INTERFACE, {})
+        if 'Volume' in transport_changes and self.intents.reconcile(
+                device_path, VOLUME, transport_changes['Volume']):
+            self.show_volume(transport_changes['Volume'])
+
+        # Extract the 'State' property of the transport.
+        state = transport_changes.get('State')
 
         if state is not None:
-            print(f"Transport state changed to: {state}")  # For debugging
+            log.debug("Transport state changed to: %s", state)
 
             if state == "active":
                 # Do the same thing as when the media player status
                 # is "playing".
-                self.mediaPlayerStatusChanged.emit("playing")
+                self.handle_status_change("playing", device_path)
 
             elif state == "idle":
                 # Do the same thing as when the media player status
                 # is "paused".
-                self.mediaPlayerStatusChanged.emit("paused")
+                self.handle_status_change("paused", device_path)
+
+    def handle_track_change(self, track_info):
+        if not isinstance(track_info, dict):
+            return
+
+        title = track_info.get('Title', "Unknown")
+        artist = track_info.get('Artist', "Unknown")
+
+        if title != "Unknown" or artist != "Unknown":
+            song_info = f"{title} - {artist}     "
+            self.trackChanged.emit(song_info)
+
+    # A status BlueZ reported; it is not shown while a press that expects
+    # something else is pending.
+    def handle_status_change(self, status_info, device_path):
+        if not status_info:
+            return
+
+        if status_info in ["playing", "paused"] and \
+                self.intents.reconcile(device_path, STATUS, status_info):
+            self.mediaPlayerStatusChanged.emit(status_info)
 
     def update_label_with_track_info(self, track_info):
         song_info = "Unknown (waiting on device for info)"
@@ -568,55 +978,377 @@ class GUI(QMainWindow):
         self.trackChanged.emit(song_info)
 
     def update_song_label(self, new_song):
-        self.scrolling_label.update_text(f"{new_song}")
+        self.scrolling_label.update_text(f"{new_song}",
+                                         self._track_received_at)
+
+    # Records the track in the metadata cache and shows its art: at once
+    # if it is in memory, otherwise once on_art_ready() hears back.
+    def show_track_art(self, device_path, track):
+        if not isinstance(track, dict):
+            return
+        key = track_key(device_path, track)
+        if key != self._art_key:
+            self._art_key = key
+            self.albumArtLabel.clear()
+        obex_port = self.dispatcher.state(device_path).get(
+            PLAYER_INTERFACE, {}).get('ObexPort')
+        self.artwork.track_changed(device_path, track, obex_port)
+
+    def on_art_ready(self, key, pixmap):
+        if key != self._art_key:
+            return  # The track has changed since
+        if pixmap is None:
+            self.albumArtLabel.clear()
+        else:
+            self.albumArtLabel.setPixmap(pixmap)
+
+    # Feeds a phone's Position, Track and Status to its playback clock.
+    # Returns True if the clock had to be moved, i.e. on a new track, a
+    # seek or a change of status.
+    def update_playback_clock(self, device_path, player):
+        if not any(name in player for name in
+                   ('Position', 'Track', 'Status')):
+            return False
+        clock = self.playback_clocks.get(device_path)
+        if clock is None:
+            clock = self.playback_clocks[device_path] = PlaybackClock()
+        track = player.get('Track')
+        duration = key = None
+        if isinstance(track, dict):
+            duration = int(track.get('Duration', 0) or 0)
+            key = track_key(device_path, track)
+        position = player.get('Position')
+        return clock.update(
+            position=None if position is None else int(position),
+            duration=duration, status=player.get('Status'), track=key)
+
+    def on_gps_fix(self, fix):
+        now = time.time()
+        if self.map_widget is not None:
+            self.map_widget.set_position(fix.latitude, fix.longitude,
+                                         fix.course, fix.speed_kmh)
+        if self.trip_log is not None:
+            self.trip_log.append(fix.latitude, fix.longitude, fix.speed_kmh,
+                                 rpm=self.engine_values.get('rpm'),
+                                 coolant_c=self.engine_values.get('coolant_c'),
+                                 now=now)
+        last = self.snapshot.get('gps')
+        if last and now - last.get('time', 0) < SNAPSHOT_GPS_INTERVAL:
+            return
+        self.snapshot.update(gps={
+            'latitude': fix.latitude, 'longitude': fix.longitude,
+            'speed_kmh': fix.speed_kmh, 'course': fix.course, 'time': now})
+
+    # The latest trip of the last day, from what the trip log has written
+    # so far.
+    def update_trip_label(self):
+        from triplog import TripReader
+        try:
+            reader = TripReader(self.trip_log.directory)
+            trips = reader.trips(start=time.time() - 86400)
+            reader.close()
+        except (OSError, ValueError) as e:
+            log.warning("Couldn't read the trip log: %s", e)
+            return
+        if not trips:
+            self.trip_label.setText("No trip yet")
+            return
+        trip = trips[-1]
+        minutes = round(trip.drive_time / 60)
+        self.trip_label.setText(
+            f"Trip {trip.distance_km:.1f} km   "
+            f"{minutes // 60}:{minutes % 60:02d}"
+            f"   avg {round(trip.average_kmh)} km/h"
+            f"   top {round(trip.top_kmh)} km/h")
+
+    def update_speed_label(self, speed_kmh):
+        self.set_speed_text(f"{round(speed_kmh)} km/h")
+        if self.dsp is not None:
+            self.dsp.set_speed(speed_kmh)
+
+    def clear_speed_label(self):
+        self.set_speed_text("-- km/h")
+
+    # Latest engine values from the telemetry thread, already limited to
+    # engine_refresh_rate updates per second.
+    def on_telemetry(self, values):
+        self.engine_values.update(values)
+        if self.dsp is not None and 'speed_kmh' in values:
+            self.dsp.set_speed(values['speed_kmh'])
+        if self.engine_label is not None:
+            text = self.engine_text()
+            if text != self.engine_label.text():
+                self.engine_label.setText(text)
+
+    def engine_text(self):
+        rpm = self.engine_values.get('rpm')
+        coolant = self.engine_values.get('coolant_c')
+        return (f"{'--' if rpm is None else round(rpm)} rpm   "
+                f"{'--' if coolant is None else round(coolant)} \u00b0C")
+
+    def set_speed_text(self, text):
+        self.speedLabel.setText(text)
+        if self.speed_page_label is not None:
+            self.speed_page_label.setText(text)
+
+    # Initial properties fetched by the media worker after attach(), for
+    # any connected phone. These run on the GUI thread and only draw if the
+    # phone is the active one.
+    def on_player_properties_loaded(self, device_path, properties):
+        log.debug("All media properties: %s", properties)
+        self.dispatcher.seed(device_path, PLAYER_INTERFACE, properties)
+        if 'Status' in properties:
+            self.connection.playback_changed(
+                device_path, properties['Status'] == "playing")
+        self.update_playback_clock(device_path, properties)
+        if device_path != self.connection.device_path:
+            return
+        self.progress_bar.set_clock(self.playback_clocks.get(device_path))
+        self.remember_media_state(device_path, player=properties)
+
+        # Get the current song information to display song information
+        # on connect.
+        current_track = properties.get('Track')
+        if current_track:
+            log.info("Initial track: %s", current_track)
+            self.update_label_with_track_info(current_track)
+            self.show_track_art(device_path, current_track)
+
+    def on_transport_properties_loaded(self, device_path, properties):
+        log.debug("All transport properties: %s", properties)
+        self.dispatcher.seed(device_path, TRANSPORT_INTERFACE, properties)
+        if device_path != self.connection.device_path:
+            return
+        self.remember_media_state(device_path, transport=properties)
+
+        self.transport_has_volume = 'Volume' in properties
+        if self.transport_has_volume and self.intents.reconcile(
+                device_path, VOLUME, properties['Volume']):
+            self.show_volume(properties['Volume'])
+
+        current_state = properties.get('State')
+        if current_state:
+            log.info("Initial state: %s", current_state)
+            if current_state == "idle":
+                self.handle_status_change("paused", device_path)
+            elif current_state == "active":
+                self.handle_status_change("playing", device_path)
+
+    def on_media_command_finished(self, command, success, error):
+        if success:
+            log.debug("Media %s command sent.", command)
+            return
+        log.error("Failed to send %s command: %s", command, error)
+        # Undo what the press showed.
+        if command in (PLAY, PAUSE):
+            self.intents.failed(STATUS)
+        elif command in (NEXT, PREVIOUS):
+            self.intents.failed(TRACK)
+        else:
+            self.intents.failed(VOLUME)
 
+    # Puts back what BlueZ last reported when a press wasn't confirmed.
+    def on_intent_rolled_back(self, kind, device_path, value):
+        if self.connection is None or \
+                device_path != self.connection.device_path:
+            return
+        if kind == STATUS:
+            self.handleMPStatusChange(value or "paused")
+        elif kind == TRACK:
+            if value:
+                self.update_label_with_track_info(value)
+                self.show_track_art(device_path, value)
+            else:
+                self.scrolling_label.update_text("Nothing playing")
+        elif kind == VOLUME:
+            self.show_volume(value)
+
+    # Button presses only queue a command for the media worker, so they
+    # return immediately however slow the phone is to answer.
+    def send_media_command(self, command):
+        if self.media_worker is None:
+            log.warning("No media worker, ignoring %s command.", command)
+            return
+        self.media_worker.request(command)
+
+    # The button shows the new state at once; see optimistic.py.
     def playpause_track(self):
-        if self.trackIsPlaying:
-            try:
-                self.media_player.Pause()
-                print("Media pause command sent.")
-            except Exception as e:
-                print(f"Failed to send pause command: {e}")
-        elif not self.trackIsPlaying:
-            try:
-                self.media_player.Play()
-                print("Media play command sent.")
-            except Exception as e:
-                print(f"Failed to send play command: {e}")
+        pressed_at = time.perf_counter()
+        device_path = self.connection.device_path \
+            if self.connection is not None else None
+        if self.media_worker is None or device_path is None:
+            self.send_media_command(PAUSE if self.trackIsPlaying else PLAY)
+            return
+        shown = "playing" if self.trackIsPlaying else "paused"
+        wanted = "paused" if self.trackIsPlaying else "playing"
+        self.intents.press(STATUS, device_path, wanted, shown,
+                           pressed_at=pressed_at)
+        self.handleMPStatusChange(wanted)
+        self.send_media_command(PLAY if wanted == "playing" else PAUSE)
 
     def playPauseButton_clicked(self):
-        self.playPauseInitiatedByButton = True
         self.playpause_track()
 
+    # Shows that the track is changing until the phone says to what.
+    def skip_track(self, command):
+        pressed_at = time.perf_counter()
+        device_path = self.connection.device_path \
+            if self.connection is not None else None
+        if self.media_worker is not None and device_path is not None:
+            track = self.dispatcher.state(device_path).get(
+                PLAYER_INTERFACE, {}).get('Track')
+            key = track_key(device_path, track) \
+                if isinstance(track, dict) else None
+            self.intents.press(
+                TRACK, device_path, command, track,
+                matches=lambda new: not isinstance(new, dict) or
+                track_key(device_path, new) != key,
+                pressed_at=pressed_at)
+            self.scrolling_label.update_text(
+                "Next track..." if command == NEXT else "Previous track...")
+            self._art_key = None
+            self.albumArtLabel.clear()
+        self.send_media_command(command)
+
     def nextTrackButton_clicked(self):
-        try:
-            self.media_player.Next()
-            print("Next track command sent.")
-        except Exception as e:
-            print(f"Failed to send next track command: {e}")
+        self.skip_track(NEXT)
 
     def prevTrackButton_clicked(self):
-        try:
-            self.media_player.Previous()
-            print("Previous track command sent.")
-        except Exception as e:
-            print(f"Failed to send previous track command: {e}")
+        self.skip_track(PREVIOUS)
+
+    # Changes the phone-side volume when the phone supports it, otherwise
+    # the local Master control. The phone's volume is shown straight away.
+    def change_volume(self, percent):
+        if self.transport_has_volume and self.transport_mixer is not None:
+            pressed_at = time.perf_counter()
+            device_path = self.connection.device_path
+            reported = self.dispatcher.state(device_path).get(
+                TRANSPORT_INTERFACE, {}).get('Volume')
+            if reported is not None:
+                volume = max(0, min(TRANSPORT_VOLUME_MAX, round(
+                    self.intents.expected(VOLUME, reported) +
+                    percent * TRANSPORT_VOLUME_MAX / 100)))
+                self.intents.press(
+                    VOLUME, device_path, volume, reported,
+                    matches=lambda new: abs(new - volume) <=
+                    VOLUME_TOLERANCE,
+                    pressed_at=pressed_at)
+                self.show_volume(volume)
+            self.transport_mixer.change(percent)
+        else:
+            self.mixer.change(percent)
+
+    # Phone-side volume, 0-127, as a percentage; None hides it.
+    def show_volume(self, volume):
+        if volume is None:
+            self.volumeLabel.clear()
+        else:
+            self.volumeLabel.setText(
+                f"{round(volume * 100 / TRANSPORT_VOLUME_MAX)}%")
 
     def volDownButton_clicked(self):
-        subprocess.run(["amixer", "set", "Master", "--", "5%-"])
-        print("Volume decreased")
+        self.change_volume(-VOLUME_STEP)
+        log.debug("Volume decreased")
 
     def volUpButton_clicked(self):
-        subprocess.run(["amixer", "set", "Master", "--", "5%+"])
-        print("Volume increased")
+        self.change_volume(VOLUME_STEP)
+        log.debug("Volume increased")
+
+    def fanButton_clicked(self):
+        level = (self.heater.settings()['fan_level'] + 1) % FAN_LEVELS
+        self.heater.set_fan_level(level)
+        self.heater_settings_changed()
+
+    def seatButton_clicked(self, seat):
+        level = (self.heater.settings()['seat_levels'][seat] + 1) % \
+            SEAT_LEVELS
+        self.heater.set_seat_level(seat, level)
+        self.heater_settings_changed()
+
+    # Below the lowest target the cabin heater switches off.
+    def cabinDownButton_clicked(self):
+        target = self.heater.settings()['cabin_target']
+        if target is not None:
+            target -= CABIN_TARGET_STEP
+            if target < CABIN_TARGET_MIN:
+                target = None
+        self.set_cabin_target(target)
+
+    def cabinUpButton_clicked(self):
+        target = self.heater.settings()['cabin_target']
+        if target is None:
+            target = CABIN_DEFAULT_TARGET
+        else:
+            target = min(CABIN_TARGET_MAX, target + CABIN_TARGET_STEP)
+        self.set_cabin_target(target)
+
+    def set_cabin_target(self, target):
+        self.heater.set_cabin_target(target)
+        self.heater_settings_changed()
+
+    def heater_settings_changed(self):
+        self.snapshot.update(heater=self.heater.settings())
+        self.show_heater_settings()
+
+    def restore_heater_settings(self):
+        settings = self.snapshot.get('heater')
+        if not isinstance(settings, dict):
+            return
+        self.heater.set_fan_level(settings.get('fan_level', 0))
+        for seat, level in settings.get('seat_levels', {}).items():
+            if seat in (SEAT_LEFT, SEAT_RIGHT):
+                self.heater.set_seat_level(seat, level)
+        self.heater.set_cabin_target(settings.get('cabin_target'))
+
+    # Draws the heater settings on the Climate page, if it has been built.
+    def show_heater_settings(self):
+        if self.climate is None:
+            return
+        settings = self.heater.settings()
+        levels = settings['seat_levels']
+        self.climate.fanButton.setText(
+            f"Fan: {LEVEL_NAMES[settings['fan_level']]}")
+        self.climate.leftSeatButton.setText(
+            f"L Seat: {LEVEL_NAMES[levels[SEAT_LEFT]]}")
+        self.climate.rightSeatButton.setText(
+            f"R Seat: {LEVEL_NAMES[levels[SEAT_RIGHT]]}")
+        target = settings['cabin_target']
+        if target is None:
+            self.climate.cabinLabel.setText("Heat: Off")
+        else:
+            self.climate.cabinLabel.setText(f"Heat: {target:.0f}\u00b0C")
 
 
 def main():
+    setup_logging()
+    startup.mark("imports")
+    try:
+        backend = create_backend()
+    except ValueError as e:
+        log.error("%s", e)
+        shutdown_logging()
+        return
+    log.info("Using the %s D-Bus backend.", backend.name)
+
+    metrics_server = MetricsServer()
+    try:
+        metrics_server.start()
+    except OSError as e:
+        log.warning("Couldn't open metrics socket %s: %s",
+                    metrics_server.path, e)
+        metrics_server = None
+
     app = QApplication([])
-    window = GUI()
+    backend.attach(app)
+    startup.mark("qapplication")
+    window = GUI(backend=backend)
 
     window.show()
-    app.exec_()
+    backend.exec(app)
+
+    if metrics_server is not None:
+        metrics_server.stop()
+    shutdown_logging()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,357 @@
+# Offline map.
+#
+# Tiles come from a local MBTiles file (SQLite, 256 px raster tiles in the
+# `tiles` table, rows numbered from the bottom as in TMS). TileLoader runs
+# a few worker threads, each with its own read-only SQLite connection, that
+# read and decode tiles into QImages. The GUI thread only turns a decoded
+# QImage into a QPixmap when it arrives (a copy, no decoding) and keeps the
+# pixmaps in an LRU cache, so MapWidget.paintEvent() does nothing but blit
+# cached pixmaps. A tile that isn't cached yet is drawn as a blank square
+# and requested.
+#
+# Requests are a priority list that each update replaces: the tiles on
+# screen first, then tiles along where the car will be over the next
+# PREFETCH_SECONDS at its current heading and speed, nearest first. Tiles
+# that are no longer wanted are dropped before a worker gets to them.
+#
+# The file is only opened by the workers, so a slow SD card doesn't hold up
+# building the page. If it can't be opened the loader stops and emits
+# failed(), and MapWidget says so instead of drawing blank tiles.
+
+import collections
+import logging
+import math
+import os
+import sqlite3
+import threading
+from PyQt5.QtCore import Qt, QObject, QPointF, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QPolygonF, QColor
+from PyQt5.QtWidgets import QWidget
+from diagnostics import metrics
+
+log = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+DEFAULT_ZOOM = 15
+# Decoded tiles kept, about 256 KB each.
+CACHE_TILES = 192
+# Worker threads reading and decoding tiles.
+WORKERS = 2
+# How far ahead to prefetch, in seconds of driving, and the step between
+# predicted positions.
+PREFETCH_SECONDS = 60.0
+PREFETCH_STEP = 5.0
+# Below this, in km/h, only the tiles on screen are fetched.
+PREFETCH_MIN_SPEED = 5.0
+
+
+def default_path():
+    data_home = os.environ.get(
+        "XDG_DATA_HOME",
+        os.path.join(os.path.expanduser("~"), ".local", "share"))
+    return os.environ.get(
+        "DASHBOARD_MBTILES",
+        os.path.join(data_home, "suzuki-lj-dashboard", "map.mbtiles"))
+
+
+# Fractional tile coordinates of a position at a zoom level (XYZ, y down).
+def tile_position(latitude, longitude, zoom):
+    scale = 1 << zoom
+    latitude = max(-85.0511, min(85.0511, latitude))
+    x = (longitude + 180.0) / 360.0 * scale
+    y = (1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 \
+        * scale
+    return x, y
+
+
+# Where the car will be after `seconds` at `course` degrees and `speed_kmh`.
+def project(latitude, longitude, course, speed_kmh, seconds):
+    distance = speed_kmh / 3.6 * seconds
+    bearing = math.radians(course)
+    latitude += distance * math.cos(bearing) / 111320.0
+    longitude += distance * math.sin(bearing) / \
+        (111320.0 * max(0.01, math.cos(math.radians(latitude))))
+    return latitude, longitude
+
+
+# Tiles (zoom, x, y) covering a width x height pixel view centred on tile
+# coordinates (x, y).
+def tiles_around(zoom, x, y, width, height):
+    half_x = width / 2 / TILE_SIZE
+    half_y = height / 2 / TILE_SIZE
+    limit = (1 << zoom) - 1
+    return [(zoom, column, row)
+            for row in range(max(0, math.floor(y - half_y)),
+                             min(limit, math.floor(y + half_y)) + 1)
+            for column in range(max(0, math.floor(x - half_x)),
+                                 min(limit, math.floor(x + half_x)) + 1)]
+
+
+class TileLoader(QObject):
+    # (zoom, x, y), QImage or None if the file has no such tile. Emitted on
+    # the loader's thread.
+    tileLoaded = pyqtSignal(object, object)
+    # The same, emitted on a worker thread.
+    _loaded = pyqtSignal(object, object)
+    # Why the file couldn't be opened. Emitted once, on the loader's
+    # thread.
+    failed = pyqtSignal(str)
+    # The same, emitted on a worker thread.
+    _failed = pyqtSignal(str)
+
+    def __init__(self, path, workers=WORKERS, parent=None):
+        super(TileLoader, self).__init__(parent)
+        self.path = path
+        self._condition = threading.Condition()
+        self._wanted = collections.OrderedDict()
+        self._loading = set()
+        self._running = True
+        self.loaded = 0
+        # Why the file couldn't be opened, once failed() has been emitted.
+        self.error = None
+        self._loaded.connect(self._deliver)
+        self._failed.connect(self._fail)
+        self._threads = [
+            threading.Thread(target=self._run, name=f"tiles-{i}",
+                             daemon=True)
+            for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    # Replaces what is wanted with `keys`, most wanted first.
+    def request(self, keys):
+        with self._condition:
+            self._wanted = collections.OrderedDict(
+                (key, None) for key in keys if key not in self._loading)
+            if self._wanted:
+                self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        connection = None
+        try:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro",
+                                         uri=True)
+            connection.execute("SELECT 1 FROM tiles LIMIT 1")
+        except sqlite3.Error as e:
+            if connection is not None:
+                connection.close()
+            # The first worker to fail stops the others and reports it.
+            with self._condition:
+                if not self._running:
+                    return
+                self._running = False
+                self._condition.notify_all()
+            log.error("Couldn't open the map %s: %s", self.path, e)
+            self._failed.emit(str(e))
+            return
+        try:
+            while True:
+                with self._condition:
+                    while self._running and not self._wanted:
+                        self._condition.wait()
+                    if not self._running:
+                        return
+                    key, _ = self._wanted.popitem(last=False)
+                    self._loading.add(key)
+                try:
+                    image = self._load(connection, key)
+                except sqlite3.Error as e:
+                    log.error("Couldn't read map tile %s: %s", key, e)
+                    image = None
+                self.loaded += 1
+                self._loaded.emit(key, image)
+        finally:
+            connection.close()
+
+    # A tile counts as loading, and isn't asked for again, until it has
+    # reached the loader's thread.
+    def _deliver(self, key, image):
+        with self._condition:
+            self._loading.discard(key)
+        self.tileLoaded.emit(key, image)
+
+    def _fail(self, message):
+        self.error = message
+        self.failed.emit(message)
+
+    def _load(self, connection, key):
+        zoom, x, y = key
+        with metrics.span("map.tile_load"):
+            row = connection.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND "
+                "tile_column = ? AND tile_row = ?",
+                (zoom, x, (1 << zoom) - 1 - y)).fetchone()
+            if row is None:
+                return None
+            image = QImage.fromData(row[0])
+            if image.isNull():
+                log.warning("Couldn't decode map tile %s", key)
+                return None
+            # The format the screen paints fastest, so that turning it into
+            # a pixmap on the GUI thread is a plain copy.
+            return image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+
+
+class MapWidget(QWidget):
+    def __init__(self, loader, zoom=DEFAULT_ZOOM, cache_tiles=CACHE_TILES,
+                 parent=None):
+        super(MapWidget, self).__init__(parent)
+        self._loader = loader
+        self._loader.tileLoaded.connect(self._on_tile_loaded)
+        self._loader.failed.connect(self._on_failed)
+        self.zoom = zoom
+        # Dragging pans the map rather than switching pages.
+        self.setProperty("handlesDrags", True)
+        self._cache = collections.OrderedDict()
+        self._cache_tiles = cache_tiles
+        # Tiles the file doesn't have.
+        self.missing = set()
+        # Last fix: (latitude, longitude, course, speed_kmh).
+        self._fix = None
+        # View centre in tile coordinates, and whether it follows the fix.
+        self._center = None
+        self.following = True
+        self._dragged_from = None
+        self.prefetch_seconds = PREFETCH_SECONDS
+        # Shown instead of the map if the loader couldn't open the file.
+        self.error = None
+        if loader.error is not None:
+            self._on_failed(loader.error)
+        # Tiles blitted and tiles drawn blank, for the benchmark.
+        self.hits = 0
+        self.misses = 0
+
+    def set_position(self, latitude, longitude, course=None, speed_kmh=None):
+        self._fix = (latitude, longitude, course, speed_kmh)
+        if self.following:
+            self._center = tile_position(latitude, longitude, self.zoom)
+        if self.isVisible():
+            self._request()
+            self.update()
+
+    def close_loader(self):
+        self._loader.close()
+
+    def recenter(self):
+        self.following = True
+        if self._fix is not None:
+            self.set_position(*self._fix)
+
+    # Tiles on screen, then tiles along the predicted route.
+    def wanted_tiles(self):
+        if self._center is None:
+            return []
+        keys = tiles_around(self.zoom, *self._center, self.width(),
+                            self.height())
+        if self._fix is not None and self.following:
+            latitude, longitude, course, speed_kmh = self._fix
+            if course is not None and speed_kmh and \
+                    speed_kmh >= PREFETCH_MIN_SPEED:
+                seconds = PREFETCH_STEP
+                while seconds <= self.prefetch_seconds:
+                    ahead = tile_position(
+                        *project(latitude, longitude, course, speed_kmh,
+                                 seconds), self.zoom)
+                    keys.extend(tiles_around(self.zoom, *ahead, self.width(),
+                                             self.height()))
+                    seconds += PREFETCH_STEP
+        seen = set()
+        return [key for key in keys if not (
+            key in seen or seen.add(key) or key in self._cache or
+            key in self.missing)]
+
+    def _request(self):
+        self._loader.request(self.wanted_tiles())
+
+    def _on_tile_loaded(self, key, image):
+        if image is None:
+            self.missing.add(key)
+            return
+        self._cache[key] = QPixmap.fromImage(image)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_tiles:
+            self._cache.popitem(last=False)
+        if key[0] == self.zoom and self.isVisible():
+            self.update()
+
+    def _on_failed(self, message):
+        self.error = f"No map at {self._loader.path}"
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(224, 224, 224))
+        if self.error is not None or self._center is None:
+            painter.drawText(self.rect(), Qt.AlignCenter,
+                             self.error or "No position")
+            painter.end()
+            return
+
+        center_x, center_y = self._center
+        origin_x = self.width() / 2 - center_x * TILE_SIZE
+        origin_y = self.height() / 2 - center_y * TILE_SIZE
+        for key in tiles_around(self.zoom, center_x, center_y, self.width(),
+                                self.height()):
+            pixmap = self._cache.get(key)
+            if pixmap is None:
+                self.misses += 1
+                continue
+            self.hits += 1
+            self._cache.move_to_end(key)
+            painter.drawPixmap(round(origin_x + key[1] * TILE_SIZE),
+                               round(origin_y + key[2] * TILE_SIZE), pixmap)
+
+        if self._fix is not None:
+            self._draw_marker(painter, origin_x, origin_y)
+        painter.end()
+
+    def _draw_marker(self, painter, origin_x, origin_y):
+        latitude, longitude, course, _ = self._fix
+        x, y = tile_position(latitude, longitude, self.zoom)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.translate(origin_x + x * TILE_SIZE, origin_y + y * TILE_SIZE)
+        painter.rotate(course or 0.0)
+        painter.setPen(Qt.white)
+        painter.setBrush(QColor(0, 102, 204))
+        painter.drawPolygon(QPolygonF([QPointF(0, -14), QPointF(9, 10),
+                                       QPointF(0, 5), QPointF(-9, 10)]))
+
+    def mousePressEvent(self, event):
+        self._dragged_from = event.pos()
+
+    def mouseMoveEvent(self, event):
+        if self._dragged_from is None or self._center is None:
+            return
+        delta = event.pos() - self._dragged_from
+        self._dragged_from = event.pos()
+        self.following = False
+        self._center = (self._center[0] - delta.x() / TILE_SIZE,
+                        self._center[1] - delta.y() / TILE_SIZE)
+        self._request()
+        self.update()
+
+    def mouseReleaseEvent(self, event):
+        self._dragged_from = None
+
+    def mouseDoubleClickEvent(self, event):
+        self.recenter()
+
+    def showEvent(self, event):
+        super(MapWidget, self).showEvent(event)
+        self._request()
+
+    def hideEvent(self, event):
+        super(MapWidget, self).hideEvent(event)
+        self._loader.request(())
+
+    def resizeEvent(self, event):
+        super(MapWidget, self).resizeEvent(event)
+        if self.isVisible():
+            self._request()
@@ -0,0 +1,319 @@
+# Media control worker.
+#
+# D-Bus proxy calls (Get, GetAll, Play, Next, ...) block until the phone
+# answers, which over AVRCP can take a long time. Making them from the Qt
+# thread freezes the touchscreen, so they all happen here instead. The
+# worker takes commands from a bounded queue and reports back through Qt
+# signals, which Qt delivers on the GUI thread.
+#
+# Every connected phone has a MediaSession, keyed by its Device1 object
+# path, holding its own MediaPlayer1/MediaTransport1 proxies and
+# PropertiesChanged subscriptions for as long as it stays connected. Button
+# commands go to the active session; activate() switches between sessions
+# without any D-Bus traffic.
+#
+# Repeated presses are coalesced while they wait in the queue: play/pause
+# requests collapse to the last one, and next/previous collapse into a
+# single net skip, so five quick taps of Next take one queue slot. Volume
+# steps for the transport are added together the same way.
+
+import collections
+import logging
+import threading
+from functools import partial
+from PyQt5.QtCore import QThread
+from PyQt5.QtCore import pyqtSignal
+from bluez_index import PLAYER_INTERFACE, TRANSPORT_INTERFACE
+from dbus_backend import get_all
+from diagnostics import metrics
+
+# Commands the buttons can send.
+PLAY = "play"
+PAUSE = "pause"
+NEXT = "next"
+PREVIOUS = "previous"
+
+# Internal commands.
+_SKIP = "skip"
+_VOLUME = "volume"
+_ATTACH = "attach"
+_DETACH = "detach"
+_STOP = "stop"
+
+# MediaTransport1.Volume runs from 0 to 127.
+TRANSPORT_VOLUME_MAX = 127
+
+log = logging.getLogger(__name__)
+
+
+# Proxies and subscriptions of one device. Only used on the worker thread.
+class MediaSession:
+    def __init__(self, device_path):
+        self.device_path = device_path
+        self.player = None
+        self.transport = None
+        self.subscriptions = []
+
+    def close(self):
+        for subscription in self.subscriptions:
+            try:
+                subscription.disconnect()
+            except Exception as e:
+                log.warning("Failed to disconnect media subscription: %s",
+                            e)
+        self.subscriptions = []
+        self.player = None
+        self.transport = None
+
+
+class MediaControlWorker(QThread):
+    # command, success, error message
+    commandFinished = pyqtSignal(str, bool, str)
+    # device path, GetAll() results, sent after attach()
+    playerPropertiesLoaded = pyqtSignal(object, object)
+    transportPropertiesLoaded = pyqtSignal(object, object)
+
+    # on_player_change and on_transport_change are called on the GLib
+    # thread as callback(device_path, interface, changed, invalidated).
+    def __init__(self, bus_object, on_player_change, on_transport_change,
+                 max_pending=8, parent=None):
+        super(MediaControlWorker, self).__init__(parent)
+        self._bus = bus_object
+        self._on_player_change = on_player_change
+        self._on_transport_change = on_transport_change
+        self._max_pending = max_pending
+
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+
+        # Device path button commands go to. Guarded by _condition.
+        self._active = None
+        # device path -> MediaSession. Only touched on the worker thread.
+        self._sessions = {}
+
+        # device path -> counter incremented by every attach()/detach() of
+        # that device, so that results of a superseded attach are not
+        # reported.
+        self._generations = collections.Counter()
+
+    # ---------- Called from any thread ----------
+
+    # Queues a button command. Returns False if the queue is full.
+    def request(self, command):
+        with self._condition:
+            if command in (NEXT, PREVIOUS):
+                step = 1 if command == NEXT else -1
+                last = self._pending[-1] if self._pending else None
+                if last is not None and last[0] == _SKIP:
+                    self._pending[-1] = (_SKIP, last[1] + step)
+                    if self._pending[-1][1] == 0:
+                        # Next followed by Previous cancels out.
+                        self._pending.pop()
+                    return True
+                entry = (_SKIP, step)
+            elif command in (PLAY, PAUSE):
+                entry = (command, None)
+                for i, pending in enumerate(self._pending):
+                    if pending[0] in (PLAY, PAUSE):
+                        # Only the latest play/pause intent matters, but it
+                        # goes after any skip pressed before it: phones
+                        # often start playing on a skip.
+                        del self._pending[i]
+                        self._pending.append(entry)
+                        self._condition.notify()
+                        return True
+            else:
+                raise ValueError(f"Unknown media command: {command}")
+
+            if len(self._pending) >= self._max_pending:
+                log.warning("Media command queue full, dropping %s", command)
+                return False
+
+            self._pending.append(entry)
+            self._condition.notify()
+            return True
+
+    # Queues a change of MediaTransport1.Volume by `steps` (0-127 scale).
+    def request_volume(self, steps):
+        with self._condition:
+            for i, pending in enumerate(self._pending):
+                if pending[0] == _VOLUME:
+                    self._pending[i] = (_VOLUME, pending[1] + steps)
+                    return True
+
+            if len(self._pending) >= self._max_pending:
+                log.warning("Media command queue full, dropping volume change")
+                return False
+
+            self._pending.append((_VOLUME, steps))
+            self._condition.notify()
+            return True
+
+    # Opens a session for a device's player/transport pair, replacing any
+    # the device already had. Either path may be None.
+    def attach(self, device_path, player_path, transport_path):
+        with self._condition:
+            self._generations[device_path] += 1
+            self._pending.append(
+                (_ATTACH, (device_path, self._generations[device_path],
+                           player_path, transport_path)))
+            self._condition.notify()
+
+    def detach(self, device_path):
+        with self._condition:
+            self._generations[device_path] += 1
+            self._pending.append((_DETACH, device_path))
+            self._condition.notify()
+
+    # Sends button commands to another device's session from now on.
+    # Pending commands were meant for the previous device and are dropped.
+    def activate(self, device_path):
+        with self._condition:
+            if device_path == self._active:
+                return
+            self._active = device_path
+            self._pending = collections.deque(
+                entry for entry in self._pending
+                if entry[0] in (_ATTACH, _DETACH, _STOP))
+
+    def stop(self):
+        with self._condition:
+            self._pending.clear()
+            self._pending.append((_STOP, None))
+            self._condition.notify()
+
+    # ---------- Worker thread ----------
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                command, argument = self._pending.popleft()
+
+            if command == _STOP:
+                for device_path in list(self._sessions):
+                    self._detach(device_path)
+                return
+
+            try:
+                if command == _ATTACH:
+                    self._attach(*argument)
+                elif command == _DETACH:
+                    self._detach(argument)
+                else:
+                    self._send(command, argument)
+            except Exception:
+                log.exception("An error occurred in the media worker")
+
+    def _attach(self, device_path, generation, player_path,
+                transport_path):
+        self._detach(device_path)
+        session = MediaSession(device_path)
+        self._sessions[device_path] = session
+
+        # Subscribe to both objects first, then read them together:
+        # backends that can send both GetAll() calls at once do.
+        requests = []
+        if player_path:
+            try:
+                session.player = self._bus.get('org.bluez', player_path)
+                session.subscriptions.append(
+                    session.player.PropertiesChanged.connect(
+                        partial(self._on_player_change, device_path)))
+                requests.append((session.player, PLAYER_INTERFACE,
+                                 self.playerPropertiesLoaded,
+                                 "media player"))
+            except Exception as e:
+                log.error("Couldn't get media player: %s", e)
+        else:
+            log.warning("No player device path!")
+
+        if transport_path:
+            try:
+                session.transport = self._bus.get('org.bluez',
+                                                  transport_path)
+                session.subscriptions.append(
+                    session.transport.PropertiesChanged.connect(
+                        partial(self._on_transport_change, device_path)))
+                requests.append((session.transport, TRANSPORT_INTERFACE,
+                                 self.transportPropertiesLoaded,
+                                 "media transport"))
+            except Exception as e:
+                log.error("Couldn't get media transport: %s", e)
+        else:
+            log.warning("No transport device path!")
+
+        results = get_all([(proxy, interface)
+                           for proxy, interface, _, _ in requests])
+        for (_, _, loaded, name), properties in zip(requests, results):
+            if isinstance(properties, Exception):
+                log.error("Couldn't get %s: %s", name, properties)
+            elif self._is_current(device_path, generation):
+                loaded.emit(device_path, properties)
+
+    # Clear up listeners so that when a device reconnects we don't have
+    # more than one listener for its media and transport active.
+    def _detach(self, device_path):
+        session = self._sessions.pop(device_path, None)
+        if session is not None:
+            session.close()
+
+    def _active_session(self):
+        with self._condition:
+            return self._sessions.get(self._active)
+
+    def _send(self, command, argument):
+        if command == _VOLUME:
+            self._set_volume(argument)
+            return
+
+        session = self._active_session()
+        if session is None or session.player is None:
+            self.commandFinished.emit(command, False, "No media player")
+            return
+        player = session.player
+
+        name = command
+        try:
+            if command == PLAY:
+                with metrics.span("dbus.MediaPlayer1.Play"):
+                    player.Play()
+            elif command == PAUSE:
+                with metrics.span("dbus.MediaPlayer1.Pause"):
+                    player.Pause()
+            elif command == _SKIP:
+                name = NEXT if argument > 0 else PREVIOUS
+                for _ in range(abs(argument)):
+                    if argument > 0:
+                        with metrics.span("dbus.MediaPlayer1.Next"):
+                            player.Next()
+                    else:
+                        with metrics.span("dbus.MediaPlayer1.Previous"):
+                            player.Previous()
+        except Exception as e:
+            self.commandFinished.emit(name, False, str(e))
+            return
+
+        self.commandFinished.emit(name, True, "")
+
+    def _set_volume(self, steps):
+        session = self._active_session()
+        if session is None or session.transport is None:
+            self.commandFinished.emit(_VOLUME, False, "No media transport")
+            return
+
+        try:
+            with metrics.span("dbus.MediaTransport1.Volume"):
+                volume = session.transport.Volume
+                session.transport.Volume = max(
+                    0, min(TRANSPORT_VOLUME_MAX, volume + steps))
+        except Exception as e:
+            self.commandFinished.emit(_VOLUME, False, str(e))
+            return
+
+        self.commandFinished.emit(_VOLUME, True, "")
+
+    def _is_current(self, device_path, generation):
+        with self._condition:
+            return generation == self._generations[device_path]
@@ -0,0 +1,144 @@
+# Volume control backends.
+#
+# Running "amixer" for every button press forks a process on the GUI thread,
+# which is slow on small boards and makes a held volume key stutter. A Mixer
+# is created once and reused. Three backends are available:
+#
+#   AlsaMixer       keeps the ALSA control open in-process (pyalsaaudio).
+#   AmixerMixer     the old "amixer set" command, started without waiting
+#                   for it. Used when pyalsaaudio is not installed.
+#   TransportMixer  changes the phone-side volume through the Volume property
+#                   of org.bluez.MediaTransport1, via the media worker.
+#
+# change() can be called as often as the button auto-repeats. Steps that
+# arrive faster than min_interval are added together and applied in one go.
+
+import abc
+import logging
+import subprocess
+import threading
+import time
+
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+from media_worker import TRANSPORT_VOLUME_MAX
+
+log = logging.getLogger(__name__)
+
+
+class Mixer(abc.ABC):
+    name = "mixer"
+
+    def __init__(self, min_interval=0.05):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        # Held while a backend applies a change, so the flush timer and a
+        # direct call never talk to the backend at the same time.
+        self._apply_lock = threading.Lock()
+        self._pending = 0
+        self._last_applied = 0.0
+        self._flush_timer = None
+
+    # Changes the volume by `percent` (negative to lower it).
+    def change(self, percent):
+        with self._lock:
+            self._pending += percent
+            wait = self._last_applied + self.min_interval - time.monotonic()
+            if wait > 0:
+                # Too soon after the last change. Apply everything that has
+                # built up once the interval is over.
+                if self._flush_timer is None:
+                    self._flush_timer = threading.Timer(wait, self._flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+                return
+
+        self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+    def _flush(self):
+        with self._lock:
+            self._flush_timer = None
+            percent, self._pending = self._pending, 0
+            self._last_applied = time.monotonic()
+
+        if percent == 0:
+            return
+        try:
+            with self._apply_lock:
+                self._apply(percent)
+        except Exception as e:
+            log.error("Failed to change volume with %s: %s", self.name, e)
+
+    # Implemented by the backends.
+    @abc.abstractmethod
+    def _apply(self, percent):
+        pass
+
+
+class AlsaMixer(Mixer):
+    name = "alsa"
+
+    def __init__(self, control="Master", min_interval=0.05):
+        super(AlsaMixer, self).__init__(min_interval)
+        if alsaaudio is None:
+            raise RuntimeError("pyalsaaudio is not installed")
+        self._mixer = alsaaudio.Mixer(control)
+
+    def _apply(self, percent):
+        # getvolume() returns one value per channel.
+        volumes = self._mixer.getvolume()
+        current = sum(volumes) // len(volumes)
+        self._mixer.setvolume(max(0, min(100, current + percent)))
+
+
+class AmixerMixer(Mixer):
+    name = "amixer"
+
+    def __init__(self, control="Master", min_interval=0.05):
+        super(AmixerMixer, self).__init__(min_interval)
+        self._control = control
+        self._process = None
+
+    def _apply(self, percent):
+        # Reap the previous command if it has finished. We never wait for
+        # it, so a slow amixer cannot hold up the caller.
+        if self._process is not None:
+            self._process.poll()
+        sign = "+" if percent > 0 else "-"
+        self._process = subprocess.Popen(
+            ["amixer", "set", self._control, "--", f"{abs(percent)}%{sign}"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class TransportMixer(Mixer):
+    name = "transport"
+
+    def __init__(self, media_worker, min_interval=0.05):
+        super(TransportMixer, self).__init__(min_interval)
+        self._media_worker = media_worker
+
+    def _apply(self, percent):
+        steps = round(percent * TRANSPORT_VOLUME_MAX / 100)
+        if steps:
+            self._media_worker.request_volume(steps)
+
+
+# Returns the best local mixer available: the in-process ALSA backend if
+# possible, otherwise the amixer command.
+def create_mixer(control="Master", min_interval=0.05):
+    if alsaaudio is not None:
+        try:
+            return AlsaMixer(control, min_interval)
+        except Exception as e:
+            log.warning("Couldn't open ALSA mixer %s, using amixer: %s",
+                        control, e)
+    return AmixerMixer(control, min_interval)
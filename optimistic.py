@@ -0,0 +1,160 @@
+# Optimistic media controls.
+#
+# Over AVRCP a phone can take a second or more to report that it has
+# paused, so a button that waited for PropertiesChanged before changing
+# looked dead and got pressed again. Now a press changes the screen at
+# once and IntentTracker remembers what it expects BlueZ to report next:
+#
+#   STATUS  "playing" or "paused"
+#   TRACK   any track other than the one showing when Next/Previous was
+#           pressed
+#   VOLUME  the transport Volume the press aimed for, within
+#           VOLUME_TOLERANCE (phones round to their own volume steps)
+#
+# Every intent gets a tag. A newer press of the same kind supersedes the
+# pending intent, so an echo that only matches the older one is dropped
+# rather than flipping the screen back. While an intent is pending, BlueZ
+# values that don't match it are treated as stale echoes and not shown; a
+# matching value confirms it. If nothing matches within INTENT_TIMEOUT, or
+# the command fails, the intent is rolled back to the last value BlueZ did
+# report.
+#
+# Two latencies are recorded per kind: press to the first frame showing it
+# (media.feedback.<kind>) and press to BlueZ confirming it
+# (media.confirmed.<kind>).
+#
+# Everything here runs on the GUI thread.
+
+import itertools
+import logging
+import time
+from functools import partial
+from PyQt5.QtCore import QObject, QTimer
+from PyQt5.QtCore import pyqtSignal
+from diagnostics import metrics
+
+log = logging.getLogger(__name__)
+
+STATUS = "status"
+TRACK = "track"
+VOLUME = "volume"
+
+# Seconds to wait for BlueZ to confirm a press.
+INTENT_TIMEOUT = 3.0
+# Transport volume steps (0-127) a confirmation may be off by.
+VOLUME_TOLERANCE = 5
+
+
+class Intent:
+    __slots__ = ('tag', 'kind', 'device_path', 'expected', 'matches',
+                 'previous', 'pressed_at')
+
+    def __init__(self, tag, kind, device_path, expected, matches, previous,
+                 pressed_at):
+        self.tag = tag
+        self.kind = kind
+        self.device_path = device_path
+        self.expected = expected
+        self.matches = matches
+        self.previous = previous
+        self.pressed_at = pressed_at
+
+
+class IntentTracker(QObject):
+    # kind, device path, value to show again
+    rolledBack = pyqtSignal(str, object, object)
+
+    def __init__(self, timeout=INTENT_TIMEOUT, parent=None):
+        super(IntentTracker, self).__init__(parent)
+        self.timeout = timeout
+        self._tags = itertools.count(1)
+        # kind -> pending Intent
+        self._pending = {}
+        # Intents whose optimistic change hasn't been painted yet.
+        self._unpainted = []
+        # (device path, kind) -> last value BlueZ reported
+        self._reported = {}
+        self.confirmed = 0
+        self.rolled_back = 0
+        self.superseded = 0
+        self.dropped = 0
+
+    # Records a press that has just been shown as `expected`. `matches`
+    # tells whether a reported value confirms it (equality by default) and
+    # `previous` is what to go back to if nothing has been reported yet.
+    # Returns the intent's tag.
+    def press(self, kind, device_path, expected, previous, matches=None,
+              pressed_at=None):
+        pending = self._pending.get(kind)
+        if pending is not None:
+            self.superseded += 1
+            # Roll back to what BlueZ showed, not to the optimistic value.
+            previous = pending.previous
+        intent = Intent(next(self._tags), kind, device_path, expected,
+                        matches or (lambda value: value == expected),
+                        previous, pressed_at or time.perf_counter())
+        self._pending[kind] = intent
+        self._unpainted.append(intent)
+        QTimer.singleShot(round(self.timeout * 1000),
+                          partial(self._expire, kind, intent.tag))
+        return intent.tag
+
+    # The value a pending intent aims for, or `default`.
+    def expected(self, kind, default=None):
+        intent = self._pending.get(kind)
+        return default if intent is None else intent.expected
+
+    def pending(self, kind):
+        return kind in self._pending
+
+    # Called with every value BlueZ reports. Returns whether to show it.
+    def reconcile(self, device_path, kind, value):
+        self._reported[(device_path, kind)] = value
+        intent = self._pending.get(kind)
+        if intent is None or intent.device_path != device_path:
+            return True
+        if intent.matches(value):
+            del self._pending[kind]
+            self.confirmed += 1
+            metrics.record(f"media.confirmed.{kind}",
+                           time.perf_counter() - intent.pressed_at)
+            return True
+        self.dropped += 1
+        log.debug("Ignoring %s %r while waiting for %r (intent %d)", kind,
+                  value, intent.expected, intent.tag)
+        return False
+
+    # The command behind the pending intent of `kind` failed.
+    def failed(self, kind):
+        intent = self._pending.get(kind)
+        if intent is not None:
+            self._roll_back(intent)
+
+    # Forgets everything about a device, e.g. when it disconnects.
+    def forget(self, device_path):
+        for kind, intent in list(self._pending.items()):
+            if intent.device_path == device_path:
+                del self._pending[kind]
+        for key in [key for key in self._reported if key[0] == device_path]:
+            del self._reported[key]
+
+    # Called by the window at the end of every frame.
+    def frame_painted(self, finished):
+        for intent in self._unpainted:
+            metrics.record(f"media.feedback.{intent.kind}",
+                           finished - intent.pressed_at)
+        self._unpainted = []
+
+    def _expire(self, kind, tag):
+        intent = self._pending.get(kind)
+        if intent is not None and intent.tag == tag:
+            log.warning("No confirmation of %s %r after %.1fs, rolling "
+                        "back", kind, intent.expected, self.timeout)
+            self._roll_back(intent)
+
+    def _roll_back(self, intent):
+        del self._pending[intent.kind]
+        self.rolled_back += 1
+        value = self._reported.get((intent.device_path, intent.kind),
+                                   intent.previous)
+        self.rolledBack.emit(intent.kind, intent.device_path, value)
@@ -0,0 +1,242 @@
+# Dashboard pages.
+#
+# The window holds several full-screen pages (Media, Climate, Speed,
+# Diagnostics) on a PageStack, switched with the tab bar along the top or
+# by swiping sideways anywhere on a page. A page is only built the first
+# time it is shown.
+#
+# A hidden page costs nothing: Qt doesn't paint hidden widgets, widgets
+# with their own timers (ScrollingLabel, ProgressBar) stop them on hide,
+# and timers a page registers with Page.add_timer() only run while it is
+# on screen.
+#
+# Every frame the window paints is timed (see GUI.event()). A page switch
+# is timed from the tap or swipe to the end of the first frame showing the
+# new page and checked against PAGE_SWITCH_BUDGET. FrameTimeOverlay draws
+# both in a corner of the window.
+
+import logging
+import os
+import time
+from PyQt5.QtCore import Qt, QTimer, QEvent, QObject
+from PyQt5.QtGui import QPainter, QColor
+from PyQt5.QtWidgets import (QApplication, QWidget, QTabBar, QStackedWidget,
+                             QVBoxLayout)
+from diagnostics import metrics
+
+log = logging.getLogger(__name__)
+
+# Milliseconds from a page switch to its first frame, above which a
+# warning is logged. Set with DASHBOARD_PAGE_SWITCH_BUDGET.
+PAGE_SWITCH_BUDGET = 50
+# A sideways drag at least this long, in pixels, and mostly horizontal is
+# a swipe.
+SWIPE_DISTANCE = 120
+
+
+class Page(QWidget):
+    # build(page) fills the page in the first time it is shown.
+    def __init__(self, name, build=None, parent=None):
+        super(Page, self).__init__(parent)
+        self.name = name
+        self._build = build
+        self._timers = []
+
+    @property
+    def built(self):
+        return self._build is None
+
+    def build(self):
+        if self._build is not None:
+            build, self._build = self._build, None
+            with metrics.span(f"page_build.{self.name}"):
+                build(self)
+
+    # A timer that runs only while the page is visible.
+    def add_timer(self, timer):
+        self._timers.append(timer)
+        if self.isVisible():
+            timer.start()
+
+    def showEvent(self, event):
+        super(Page, self).showEvent(event)
+        for timer in self._timers:
+            timer.start()
+
+    def hideEvent(self, event):
+        super(Page, self).hideEvent(event)
+        for timer in self._timers:
+            timer.stop()
+
+
+class PageStack(QWidget):
+    def __init__(self, parent=None):
+        super(PageStack, self).__init__(parent)
+        self.tab_bar = QTabBar()
+        self.tab_bar.setExpanding(True)
+        self._stack = QStackedWidget()
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(0)
+        layout.addWidget(self.tab_bar)
+        layout.addWidget(self._stack)
+        self.setLayout(layout)
+
+        self._pages = []
+        self.budget = float(os.environ.get("DASHBOARD_PAGE_SWITCH_BUDGET",
+                                           PAGE_SWITCH_BUDGET))
+        # (page name, time.perf_counter() of the tap or swipe) until the
+        # page's first frame.
+        self._switching = None
+        # (page name, ms) of the last switch.
+        self.last_switch = None
+
+        self._swipe = SwipeFilter(self)
+        QApplication.instance().installEventFilter(self._swipe)
+        self.tab_bar.currentChanged.connect(self._on_tab_changed)
+
+    # The first page added is built straight away and shown first.
+    def add_page(self, page):
+        self._pages.append(page)
+        if len(self._pages) == 1:
+            page.build()
+        self._stack.addWidget(page)
+        self.tab_bar.addTab(page.name)
+
+    def page(self, name):
+        for page in self._pages:
+            if page.name == name:
+                return page
+        raise KeyError(name)
+
+    def current_page(self):
+        return self._stack.currentWidget()
+
+    def show_page(self, index):
+        index = max(0, min(len(self._pages) - 1, index))
+        self.tab_bar.setCurrentIndex(index)
+
+    def show_next(self, step):
+        self.show_page(self._stack.currentIndex() + step)
+
+    # Called by the window at the end of every frame.
+    def frame_painted(self, finished):
+        if self._switching is None:
+            return
+        name, started = self._switching
+        self._switching = None
+        elapsed = finished - started
+        metrics.record(f"page_switch.{name}", elapsed)
+        self.last_switch = (name, elapsed * 1000)
+        if elapsed * 1000 > self.budget:
+            log.warning("Switching to %s took %.1f ms, over the %.0f ms "
+                        "budget", name, elapsed * 1000, self.budget)
+
+    def _on_tab_changed(self, index):
+        if index == self._stack.currentIndex():
+            return  # The first tab being added
+        page = self._pages[index]
+        self._switching = (page.name, time.perf_counter())
+        page.build()
+        self._stack.setCurrentIndex(index)
+
+
+# Turns sideways drags that start on a PageStack into page switches. It
+# watches the whole application because the press usually lands on a
+# button, not on the stack itself. Widgets that take drags themselves, like
+# the map, set the "handlesDrags" property and are left alone.
+class SwipeFilter(QObject):
+    def __init__(self, pages):
+        super(SwipeFilter, self).__init__(pages)
+        self._pages = pages
+        self._pressed_at = None
+
+    def eventFilter(self, watched, event):
+        kind = event.type()
+        if kind not in (QEvent.MouseButtonPress, QEvent.MouseButtonRelease):
+            return False
+        if not isinstance(watched, QWidget) or \
+                not self._pages.isAncestorOf(watched):
+            return False
+
+        if kind == QEvent.MouseButtonPress:
+            self._pressed_at = None if handles_drags(watched) else \
+                event.globalPos()
+        elif self._pressed_at is not None:
+            delta = event.globalPos() - self._pressed_at
+            self._pressed_at = None
+            if abs(delta.x()) >= SWIPE_DISTANCE and \
+                    abs(delta.x()) > 2 * abs(delta.y()):
+                # Dragging left brings in the page on the right.
+                self._pages.show_next(1 if delta.x() < 0 else -1)
+        return False
+
+
+def handles_drags(widget):
+    while widget is not None:
+        if widget.property("handlesDrags"):
+            return True
+        widget = widget.parentWidget()
+    return False
+
+
+# Frame and page switch times drawn over the top right of the window. Its
+# own repaints are frames too, so it redraws at most refresh_rate times a
+# second rather than every frame.
+class FrameTimeOverlay(QWidget):
+    def __init__(self, pages, parent=None, refresh_rate=4):
+        super(FrameTimeOverlay, self).__init__(parent)
+        self._pages = pages
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.resize(260, 60)
+        self._frames = 0
+        self._frame_time = 0.0
+        self._worst = 0.0
+        self._lines = ()
+
+        self._timer = QTimer(self)
+        self._timer.setInterval(round(1000 / refresh_rate))
+        self._timer.timeout.connect(self._refresh)
+
+    def frame_painted(self, seconds):
+        self._frames += 1
+        self._frame_time += seconds
+        self._worst = max(self._worst, seconds)
+
+    def _refresh(self):
+        lines = []
+        if self._frames:
+            lines.append(f"frame {self._frame_time * 1000 / self._frames:5.1f}"
+                         f" ms avg {self._worst * 1000:5.1f} ms max")
+        else:
+            lines.append("frame   idle")
+        if self._pages.last_switch is not None:
+            name, ms = self._pages.last_switch
+            state = "over" if ms > self._pages.budget else "ok"
+            lines.append(f"{name} {ms:5.1f} ms / {self._pages.budget:.0f} "
+                         f"{state}")
+        self._frames = 0
+        self._frame_time = 0.0
+        self._worst = 0.0
+        if tuple(lines) != self._lines:
+            self._lines = tuple(lines)
+            self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(0, 0, 0, 160))
+        painter.setPen(Qt.white)
+        y = painter.fontMetrics().ascent() + 4
+        for line in self._lines:
+            painter.drawText(6, y, line)
+            y += painter.fontMetrics().height()
+        painter.end()
+
+    def showEvent(self, event):
+        super(FrameTimeOverlay, self).showEvent(event)
+        self.raise_()
+        self._timer.start()
+
+    def hideEvent(self, event):
+        super(FrameTimeOverlay, self).hideEvent(event)
+        self._timer.stop()
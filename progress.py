@@ -0,0 +1,159 @@
+# Track progress without polling.
+#
+# Asking the phone for MediaPlayer1.Position would mean a D-Bus round trip
+# per update. Instead PlaybackClock is anchored on the Position, Duration
+# and Status the phone sends in PropertiesChanged and advances on its own
+# in between. A reported Position that agrees with the clock is ignored;
+# only one that doesn't (a seek) or a change of status moves the anchor.
+#
+# ProgressBar draws a clock. It only wakes up as often as the bar gains a
+# pixel (about every third of a second for a three minute song on a 550
+# pixel bar) and only while the track is playing and the bar is visible.
+
+import time
+from PyQt5.QtCore import QTimer, QRect
+from PyQt5.QtGui import QPainter, QPalette
+from PyQt5.QtWidgets import QWidget
+
+# A reported position this close to the clock's (in ms) is not a seek.
+SEEK_TOLERANCE = 1500
+# Fastest and slowest repaint intervals, in ms.
+MIN_REPAINT_INTERVAL = 16
+MAX_REPAINT_INTERVAL = 1000
+
+
+class PlaybackClock:
+    def __init__(self):
+        self.duration = 0
+        self.playing = False
+        # Identity of the track being timed, see update().
+        self.track = None
+        # Position in ms at anchor_time (time.monotonic()).
+        self._anchor_position = 0
+        self._anchor_time = time.monotonic()
+        # Number of times the anchor moved, for checking how rarely that
+        # happens.
+        self.resyncs = 0
+
+    # Current position in ms.
+    def position(self, now=None):
+        position = self._anchor_position
+        if self.playing:
+            now = time.monotonic() if now is None else now
+            position += (now - self._anchor_time) * 1000
+        if self.duration:
+            position = min(position, self.duration)
+        return max(0, int(position))
+
+    # Feeds values from PropertiesChanged or GetAll(); any may be None.
+    # track is anything identifying the track: a different one starts from
+    # 0 unless a position comes with it. Returns True if the clock was
+    # moved.
+    def update(self, position=None, duration=None, status=None, track=None,
+               now=None):
+        now = time.monotonic() if now is None else now
+        resync = False
+
+        if track is not None and track != self.track:
+            self.track = track
+            if position is None:
+                position = 0
+            resync = True
+
+        if duration is not None and duration != self.duration:
+            self.duration = duration
+            resync = True
+
+        playing = self.playing
+        if status is not None:
+            playing = status == "playing"
+        if playing != self.playing:
+            resync = True
+
+        if position is not None and \
+                abs(position - self.position(now)) > SEEK_TOLERANCE:
+            resync = True
+        elif position is None or not resync:
+            # Keep interpolating from where the clock is.
+            position = self.position(now)
+
+        if resync:
+            self._anchor_position = position
+            self._anchor_time = now
+            self.playing = playing
+            self.resyncs += 1
+        return resync
+
+
+class ProgressBar(QWidget):
+    def __init__(self, parent=None):
+        super(ProgressBar, self).__init__(parent)
+        self._clock = None
+        # Width in pixels of the filled part as last painted.
+        self._filled = -1
+
+        self.setFixedHeight(12)
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._tick)
+
+    # Shows another clock, or nothing for None.
+    def set_clock(self, clock):
+        self._clock = clock
+        self.clock_changed()
+
+    # Call after updating the clock.
+    def clock_changed(self):
+        self._filled = -1
+        self._tick()
+        self._update_timer()
+
+    def _filled_width(self):
+        clock = self._clock
+        if clock is None or not clock.duration:
+            return 0
+        return round(self.width() * clock.position() / clock.duration)
+
+    # Repaints only when the filled part has grown by a pixel.
+    def _tick(self):
+        filled = self._filled_width()
+        if filled != self._filled:
+            self._filled = filled
+            self.update()
+        if self._clock is not None and self._clock.duration and \
+                self._clock.position() >= self._clock.duration:
+            self._timer.stop()
+
+    def _update_timer(self):
+        clock = self._clock
+        if clock is None or not clock.playing or not clock.duration or \
+                not self.isVisible():
+            self._timer.stop()
+            return
+        # The time the bar takes to gain one pixel.
+        interval = clock.duration / max(1, self.width())
+        self._timer.setInterval(int(max(MIN_REPAINT_INTERVAL,
+                                        min(MAX_REPAINT_INTERVAL,
+                                            interval))))
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        palette = self.palette()
+        painter.fillRect(self.rect(), palette.color(QPalette.Mid))
+        if self._filled > 0:
+            painter.fillRect(QRect(0, 0, self._filled, self.height()),
+                             palette.color(QPalette.Highlight))
+        painter.end()
+
+    def showEvent(self, event):
+        super(ProgressBar, self).showEvent(event)
+        self.clock_changed()
+
+    def hideEvent(self, event):
+        super(ProgressBar, self).hideEvent(event)
+        self._update_timer()
+
+    def resizeEvent(self, event):
+        super(ProgressBar, self).resizeEvent(event)
+        self.clock_changed()
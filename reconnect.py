@@ -0,0 +1,229 @@
+# Reconnecting to known phones.
+#
+# Left alone, a phone can take 10-30 s after the ignition to decide to
+# connect. ReconnectScheduler doesn't wait for it: at start up, and
+# whenever the last phone disconnects, it calls Device1.Connect on the
+# phones it knows, one at a time in priority order, until one connects.
+#
+# Known phones are the ones that have connected before, most recent first
+# (kept in the state snapshot by the GUI), followed by any other device
+# BlueZ lists as trusted. A round that connects nothing is followed by a
+# wait of BASE_DELAY doubled each round up to MAX_DELAY, randomised by
+# +-JITTER so that a reconnect never falls into step with a phone's own
+# retries. A connection, whether ours or the phone's, cancels the rest.
+#
+# Calls are made on the scheduler's own thread, as Connect blocks until
+# the phone answers or the page times out. Connection events come from
+# the BlueZ object index. The time from the scheduler starting (the
+# ignition, or the disconnect) to a phone being connected is recorded as
+# reconnect.latency, and every Connect call as reconnect.attempt.
+
+import collections
+import logging
+import random
+import threading
+import time
+from PyQt5.QtCore import QObject
+from PyQt5.QtCore import pyqtSignal
+from bluez_index import DEVICE_INTERFACE
+from diagnostics import metrics
+
+log = logging.getLogger(__name__)
+
+# Wait after the first round that connects nothing, in seconds; it doubles
+# every round up to MAX_DELAY.
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+# Each wait is scaled by a random factor in 1 +- JITTER.
+JITTER = 0.5
+# Seconds for a successful Connect to show up as Connected.
+CONFIRM_TIMEOUT = 5.0
+# Devices remembered.
+MAX_DEVICES = 5
+# Latencies kept for reconnect_stats().
+LATENCY_SAMPLES = 50
+
+
+class ReconnectScheduler(QObject):
+    # Known device paths, most preferred first, whenever they change.
+    devicesChanged = pyqtSignal(object)
+    # device path, seconds from the scheduler starting to it connecting.
+    reconnected = pyqtSignal(object, float)
+
+    # devices is the remembered list from a previous run.
+    def __init__(self, bus, index, devices=(), parent=None):
+        super(ReconnectScheduler, self).__init__(parent)
+        self._bus = bus
+        self._index = index
+        self._condition = threading.Condition()
+        self._devices = list(devices)[:MAX_DEVICES]
+        # time.monotonic() when reconnecting started, None when idle.
+        self._started = None
+        # Bumped on every start and cancel so a round in progress can tell
+        # it is out of date.
+        self._generation = 0
+        self._running = True
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.attempts = 0
+        self._thread = threading.Thread(target=self._run, name="reconnect",
+                                        daemon=True)
+
+    def start(self):
+        self._index.add_listener(self._on_index_event)
+        self._thread.start()
+        if self._index.connected_device_path() is None:
+            self._schedule()
+        else:
+            for device_path in self._index.connected_device_paths():
+                self._remember(device_path)
+
+    def close(self):
+        self._index.remove_listener(self._on_index_event)
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        # A Connect call can't be cut short; the thread is a daemon.
+        self._thread.join(timeout=1.0)
+
+    def devices(self):
+        with self._condition:
+            return list(self._devices)
+
+    # Latest reconnect latencies: {count, p50_ms, max_ms}, or None.
+    def reconnect_stats(self):
+        with self._condition:
+            samples = sorted(self._latencies)
+        if not samples:
+            return None
+        return {'count': len(samples),
+                'p50_ms': samples[(len(samples) - 1) // 2] * 1000,
+                'max_ms': samples[-1] * 1000}
+
+    # Remembered devices first, then other trusted ones, skipping any
+    # BlueZ no longer knows.
+    def candidates(self):
+        with self._condition:
+            devices = list(self._devices)
+        trusted = [path for path in
+                   reversed(self._index.paths_with_interface(
+                       DEVICE_INTERFACE))
+                   if (self._index.properties(path, DEVICE_INTERFACE)
+                       or {}).get('Trusted')]
+        known = set(trusted)
+        return [path for path in devices if path in known] + \
+            [path for path in trusted if path not in devices]
+
+    # ---------- Index events (GLib thread) ----------
+
+    def _on_index_event(self, event, path, interfaces):
+        if event == "removed":
+            # interfaces is a list of names. A connected phone that goes
+            # away never reports Connected False.
+            if DEVICE_INTERFACE in interfaces and \
+                    self._index.connected_device_path() is None:
+                log.info("No phone connected; reconnecting.")
+                self._schedule()
+            return
+        device = interfaces.get(DEVICE_INTERFACE)
+        if not device or 'Connected' not in device:
+            return
+        if device['Connected']:
+            self._connected(path)
+        elif self._index.connected_device_path() is None:
+            log.info("No phone connected; reconnecting.")
+            self._schedule()
+
+    def _connected(self, device_path):
+        with self._condition:
+            started, self._started = self._started, None
+            self._generation += 1
+            self._condition.notify()
+        self._remember(device_path)
+        if started is None:
+            return
+        latency = time.monotonic() - started
+        with self._condition:
+            self._latencies.append(latency)
+        metrics.record("reconnect.latency", latency)
+        log.info("Reconnected to %s after %.2fs", device_path, latency)
+        self.reconnected.emit(device_path, latency)
+
+    def _remember(self, device_path):
+        with self._condition:
+            if self._devices[:1] == [device_path]:
+                return
+            if device_path in self._devices:
+                self._devices.remove(device_path)
+            self._devices.insert(0, device_path)
+            del self._devices[MAX_DEVICES:]
+            devices = list(self._devices)
+        self.devicesChanged.emit(devices)
+
+    def _schedule(self):
+        with self._condition:
+            if self._started is not None:
+                return  # Already reconnecting
+            self._started = time.monotonic()
+            self._generation += 1
+            self._condition.notify()
+
+    # ---------- Scheduler thread ----------
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and self._started is None:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                generation = self._generation
+
+            delay = BASE_DELAY
+            while self._round(generation):
+                wait = min(delay, MAX_DELAY) * \
+                    random.uniform(1 - JITTER, 1 + JITTER)
+                log.info("No known phone connected; next try in %.1fs",
+                         wait)
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: not self._current(generation), wait)
+                    if not self._current(generation):
+                        break
+                delay *= 2
+
+    # Lock must be held.
+    def _current(self, generation):
+        return self._running and self._generation == generation
+
+    # One pass over the candidates. Returns True if another is needed.
+    def _round(self, generation):
+        candidates = self.candidates()
+        if not candidates:
+            log.info("No known phone to reconnect to.")
+        for device_path in candidates:
+            with self._condition:
+                if not self._current(generation):
+                    return False
+            if self._connect(device_path):
+                # Done once the index hears of it; if it never does, carry
+                # on as if the call had failed.
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: not self._current(generation),
+                        CONFIRM_TIMEOUT)
+                    return self._current(generation)
+        with self._condition:
+            return self._current(generation)
+
+    def _connect(self, device_path):
+        self.attempts += 1
+        started = time.monotonic()
+        try:
+            self._bus.get('org.bluez', device_path).Connect()
+        except Exception as e:
+            metrics.record("reconnect.attempt", time.monotonic() - started)
+            log.info("Couldn't connect to %s: %s", device_path, e)
+            return False
+        metrics.record("reconnect.attempt", time.monotonic() - started)
+        log.info("Connected to %s", device_path)
+        return True
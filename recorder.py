@@ -0,0 +1,349 @@
+# D-Bus recording and replay.
+#
+# Setting DASHBOARD_RECORD=file makes the dashboard write every org.bluez
+# signal it receives and every method reply and property read it gets to
+# a file, so a bad drive can be replayed on a desk machine. Each start
+# replaces the file: timestamps restart at 0 with every recording and
+# replay needs them in order.
+#
+# The file starts with MAGIC and a JSON header, followed by records of
+#
+#   float64 seconds since the start, uint32 length, JSON payload
+#
+# where the payload is one of
+#
+#   ["s", sender, path, interface, member, params]   a signal
+#   ["r", path, member, args, result]                 a method reply
+#   ["p", path, name, value]                          a property read
+#
+# Records are written by a background thread, so capturing costs the
+# GLib thread only a queue put. A record cut short by a power cut is
+# ignored when reading.
+#
+# ReplayBus stands in for the pydbus bus: it answers method calls with the
+# recorded replies and delivers the recorded signals through the same
+# subscriptions the real bus would, so the dashboard's handlers
+# (on_device_property_changed() through the BlueZ index,
+# on_player_properties_change() and on_transport_change() through the
+# media worker) run exactly as they did live. bench_replay.py drives it.
+
+import json
+import logging
+import queue
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"DBUSREC1\n"
+RECORD_HEADER = struct.Struct('<dI')
+
+SIGNAL = "s"
+REPLY = "r"
+PROPERTY = "p"
+
+# Interface of each signal a proxy can connect to.
+SIGNAL_INTERFACES = {
+    'PropertiesChanged': 'org.freedesktop.DBus.Properties',
+    'InterfacesAdded': 'org.freedesktop.DBus.ObjectManager',
+    'InterfacesRemoved': 'org.freedesktop.DBus.ObjectManager',
+}
+
+
+def _encode(value):
+    # Byte arrays become lists of ints; everything else D-Bus sends is
+    # already JSON apart from tuples, which become lists.
+    if isinstance(value, (bytes, bytearray)):
+        return list(value)
+    raise TypeError(f"Can't record {type(value).__name__}")
+
+
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self._started = time.perf_counter()
+        self._queue = queue.SimpleQueue()
+        self._file = open(path, 'wb')
+        header = json.dumps({'started': time.time()}).encode()
+        self._file.write(MAGIC + RECORD_HEADER.pack(0.0, len(header)) +
+                         header)
+        self.records_written = 0
+        self._thread = threading.Thread(target=self._write, name="recorder",
+                                        daemon=True)
+        self._thread.start()
+
+    # t is seconds since the recording started; now if not given.
+    def signal(self, sender, path, interface, member, params, t=None):
+        self._put(t, [SIGNAL, sender, path, interface, member, params])
+
+    def reply(self, path, member, args, result, t=None):
+        self._put(t, [REPLY, path, member, list(args), result])
+
+    def property(self, path, name, value, t=None):
+        self._put(t, [PROPERTY, path, name, value])
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _put(self, t, record):
+        if t is None:
+            t = time.perf_counter() - self._started
+        self._queue.put((t, record))
+
+    def _write(self):
+        while True:
+            batch = [self._queue.get()]
+            # Write whatever else has queued up in one go.
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in batch:
+                if item is None:
+                    self._file.close()
+                    return
+                t, record = item
+                try:
+                    payload = json.dumps(record, separators=(',', ':'),
+                                         default=_encode).encode()
+                except (TypeError, ValueError) as e:
+                    log.warning("Couldn't record %s: %s", record[:3], e)
+                    continue
+                self._file.write(RECORD_HEADER.pack(t, len(payload)) +
+                                 payload)
+                self.records_written += 1
+            self._file.flush()
+
+
+# Yields (t, record) for every complete record in a recording.
+def read_recording(path):
+    with open(path, 'rb') as recording:
+        if recording.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a D-Bus recording")
+        first = True
+        while True:
+            header = recording.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            t, length = RECORD_HEADER.unpack(header)
+            payload = recording.read(length)
+            if len(payload) < length:
+                return
+            if first:
+                first = False  # The file header
+                continue
+            yield t, json.loads(payload)
+
+
+# A pydbus proxy that records the replies of the calls made through it.
+# Signals are not recorded here but by RecordingBus's own subscription, so
+# each is recorded once however many handlers it has.
+class RecordingProxy:
+    def __init__(self, proxy, path, recorder):
+        object.__setattr__(self, '_proxy', proxy)
+        object.__setattr__(self, '_path', path)
+        object.__setattr__(self, '_recorder', recorder)
+
+    def __getitem__(self, interface):
+        return RecordingProxy(self._proxy[interface], self._path,
+                              self._recorder)
+
+    def __getattr__(self, name):
+        value = getattr(self._proxy, name)
+        if hasattr(value, 'connect'):
+            return value  # A signal
+
+        if callable(value):
+            def call(*args):
+                result = value(*args)
+                self._recorder.reply(self._path, name, args, result)
+                return result
+            return call
+
+        self._recorder.property(self._path, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._proxy, name, value)
+
+
+# Wraps a pydbus bus so that everything main.py sees of org.bluez is
+# recorded.
+class RecordingBus:
+    def __init__(self, bus, path):
+        self._bus = bus
+        self.recorder = Recorder(path)
+        self._subscription = bus.subscribe(sender='org.bluez',
+                                           signal_fired=self._on_signal)
+        log.info("Recording D-Bus traffic to %s", path)
+
+    def get(self, service, path=None):
+        proxy = self._bus.get(service, path)
+        if service != 'org.bluez':
+            return proxy
+        return RecordingProxy(proxy, path, self.recorder)
+
+    def subscribe(self, *args, **kwargs):
+        return self._bus.subscribe(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._bus, name)
+
+    def close(self):
+        self._subscription.disconnect()
+        self.recorder.close()
+
+    def _on_signal(self, sender, path, interface, member, params):
+        self.recorder.signal(sender, path, interface, member, params)
+
+
+# ---------- Replay ----------
+
+class ReplaySubscription:
+    def __init__(self, bus, entry):
+        self._bus = bus
+        self._entry = entry
+
+    def disconnect(self):
+        with self._bus._lock:
+            if self._entry in self._bus._subscriptions:
+                self._bus._subscriptions.remove(self._entry)
+
+
+class ReplaySignal:
+    def __init__(self, bus, path, name):
+        self._bus = bus
+        self._path = path
+        self._name = name
+
+    def connect(self, callback):
+        return self._bus.subscribe(
+            object=self._path, iface=SIGNAL_INTERFACES.get(self._name),
+            signal=self._name,
+            signal_fired=lambda sender, path, iface, member, params:
+                callback(*params))
+
+
+class ReplayProxy:
+    def __init__(self, bus, path):
+        object.__setattr__(self, '_bus', bus)
+        object.__setattr__(self, '_path', path)
+
+    def __getitem__(self, interface):
+        return self
+
+    def __getattr__(self, name):
+        if name in SIGNAL_INTERFACES:
+            return ReplaySignal(self._bus, self._path, name)
+        found, value = self._bus.recorded(PROPERTY, self._path, name)
+        if found:
+            return value
+
+        def call(*args):
+            self._bus.calls.append((self._path, name, args))
+            return self._bus.recorded(REPLY, self._path, name, args)[1]
+        return call
+
+    def __setattr__(self, name, value):
+        self._bus.calls.append((self._path, name, (value,)))
+
+
+class ReplayBus:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        # [(filters, signal_fired)]
+        self._subscriptions = []
+        self.signals = []
+        # (kind, path, member[, args]) -> [(t, value)] in time order
+        self._replies = {}
+        for t, record in read_recording(path):
+            if record[0] == SIGNAL:
+                self.signals.append((t, record[1:]))
+            elif record[0] == REPLY:
+                _, path_, member, args, result = record
+                self._replies.setdefault(
+                    (REPLY, path_, member, json.dumps(args)), []).append(
+                        (t, result))
+            elif record[0] == PROPERTY:
+                _, path_, name, value = record
+                self._replies.setdefault((PROPERTY, path_, name), []).append(
+                    (t, value))
+
+        # Recorded time of the last signal delivered. Replies are answered
+        # with the last one recorded before it.
+        self.position = 0.0
+        # Calls and property writes made, with their arguments.
+        self.calls = []
+
+    def get(self, service, path=None):
+        return ReplayProxy(self, path)
+
+    def subscribe(self, sender=None, iface=None, signal=None, object=None,
+                  arg0=None, flags=0, signal_fired=None):
+        entry = ((sender, iface, signal, object), signal_fired)
+        with self._lock:
+            self._subscriptions.append(entry)
+        return ReplaySubscription(self, entry)
+
+    # Returns (found, value) for a recorded reply or property read.
+    def recorded(self, kind, path, member, args=None):
+        key = (kind, path, member)
+        if kind == REPLY:
+            key += (json.dumps(list(args)),)
+        answers = self._replies.get(key)
+        if not answers:
+            return False, None
+        value = answers[0][1]
+        for t, answer in answers:
+            if t > self.position:
+                break
+            value = answer
+        return True, value
+
+    # Delivers one recorded signal to every matching subscription, on the
+    # calling thread.
+    def deliver(self, t, signal):
+        sender, path, interface, member, params = signal
+        self.position = t
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        # Everything recorded came from org.bluez, so the sender filter
+        # always matches.
+        for (_, want_iface, want_signal, want_object), callback \
+                in subscriptions:
+            if (want_iface is None or want_iface == interface) and \
+                    (want_signal is None or want_signal == member) and \
+                    (want_object is None or want_object == path):
+                callback(sender, path, interface, member, params)
+
+
+# Feeds a ReplayBus's signals on its own thread, standing in for the GLib
+# thread. speed 1.0 keeps the recorded timing, 2.0 is twice as fast and 0
+# is as fast as possible.
+class Replayer(threading.Thread):
+    def __init__(self, bus, speed=1.0):
+        super(Replayer, self).__init__(name="replay", daemon=True)
+        self._bus = bus
+        self._speed = speed
+        self.delivered = 0
+        self.elapsed = 0.0
+
+    def run(self):
+        signals = self._bus.signals
+        if not signals:
+            return
+        first = signals[0][0]
+        started = time.perf_counter()
+        for t, signal in signals:
+            if self._speed > 0:
+                delay = (t - first) / self._speed - \
+                    (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            self._bus.deliver(t, signal)
+            self.delivered += 1
+        self.elapsed = time.perf_counter() - started
@@ -0,0 +1,150 @@
+# Last known state, kept across ignition cycles.
+#
+# The dashboard loses power whenever the engine stops, so every start used
+# to begin from "Nothing playing". StateSnapshot keeps what is needed to
+# paint the screen as it was straight away: the phone's device, player and
+# transport paths, the last track and play status, the volume, the heater
+# settings and the last GPS fix. The GUI draws it before D-Bus is even
+# connected and then lets BlueZ confirm or correct it.
+#
+# The file is
+#
+#   MAGIC, uint32 CRC-32 of the payload, uint32 length, JSON payload
+#
+# and is replaced atomically: written to a temporary file, fsynced,
+# renamed over the old one and the directory fsynced, so a power cut
+# leaves either the old snapshot or the new one. A file that is cut short
+# or fails its CRC is ignored.
+#
+# Changes are written by a background thread at most once per
+# write_delay seconds, so a stream of updates costs one small write and
+# the GUI thread never waits on the SD card.
+
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"DSNAP1\n"
+HEADER = struct.Struct('<II')
+# Seconds between a change and it being written.
+WRITE_DELAY = 5.0
+
+
+def default_path():
+    state_home = os.environ.get(
+        "XDG_STATE_HOME",
+        os.path.join(os.path.expanduser("~"), ".local", "state"))
+    return os.environ.get(
+        "DASHBOARD_STATE",
+        os.path.join(state_home, "suzuki-lj-dashboard", "state.bin"))
+
+
+def read_snapshot(path):
+    with open(path, 'rb') as snapshot_file:
+        data = snapshot_file.read()
+    if not data.startswith(MAGIC) or \
+            len(data) < len(MAGIC) + HEADER.size:
+        raise ValueError("not a state snapshot")
+    crc, length = HEADER.unpack_from(data, len(MAGIC))
+    payload = data[len(MAGIC) + HEADER.size:]
+    if len(payload) != length or zlib.crc32(payload) != crc:
+        raise ValueError("damaged state snapshot")
+    return json.loads(payload)
+
+
+def write_snapshot(path, state):
+    payload = json.dumps(state, separators=(',', ':')).encode()
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, partial_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as partial:
+            partial.write(MAGIC + HEADER.pack(zlib.crc32(payload),
+                                              len(payload)) + payload)
+            partial.flush()
+            os.fsync(partial.fileno())
+        os.replace(partial_path, path)
+    except BaseException:
+        os.unlink(partial_path)
+        raise
+    # Make the rename itself durable.
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+class StateSnapshot:
+    def __init__(self, path=None, write_delay=WRITE_DELAY):
+        self.path = path or default_path()
+        self._write_delay = write_delay
+        self._condition = threading.Condition()
+        self._state = {}
+        self._dirty = False
+        self._running = True
+        self.writes = 0
+
+        try:
+            self._state = read_snapshot(self.path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring state snapshot %s: %s", self.path, e)
+
+        self._thread = threading.Thread(target=self._run,
+                                        name="snapshot", daemon=True)
+        self._thread.start()
+
+    # The state as loaded or last updated.
+    def get(self, name, default=None):
+        with self._condition:
+            return self._state.get(name, default)
+
+    # Sets top-level values; only a real change gets written.
+    def update(self, **values):
+        with self._condition:
+            changed = {name: value for name, value in values.items()
+                       if self._state.get(name) != value}
+            if not changed:
+                return
+            self._state.update(changed)
+            if not self._dirty:
+                self._dirty = True
+                self._condition.notify()
+
+    # Writes any pending change now and stops the writer.
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._dirty:
+                    self._condition.wait()
+                # Let more changes gather before writing.
+                if self._running:
+                    self._condition.wait(self._write_delay)
+                if not self._dirty:
+                    return
+                self._dirty = False
+                state = dict(self._state)
+                running = self._running
+
+            try:
+                write_snapshot(self.path, state)
+                self.writes += 1
+            except OSError as e:
+                log.error("Couldn't write state snapshot %s: %s",
+                          self.path, e)
+            if not running:
+                return
@@ -0,0 +1,472 @@
+# Engine telemetry from CAN or OBD-II.
+#
+# Frames come from SocketCAN (a real interface, or vcan for testing), from
+# an ELM327 adapter on a serial port, or from a candump log. Sources hand
+# over frames in batches as three flat buffers (times, CAN ids, 8 data
+# bytes per frame), and FrameDecoder decodes a whole batch at once with
+# NumPy: OBD-II mode 01 responses are picked out with masks and each PID's
+# formula is applied to all of its samples together. Decoded samples go
+# into TelemetryHistory, fixed-size NumPy rings per channel.
+#
+# TelemetryThread runs the source and the decoder and hands the GUI the
+# latest value of each channel through a Qt signal, at no more than
+# max_rate updates per second, however busy the bus is.
+
+import array
+import logging
+import socket
+import struct
+import threading
+import time
+import numpy
+from PyQt5.QtCore import QThread
+from PyQt5.QtCore import pyqtSignal
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+log = logging.getLogger(__name__)
+
+# Decoded channels, in ring order.
+CHANNELS = ('rpm', 'speed_kmh', 'coolant_c', 'intake_c', 'throttle_pct',
+            'load_pct', 'voltage')
+
+# OBD-II mode 01 PIDs: pid -> (channel, formula of the data bytes A and B
+# as arrays).
+PIDS = {
+    0x04: ('load_pct', lambda a, b: a * (100 / 255)),
+    0x05: ('coolant_c', lambda a, b: a - 40.0),
+    0x0C: ('rpm', lambda a, b: (a * 256 + b) / 4),
+    0x0D: ('speed_kmh', lambda a, b: a * 1.0),
+    0x0F: ('intake_c', lambda a, b: a - 40.0),
+    0x11: ('throttle_pct', lambda a, b: a * (100 / 255)),
+    0x42: ('voltage', lambda a, b: (a * 256 + b) / 1000),
+}
+# PIDs asked for, round robin.
+POLL_PIDS = (0x0C, 0x0D, 0x05, 0x11, 0x04, 0x0F, 0x42)
+
+# Functional request id and the ECU response ids 0x7E8-0x7EF (11 bit).
+OBD_REQUEST_ID = 0x7DF
+OBD_RESPONSE_BASE = 0x7E8
+OBD_RESPONSE_MASK = 0x7F8
+
+# Samples kept per channel.
+HISTORY_SIZE = 4096
+# Most frames handed over in one batch.
+BATCH_SIZE = 512
+# Seconds a paced replay lets frames gather before handing them over, so
+# it wakes up per batch rather than per frame.
+BATCH_INTERVAL = 0.02
+
+
+# A batch of frames: times (array 'd', Unix time), CAN ids (array 'I')
+# and data (bytearray, 8 bytes per frame, zero padded).
+class FrameBatch:
+    __slots__ = ('times', 'ids', 'data')
+
+    def __init__(self):
+        self.times = array.array('d')
+        self.ids = array.array('I')
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, t, can_id, payload):
+        self.times.append(t)
+        self.ids.append(can_id)
+        self.data += payload[:8].ljust(8, b'\0')
+
+
+# Fixed-size rings of (time, value) per channel.
+class TelemetryHistory:
+    def __init__(self, size=HISTORY_SIZE, channels=CHANNELS):
+        self.size = size
+        self.channels = channels
+        self._times = numpy.zeros((len(channels), size))
+        self._values = numpy.zeros((len(channels), size))
+        # Samples written per channel so far.
+        self._written = numpy.zeros(len(channels), dtype=numpy.int64)
+
+    def extend(self, channel, times, values):
+        row = self.channels.index(channel)
+        count = len(values)
+        if count > self.size:
+            times = times[-self.size:]
+            values = values[-self.size:]
+            self._written[row] += count - self.size
+            count = self.size
+        start = self._written[row] % self.size
+        first = min(count, self.size - start)
+        self._times[row, start:start + first] = times[:first]
+        self._values[row, start:start + first] = values[:first]
+        if first < count:
+            self._times[row, :count - first] = times[first:]
+            self._values[row, :count - first] = values[first:]
+        self._written[row] += count
+
+    # (time, value) of the newest sample, or None.
+    def latest(self, channel):
+        row = self.channels.index(channel)
+        if not self._written[row]:
+            return None
+        index = (self._written[row] - 1) % self.size
+        return self._times[row, index], self._values[row, index]
+
+    # Times and values of a channel, oldest first, as NumPy arrays.
+    def samples(self, channel):
+        row = self.channels.index(channel)
+        written = int(self._written[row])
+        if written < self.size:
+            return self._times[row, :written], self._values[row, :written]
+        start = written % self.size
+        order = numpy.r_[start:self.size, 0:start]
+        return self._times[row, order], self._values[row, order]
+
+
+class FrameDecoder:
+    def __init__(self, history):
+        self.history = history
+        self.frames_decoded = 0
+        self.samples_decoded = 0
+
+    # Decodes a FrameBatch. Returns the channels that got new samples.
+    def decode(self, batch):
+        count = len(batch)
+        if not count:
+            return ()
+        self.frames_decoded += count
+        ids = numpy.frombuffer(batch.ids, dtype=numpy.uint32)
+        data = numpy.frombuffer(batch.data, dtype=numpy.uint8).reshape(
+            count, 8)
+        times = numpy.frombuffer(batch.times, dtype=numpy.float64)
+
+        # Single frame mode 01 responses: length, 0x41, PID, A, B, ...
+        responses = ((ids & OBD_RESPONSE_MASK) == OBD_RESPONSE_BASE) & \
+            (data[:, 1] == 0x41)
+        if not responses.any():
+            return ()
+        pids = data[responses, 2]
+        a = data[responses, 3].astype(numpy.float64)
+        b = data[responses, 4].astype(numpy.float64)
+        response_times = times[responses]
+
+        updated = []
+        for pid in numpy.unique(pids):
+            entry = PIDS.get(int(pid))
+            if entry is None:
+                continue
+            channel, formula = entry
+            selected = pids == pid
+            self.history.extend(channel, response_times[selected],
+                                formula(a[selected], b[selected]))
+            self.samples_decoded += int(selected.sum())
+            updated.append(channel)
+        return updated
+
+
+# ---------- Sources ----------
+# Each source has read_frames(), which blocks until some frames have
+# arrived and returns a FrameBatch, and close(). A batch may be empty when
+# nothing came; None means the end of the stream.
+
+class SocketCanSource:
+    FRAME = struct.Struct('=IB3x8s')
+    # struct timeval of SO_TIMESTAMP.
+    TIMESTAMP = struct.Struct('=ll')
+
+    # pids are polled at poll_rate requests per second in all; None only
+    # listens, for buses where the ECU broadcasts on its own.
+    def __init__(self, interface, pids=POLL_PIDS, poll_rate=50.0):
+        self._socket = socket.socket(socket.AF_CAN, socket.SOCK_RAW,
+                                     socket.CAN_RAW)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_TIMESTAMP, 1)
+        self._socket.bind((interface,))
+        self._socket.settimeout(0.05)
+        self._pids = pids
+        self._poll_interval = 1.0 / poll_rate
+        self._next_poll = 0.0
+        self._poll_index = 0
+        self._closed = threading.Event()
+        self._handed_over = None
+
+    def _poll(self, now):
+        if not self._pids or now < self._next_poll:
+            return
+        self._next_poll = now + self._poll_interval
+        pid = self._pids[self._poll_index % len(self._pids)]
+        self._poll_index += 1
+        self._socket.send(self.FRAME.pack(
+            OBD_REQUEST_ID, 8, bytes((0x02, 0x01, pid))))
+
+    # One frame and its kernel receive time, or None if none is queued.
+    def _receive(self):
+        try:
+            frame, ancillary, _, _ = self._socket.recvmsg(
+                self.FRAME.size, self.TIMESTAMP.size)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return None
+        t = time.time()
+        for level, kind, data in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SO_TIMESTAMP:
+                seconds, microseconds = self.TIMESTAMP.unpack(data)
+                t = seconds + microseconds / 1e6
+        can_id, length, payload = self.FRAME.unpack(frame)
+        return t, can_id & socket.CAN_EFF_MASK, payload[:length]
+
+    def read_frames(self):
+        batch = FrameBatch()
+        while not self._closed.is_set():
+            self._poll(time.monotonic())
+            try:
+                received = self._receive()
+            except OSError:
+                return None
+            if received is None:
+                continue
+            batch.append(*received)
+            # Let a batch's worth gather, then take whatever is queued
+            # without waiting.
+            if self._handed_over is not None:
+                self._closed.wait(
+                    self._handed_over + BATCH_INTERVAL - time.monotonic())
+            self._socket.setblocking(False)
+            try:
+                while len(batch) < BATCH_SIZE:
+                    received = self._receive()
+                    if received is None:
+                        break
+                    batch.append(*received)
+            except OSError:
+                pass
+            finally:
+                self._socket.settimeout(0.05)
+            break
+        self._handed_over = time.monotonic() \
+            if len(batch) < BATCH_SIZE else None
+        return batch
+
+    def close(self):
+        self._closed.set()
+        self._socket.close()
+
+
+# An ELM327 adapter polled one PID at a time, with CAN headers turned on so
+# replies parse like any other frame.
+class Elm327Source:
+    SETUP = (b"ATZ", b"ATE0", b"ATL0", b"ATS0", b"ATH1", b"ATSP0")
+
+    def __init__(self, path, baudrate=38400, pids=POLL_PIDS):
+        if serial is None:
+            raise RuntimeError("pyserial is needed for an ELM327")
+        self._port = serial.Serial(path, baudrate, timeout=1)
+        self._pids = pids
+        self._poll_index = 0
+        for command in self.SETUP:
+            self._command(command)
+
+    def _command(self, command):
+        self._port.write(command + b"\r")
+        return self._port.read_until(b">")
+
+    def read_frames(self):
+        batch = FrameBatch()
+        pid = self._pids[self._poll_index % len(self._pids)]
+        self._poll_index += 1
+        try:
+            reply = self._command(b"01%02X" % pid)
+        except (OSError, serial.SerialException):
+            return None
+        now = time.time()
+        # Lines of hex, e.g. 7E804410C1AF8: 3 digit id, then the data.
+        for line in reply.replace(b">", b"").split(b"\r"):
+            line = line.strip().replace(b" ", b"")
+            if len(line) < 5:
+                continue
+            try:
+                can_id = int(line[:3], 16)
+                payload = bytes.fromhex(line[3:].decode())
+            except ValueError:
+                continue  # NO DATA, SEARCHING... and the like
+            batch.append(now, can_id, payload)
+        return batch
+
+    def close(self):
+        self._port.close()
+
+
+# Plays back a candump -l log, e.g.
+#
+#   (1436509052.249713) vcan0 7E8#04410C1AF8000000
+#
+# at the recorded pace divided by `speed`; speed=0 reads as fast as
+# possible.
+class CandumpReplaySource:
+    def __init__(self, path, speed=1.0, loop=False):
+        self._file = open(path, 'rb')
+        self._speed = speed
+        self._loop = loop
+        self._closed = threading.Event()
+        # Recorded time of the first frame and when it was replayed.
+        self._first = None
+        self._started = None
+        self._pending = None
+        # When the last batch was handed over, unless it was full.
+        self._handed_over = None
+
+    def _next_line(self):
+        line = self._file.readline()
+        if not line and self._loop:
+            self._file.seek(0)
+            self._first = None
+            line = self._file.readline()
+        return line
+
+    def read_frames(self):
+        batch = FrameBatch()
+        if self._speed > 0 and self._handed_over is not None:
+            self._closed.wait(
+                self._handed_over + BATCH_INTERVAL - time.monotonic())
+        while len(batch) < BATCH_SIZE and not self._closed.is_set():
+            line = self._pending or self._next_line()
+            self._pending = None
+            if not line:
+                if not len(batch):
+                    return None
+                break
+            try:
+                stamp, _, frame = line.split(None, 2)
+                t = float(stamp[1:-1])
+                can_id, _, payload = frame.strip().partition(b'#')
+                can_id = int(can_id, 16)
+                payload = bytes.fromhex(payload.decode())
+            except ValueError:
+                continue
+
+            if self._speed > 0:
+                now = time.monotonic()
+                if self._first is None:
+                    self._first, self._started = t, now
+                due = self._started + (t - self._first) / self._speed
+                if due > now:
+                    if len(batch):
+                        # Hand over what is due and keep this one.
+                        self._pending = line
+                        break
+                    self._closed.wait(due - now + BATCH_INTERVAL)
+            batch.append(t, can_id, payload)
+        # Straight back for more if it is behind.
+        self._handed_over = time.monotonic() \
+            if len(batch) < BATCH_SIZE else None
+        return batch
+
+    def close(self):
+        self._closed.set()
+        self._file.close()
+
+
+# "socketcan:can0" (or "vcan0" for testing), "elm327:/dev/ttyUSB0[:baud]"
+# or "replay:path[:speed]".
+def open_telemetry_source(spec):
+    kind, _, rest = spec.partition(":")
+    if kind == "socketcan":
+        return SocketCanSource(rest)
+    if kind == "elm327":
+        parts = rest.split(":")
+        baudrate = int(parts[1]) if len(parts) > 1 else 38400
+        return Elm327Source(parts[0], baudrate)
+    if kind == "replay":
+        parts = rest.split(":")
+        speed = float(parts[1]) if len(parts) > 1 else 1.0
+        return CandumpReplaySource(parts[0], speed, loop=True)
+    raise ValueError(f"Unknown telemetry source {spec!r}")
+
+
+class TelemetryThread(QThread):
+    # {channel: latest value} for the channels that changed, at most
+    # max_rate times per second. Changes held back by the limit are sent
+    # once it allows, even if no more frames come.
+    valuesChanged = pyqtSignal(object)
+
+    def __init__(self, source, max_rate=10.0, history_size=HISTORY_SIZE,
+                 parent=None):
+        super(TelemetryThread, self).__init__(parent)
+        self._source = source
+        self._interval = 1.0 / max_rate
+        self._running = True
+        self.history = TelemetryHistory(history_size)
+        self.decoder = FrameDecoder(self.history)
+        # Guards the history and the changes not sent yet, which the flush
+        # timer reads.
+        self._lock = threading.Lock()
+        self._changed = set()
+        self._last_emit = 0.0
+        self._flush_timer = None
+        # Seconds spent decoding and publishing, for the benchmark.
+        self.decode_time = 0.0
+
+    def stop(self):
+        self._running = False
+        self._source.close()
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+    def run(self):
+        while self._running:
+            try:
+                batch = self._source.read_frames()
+            except Exception as e:
+                if self._running:
+                    log.error("Telemetry read failed: %s", e)
+                break
+            if batch is None:
+                break
+            if not len(batch):
+                continue
+
+            started = time.perf_counter()
+            values = None
+            with self._lock:
+                self._changed.update(self.decoder.decode(batch))
+                wait = self._last_emit + self._interval - time.monotonic()
+                if wait <= 0:
+                    values = self._take_changes()
+                else:
+                    self._schedule_flush(wait)
+            if values:
+                self.valuesChanged.emit(values)
+            self.decode_time += time.perf_counter() - started
+
+    # Sends what was held back by the rate limit, on the timer's thread.
+    def _flush(self):
+        with self._lock:
+            self._flush_timer = None
+            # The run loop may have sent an update since the timer started.
+            wait = self._last_emit + self._interval - time.monotonic()
+            if wait > 0:
+                self._schedule_flush(wait)
+                return
+            values = self._take_changes()
+        if values:
+            self.valuesChanged.emit(values)
+
+    # Lock must be held.
+    def _schedule_flush(self, wait):
+        if self._changed and self._flush_timer is None and self._running:
+            self._flush_timer = threading.Timer(wait, self._flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    # Latest value of every changed channel. Lock must be held.
+    def _take_changes(self):
+        if not self._changed:
+            return None
+        self._last_emit = time.monotonic()
+        values = {channel: float(self.history.latest(channel)[1])
+                  for channel in self._changed}
+        self._changed.clear()
+        return values
@@ -0,0 +1,284 @@
+# Trip history.
+#
+# TripLog keeps a sample a second of where the car was, how fast it went
+# and what the engine was doing, as one file per column of fixed-width
+# little-endian values:
+#
+#   time.f8  latitude.f8  longitude.f8  speed_kmh.f4  rpm.f4  coolant_c.f4
+#
+# Row i is the i-th value of every file. Files are only ever appended to,
+# by a background thread that writes what has gathered every
+# flush_interval seconds as one write per column and then fsyncs, so the
+# SD card sees a few small sequential writes a minute. A power cut can
+# leave the columns at different lengths; the rows past the shortest one
+# are dropped the next time the log is opened.
+#
+# TripReader maps the files read-only with NumPy and answers queries with
+# whole-array operations: a time range is found by binary search on the
+# time column, trips are split where samples are more than TRIP_GAP apart,
+# and distances, drive times and top speeds per trip come from ufunc
+# reductions, so a year of samples is summarised without a Python loop
+# over rows. Long ranges are taken CHUNK_ROWS at a time.
+
+import array
+import collections
+import logging
+import math
+import os
+import threading
+import time
+import numpy
+
+log = logging.getLogger(__name__)
+
+# (column, array typecode, NumPy dtype).
+COLUMNS = (
+    ('time', 'd', '<f8'),
+    ('latitude', 'd', '<f8'),
+    ('longitude', 'd', '<f8'),
+    ('speed_kmh', 'f', '<f4'),
+    ('rpm', 'f', '<f4'),
+    ('coolant_c', 'f', '<f4'),
+)
+# Seconds between samples kept.
+SAMPLE_INTERVAL = 1.0
+# Seconds between writes to disk.
+FLUSH_INTERVAL = 30.0
+# Samples further apart than this, in seconds, belong to different trips.
+TRIP_GAP = 300.0
+# Slower than this, in km/h, counts as standing still.
+MOVING_SPEED = 2.0
+# Mean radius of the Earth in km.
+EARTH_RADIUS = 6371.0
+# Rows summarised at a time, to bound the memory a query takes.
+CHUNK_ROWS = 1 << 20
+
+TripSummary = collections.namedtuple(
+    'TripSummary',
+    'start end distance_km drive_time average_kmh top_kmh')
+
+
+def default_directory():
+    data_home = os.environ.get(
+        "XDG_DATA_HOME",
+        os.path.join(os.path.expanduser("~"), ".local", "share"))
+    return os.environ.get(
+        "DASHBOARD_TRIPS",
+        os.path.join(data_home, "suzuki-lj-dashboard", "trips"))
+
+
+def column_path(directory, name, dtype):
+    return os.path.join(directory, f"{name}.{dtype[1:]}")
+
+
+# Rows every column has.
+def complete_rows(directory):
+    rows = None
+    for name, _, dtype in COLUMNS:
+        path = column_path(directory, name, dtype)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        count = size // numpy.dtype(dtype).itemsize
+        rows = count if rows is None else min(rows, count)
+    return rows
+
+
+# Cuts every column back to the shortest one. Returns the row count.
+def repair_columns(directory):
+    rows = complete_rows(directory)
+    for name, _, dtype in COLUMNS:
+        path = column_path(directory, name, dtype)
+        length = rows * numpy.dtype(dtype).itemsize
+        if os.path.exists(path) and os.path.getsize(path) != length:
+            log.warning("Trimming %s to %d rows", path, rows)
+            os.truncate(path, length)
+    return rows
+
+
+class TripLog:
+    def __init__(self, directory=None, sample_interval=SAMPLE_INTERVAL,
+                 flush_interval=FLUSH_INTERVAL):
+        self.directory = directory or default_directory()
+        self._sample_interval = sample_interval
+        self._flush_interval = flush_interval
+        self._condition = threading.Condition()
+        self._pending = {name: array.array(typecode)
+                         for name, typecode, _ in COLUMNS}
+        self._last_sample = None
+        self._running = True
+        self.flushes = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.rows = repair_columns(self.directory)
+        self._files = {
+            name: open(column_path(self.directory, name, dtype), 'ab')
+            for name, _, dtype in COLUMNS}
+
+        self._thread = threading.Thread(target=self._run, name="triplog",
+                                        daemon=True)
+        self._thread.start()
+
+    # Adds a sample unless the last one is less than sample_interval old.
+    # Missing values are stored as NaN.
+    def append(self, latitude, longitude, speed_kmh, rpm=None,
+               coolant_c=None, now=None):
+        now = time.time() if now is None else now
+        if self._last_sample is not None and \
+                now - self._last_sample < self._sample_interval:
+            return False
+        self._last_sample = now
+        row = (now, latitude, longitude, speed_kmh, rpm, coolant_c)
+        with self._condition:
+            for (name, _, _), value in zip(COLUMNS, row):
+                self._pending[name].append(
+                    math.nan if value is None else value)
+        return True
+
+    # Writes what has gathered now and stops the writer.
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        for column in self._files.values():
+            column.close()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._running:
+                    self._condition.wait(self._flush_interval)
+                pending = self._pending
+                self._pending = {name: array.array(typecode)
+                                 for name, typecode, _ in COLUMNS}
+                running = self._running
+
+            if len(pending['time']):
+                try:
+                    self._write(pending)
+                except OSError as e:
+                    log.error("Couldn't write the trip log in %s: %s",
+                              self.directory, e)
+            if not running:
+                return
+
+    def _write(self, pending):
+        for name, values in pending.items():
+            self._files[name].write(values.tobytes())
+        for column in self._files.values():
+            column.flush()
+            os.fsync(column.fileno())
+        self.rows += len(pending['time'])
+        self.flushes += 1
+
+
+def _average(distance_km, drive_time):
+    return distance_km / drive_time * 3600 if drive_time > 0 else 0.0
+
+
+def _merge(trip, more):
+    distance_km = trip.distance_km + more.distance_km
+    drive_time = trip.drive_time + more.drive_time
+    return TripSummary(trip.start, more.end, distance_km, drive_time,
+                       _average(distance_km, drive_time),
+                       max(trip.top_kmh, more.top_kmh))
+
+
+class TripReader:
+    def __init__(self, directory=None):
+        self.directory = directory or default_directory()
+        rows = self.rows = complete_rows(self.directory)
+        # Mapped read-only; rows written after this are not seen.
+        self._columns = {}
+        for name, _, dtype in COLUMNS:
+            if rows:
+                self._columns[name] = numpy.memmap(
+                    column_path(self.directory, name, dtype), dtype=dtype,
+                    mode='r', shape=(rows,))
+            else:
+                self._columns[name] = numpy.zeros(0, dtype=dtype)
+
+    # Row range [first, last) with start <= time < end.
+    def _rows(self, start=None, end=None):
+        times = self._columns['time']
+        first = 0 if start is None else \
+            int(numpy.searchsorted(times, start, side='left'))
+        last = self.rows if end is None else \
+            int(numpy.searchsorted(times, end, side='left'))
+        return first, last
+
+    # A column's values between start and end, as a NumPy array.
+    def column(self, name, start=None, end=None):
+        first, last = self._rows(start, end)
+        return self._columns[name][first:last]
+
+    # TripSummary of every trip with samples between start and end.
+    def trips(self, start=None, end=None):
+        first, last = self._rows(start, end)
+        trips = []
+        for low in range(first, last, CHUNK_ROWS):
+            high = min(last, low + CHUNK_ROWS)
+            chunk = self._summarise(low, high, low == first)
+            if trips and chunk and not chunk[0][0]:
+                # The chunk's first trip carries on the last one.
+                _, head = chunk.pop(0)
+                trips[-1] = _merge(trips[-1], head)
+            trips.extend(summary for _, summary in chunk)
+        return trips
+
+    # [(starts a trip, TripSummary)] for rows [low, high), looking back at
+    # row low - 1 unless `first`.
+    def _summarise(self, low, high, first):
+        if high <= low:
+            return []
+        back = low if first else low - 1
+
+        def column(name):
+            return numpy.asarray(self._columns[name][back:high],
+                                 dtype=numpy.float64)
+
+        times = column('time')
+        latitude = numpy.radians(column('latitude'))
+        longitude = numpy.radians(column('longitude'))
+        speed = column('speed_kmh')
+
+        # Per sample: time since the previous one and distance from it.
+        # Steps across a gap start a new trip and count for nothing.
+        step = numpy.diff(times, prepend=times[0])
+        new_trip = step > TRIP_GAP
+        new_trip[0] = True
+        half_lat = numpy.diff(latitude, prepend=latitude[0]) / 2
+        half_lon = numpy.diff(longitude, prepend=longitude[0]) / 2
+        a = numpy.sin(half_lat) ** 2 + numpy.cos(latitude) * \
+            numpy.cos(numpy.roll(latitude, 1)) * numpy.sin(half_lon) ** 2
+        distance = 2 * EARTH_RADIUS * numpy.arcsin(
+            numpy.sqrt(numpy.clip(a, 0, 1)))
+        # No fix (NaN position) adds no distance.
+        distance[new_trip | numpy.isnan(distance)] = 0
+        moving = numpy.where(new_trip | ~(speed >= MOVING_SPEED), 0, step)
+
+        if not first:
+            # Drop the row looked back at; it only supplied the step.
+            times, speed, distance, moving, new_trip = (
+                values[1:] for values in
+                (times, speed, distance, moving, new_trip))
+        starts = numpy.flatnonzero(new_trip)
+        if not len(starts) or starts[0] != 0:
+            starts = numpy.r_[0, starts]
+        ends = numpy.r_[starts[1:], len(times)] - 1
+        distance_km = numpy.add.reduceat(distance, starts)
+        drive_time = numpy.add.reduceat(moving, starts)
+        top = numpy.nan_to_num(numpy.fmax.reduceat(speed, starts))
+        return [(bool(new_trip[index]),
+                 TripSummary(begin, finish, km, seconds,
+                             _average(km, seconds), fastest))
+                for index, begin, finish, km, seconds, fastest in zip(
+                    starts.tolist(), times[starts].tolist(),
+                    times[ends].tolist(), distance_km.tolist(),
+                    drive_time.tolist(), top.tolist())]
+
+    # Kilometres driven between start and end.
+    def odometer(self, start=None, end=None):
+        return sum(trip.distance_km for trip in self.trips(start, end))
+
+    def close(self):
+        self._columns = {}
@@ -0,0 +1,107 @@
+# Precompiled Qt Designer forms.
+#
+# uic.loadUi() parses the .ui XML and builds the widgets through
+# reflection on every start. Instead the form is compiled once with
+# uic.compileUi() into a Python module, stored under a name that includes
+# a hash of the .ui file, and imported from then on, so an edited form is
+# recompiled on the next start and a stale one is never used. The cache
+# directory is DASHBOARD_CACHE_DIR, or ~/.cache/suzuki-lj-dashboard.
+#
+# To fill the cache ahead of time, e.g. when installing:
+#
+#   python ui_cache.py mainwindow.ui
+
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import sys
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+def cache_dir():
+    return os.environ.get(
+        "DASHBOARD_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache",
+                     "suzuki-lj-dashboard"))
+
+
+def _ui_hash(ui_path):
+    with open(ui_path, 'rb') as ui_file:
+        return hashlib.sha256(ui_file.read()).hexdigest()[:16]
+
+
+def compiled_path(ui_path):
+    name = os.path.splitext(os.path.basename(ui_path))[0]
+    return os.path.join(cache_dir(),
+                        f"ui_{name}_{_ui_hash(ui_path)}.py")
+
+
+def _compile_source(ui_path):
+    # Only needed on a cache miss.
+    from PyQt5 import uic
+    source = io.StringIO()
+    with open(ui_path) as ui_file:
+        uic.compileUi(ui_file, source)
+    return source.getvalue()
+
+
+# Compiles the form into the cache unless it is already there, and
+# returns the module path. The file is written under a temporary name and
+# renamed, so a power cut never leaves half a module behind.
+def compile_ui(ui_path):
+    path = compiled_path(ui_path)
+    if os.path.exists(path):
+        return path
+
+    source = _compile_source(ui_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as out:
+            out.write(source)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    log.info("Compiled %s to %s", ui_path, path)
+    return path
+
+
+def _form_class(namespace):
+    for name, value in namespace.items():
+        if name.startswith("Ui_") and isinstance(value, type):
+            return value
+    raise ImportError("No Ui_ class in compiled form")
+
+
+# Builds the form into widget, like uic.loadUi(ui_path, widget): the named
+# child widgets become attributes of widget.
+def load_ui(ui_path, widget):
+    try:
+        path = compile_ui(ui_path)
+        spec = importlib.util.spec_from_file_location(
+            os.path.splitext(os.path.basename(path))[0], path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        namespace = vars(module)
+    except OSError as e:
+        # Read-only home directory and the like. Compile in memory.
+        log.warning("Couldn't cache compiled UI: %s", e)
+        namespace = {}
+        exec(compile(_compile_source(ui_path), ui_path, 'exec'), namespace)
+
+    form = _form_class(namespace)()
+    form.setupUi(widget)
+    for name, value in vars(form).items():
+        setattr(widget, name, value)
+    return form
+
+
+if __name__ == "__main__":
+    for ui_path in sys.argv[1:] or ["mainwindow.ui", "climate.ui"]:
+        print(compile_ui(ui_path))